@@ -6,6 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
+    # Tests run with their own settings, see webserv/test_settings.py
+    if sys.argv[1:2] == ['test']:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webserv.test_settings')
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webserv.settings')
     try:
         from django.core.management import execute_from_command_line
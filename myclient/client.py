@@ -1,22 +1,295 @@
 import argparse
+import codecs
+import csv
 import requests
+import os
 import sys
 import getpass
 import json
+import math
+import random
+import re
+import sqlite3
+import subprocess
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 URL = "http://127.0.0.1:8000/api"
 
+# Seconds a cached response is used without asking the server, after that it is
+# revalidated with its ETag
+CACHE_TTLS = {"list": 300, "view": 30, "average": 30}
+
+# Lists that can be streamed: their path, and the key of the list in the JSON response
+STREAMS = {"list": ("/list/", "modules"), "view": ("/view/", "professors")}
+
+# Longest streamed list that is also kept in the cache, longer ones are only streamed
+CACHE_MAX_ITEMS = 20000
+
+# Function for the path of the cache file, in the user cache directory
+def default_cache_path():
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "professor-rating", "cache.sqlite3")
+
+# ResponseCache class
+# Keeps catalog and aggregate responses in an SQLite file, so they survive between sessions
+class ResponseCache:
+
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS response (
+                base_url TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                etag TEXT,
+                data TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                PRIMARY KEY (base_url, kind, params)
+            )
+        """)
+
+    # Function for a cached response, returns (data, etag, age in seconds) or None
+    def get(self, base_url, kind, params):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT data, etag, stored_at FROM response WHERE base_url = ? AND kind = ? AND params = ?",
+                (base_url, kind, params)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], time.time() - row[2]
+
+    def set(self, base_url, kind, params, data, etag):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO response (base_url, kind, params, etag, data, stored_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (base_url, kind, params, etag, json.dumps(data), time.time()))
+
+    # Function for marking a response as fresh again, after the server said it hasn't changed
+    def touch(self, base_url, kind, params):
+        with self.lock:
+            self.db.execute("UPDATE response SET stored_at = ? WHERE base_url = ? AND kind = ? AND params = ?",
+                            (time.time(), base_url, kind, params))
+
+    # Function for dropping every cached response of some kinds
+    def invalidate(self, base_url, kinds):
+        with self.lock:
+            self.db.executemany("DELETE FROM response WHERE base_url = ? AND kind = ?",
+                                [(base_url, kind) for kind in kinds])
+
+# Function for the path of the offline rating queue, in the user data directory
+# Unlike the cache it holds data that exists nowhere else, so it doesn't go in the cache directory
+def default_outbox_path():
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Application Support")
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    return os.path.join(base, "professor-rating", "outbox.sqlite3")
+
+# RatingOutbox class
+# Durable queue of ratings that couldn't be sent, kept per server and user until a sync.
+# Queuing the same professor and module instance again replaces the earlier rating,
+# and every rating gets an id the server uses to ignore it if it is sent twice.
+class RatingOutbox:
+
+    def __init__(self, path=None):
+        self.path = path or default_outbox_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Every queued rating must survive a crash or power cut
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS rating (
+                id TEXT PRIMARY KEY,
+                base_url TEXT NOT NULL,
+                username TEXT NOT NULL,
+                professor_id TEXT NOT NULL,
+                module_code TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                semester INTEGER NOT NULL,
+                stars INTEGER NOT NULL,
+                "update" INTEGER NOT NULL,
+                queued_at REAL NOT NULL,
+                UNIQUE (base_url, username, professor_id, module_code, year, semester)
+            )
+        """)
+
+    # Function for queuing a rating, returns its id
+    def add(self, base_url, username, professor_id, module_code, year, semester, stars, update=False):
+        rating_id = uuid.uuid4().hex
+        with self.lock:
+            # A new id for a replaced rating, the old one may already have reached the server
+            self.db.execute(
+                'INSERT INTO rating (id, base_url, username, professor_id, module_code, year, semester, stars, "update", queued_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (base_url, username, professor_id, module_code, year, semester) DO UPDATE SET '
+                'id = excluded.id, stars = excluded.stars, "update" = "update" OR excluded."update", '
+                'queued_at = excluded.queued_at',
+                (rating_id, base_url, username, professor_id, module_code, year, semester, stars, update, time.time()))
+        return rating_id
+
+    # Function for the queued ratings of a user on a server, oldest first
+    def pending(self, base_url, username, limit=-1):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT id, professor_id, module_code, year, semester, stars, "update" FROM rating '
+                'WHERE base_url = ? AND username = ? ORDER BY queued_at LIMIT ?',
+                (base_url, username, limit)).fetchall()
+        return [{"id": row[0], "professor_id": row[1], "module_code": row[2], "year": row[3],
+                 "semester": row[4], "stars": row[5], "update": bool(row[6])} for row in rows]
+
+    def count(self, base_url, username):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM rating WHERE base_url = ? AND username = ?",
+                                   (base_url, username)).fetchone()[0]
+
+    def remove(self, ids):
+        with self.lock:
+            self.db.executemany("DELETE FROM rating WHERE id = ?", [(rating_id,) for rating_id in ids])
+
+# Methods that can be repeated without changing the result, they are retried after any failure
+IDEMPOTENT_METHODS = ["get", "head", "options", "put", "delete"]
+
+# CircuitBreaker class
+# Stops sending requests to a server that keeps failing, so callers fail fast instead of
+# waiting on timeouts. After <threshold> failures in a row the circuit opens for
+# <cooldown> seconds, then one trial request is let through: success closes the
+# circuit, failure opens it again. A threshold of 0 turns the breaker off.
+class CircuitBreaker:
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    # Function for whether a request may be sent now
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    # Function for recording the outcome of a request, returns True when it opened the circuit
+    def record(self, ok):
+        with self.lock:
+            trial, self.trial = self.trial, False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return False
+            self.failures += 1
+            if self.threshold and (trial or self.failures >= self.threshold):
+                opened = self.opened_at is None
+                self.opened_at = time.monotonic()
+                return opened
+            return False
+
+    # Function for the seconds until a trial request is let through, 0 when the circuit is closed
+    def remaining(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.cooldown - (time.monotonic() - self.opened_at))
+
+# Function for the seconds a Retry-After header asks to wait, None when there is none
+# The header is either a number of seconds or an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Function for a response header, whatever its case
+def header(headers, name):
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
 # APIClient class
 # Creates a client that communicates directly with the server
 class APIClient:
 
-    def __init__(self, base_url=URL):
+    # timeout is (connect, read) seconds, retries the extra attempts a failed request gets,
+    # pool_size the keep-alive connections kept for concurrent use of one client
+    def __init__(self, base_url=URL, pool_size=10, cache=True, outbox=True, timeout=(3.05, 30), retries=3,
+                 backoff=0.5, backoff_max=10, max_retry_after=30, breaker_threshold=5, breaker_cooldown=30):
         self.base_url = base_url.rstrip('/')
         self.session = requests.Session()
+        # Requests beyond the pool wait for a free connection instead of opening throwaway ones
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+
+        # Transport statistics, see transport_stats()
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "attempts": 0, "retries": 0, "failures": 0, "timeouts": 0,
+                      "circuit_opened": 0, "fast_failures": 0}
+        self.latency = LatencyHistogram()
+
         self.token = None
         self.username = None
 
+        # cache is True for the default cache file, False for none, or a ResponseCache
+        self.cache = None
+        if cache is True:
+            try:
+                self.cache = ResponseCache()
+            except (OSError, sqlite3.Error):
+                # No usable cache directory, every request goes to the server
+                self.cache = None
+        elif cache:
+            self.cache = cache
+
+        # outbox works the same way, ratings that can't be sent are queued in it
+        self.outbox = None
+        if outbox is True:
+            try:
+                self.outbox = RatingOutbox()
+            except (OSError, sqlite3.Error):
+                self.outbox = None
+        elif outbox:
+            self.outbox = outbox
+        self.sync_lock = threading.Lock()
+
     # Function to send registration request to the server
     def register(self, username, email, password):
         url = f"{self.base_url}/register/"
@@ -36,7 +309,8 @@ class APIClient:
             "password": password
         }
 
-        response = self.make_request("post", url, json=data)
+        # Logging in again returns the same token
+        response = self.make_request("post", url, json=data, idempotent=True)
         
         try:
             token = response.get("data", {}).get("token")
@@ -48,6 +322,8 @@ class APIClient:
             self.username = username
             # Add the token to the session headers
             self.session.headers.update({"Authorization": f"Token {token}"})
+            # Send the ratings queued while offline now the server can be reached
+            self.flush_outbox(response)
 
         return response
 
@@ -66,12 +342,11 @@ class APIClient:
 
     # Function to send list request to the server
     def list_modules(self):
-        url = f"{self.base_url}/list/"
-        response = self.make_request("get", url)
+        response = self.read_stream("list")
         return response
     
     # Function to send new rating request to the server
-    def rate_professor(self, professor_id, module_code, year, semester, stars):
+    def rate_professor(self, professor_id, module_code, year, semester, stars, update=False, defer=False):
         url = f"{self.base_url}/rate/"
         data = {
             "professor_id": professor_id,
@@ -80,13 +355,115 @@ class APIClient:
             "semester": semester,
             "stars": stars
         }
+        # Replace an earlier rating instead of failing
+        if update:
+            data["update"] = True
+
+        # Don't send ratings the cached catalog says the server would reject
+        error = self.validate_rating(professor_id, module_code, year, semester, stars)
+        if error:
+            return error
+
+        # Queue the rating when asked to, or when it never reached the server. One that failed
+        # after it was sent may have been saved, queuing it would send it again under a new id
+        if defer:
+            return self.queue_rating(data)
         response = self.make_request("post", url, json=data)
+        if response.get("connect_failed"):
+            return self.queue_rating(data, response)
+
+        # The rating changes the averages, so they have to come from the server again
+        if self.cache and response.get("status_code") in [200, 201, 202]:
+            self.cache.invalidate(self.base_url, ["view", "average"])
+        self.flush_outbox(response)
         return response
 
+    # Function for putting a rating in the outbox, returns a response saying it was queued
+    # Without an outbox, or before login, the original error is returned
+    def queue_rating(self, data, failed=None):
+        if self.outbox is None or not self.username:
+            return failed or {"error": "Ratings can only be queued when logged in", "status_code": None}
+        try:
+            year, semester, stars = int(data["year"]), int(data["semester"]), int(data["stars"])
+        except (TypeError, ValueError):
+            return failed or {"error": "Year, semester and rating must be numbers", "status_code": None}
+
+        rating_id = self.outbox.add(self.base_url, self.username, data["professor_id"], data["module_code"],
+                                    year, semester, stars, data.get("update", False))
+        return {
+            "status_code": None,
+            "queued": True,
+            "data": {"id": rating_id, "queued": self.outbox.count(self.base_url, self.username)},
+            "error": failed.get("error") if failed else None
+        }
+
+    # Function for sending the queued ratings in batches
+    # Returns the outcome of every rating sent, ratings stay queued only when the server
+    # can't be reached. Only one sync runs at a time, others return None straight away.
+    def sync(self, batch_size=50):
+        if self.outbox is None or not self.username:
+            return None
+        if not self.sync_lock.acquire(blocking=False):
+            return None
+        try:
+            outcomes = []
+            while True:
+                batch = self.outbox.pending(self.base_url, self.username, batch_size)
+                if not batch:
+                    break
+                # The ids make resending a batch safe
+                response = self.make_request("post", f"{self.base_url}/rate/batch/", json={"ratings": batch},
+                                             idempotent=True)
+                if response.get("status_code") != 200 or not isinstance(response.get("data"), dict):
+                    # Keep the ratings for the next sync, and report why this one stopped
+                    outcomes.append({"id": None, "status_code": response.get("status_code"),
+                                     "error": response.get("error") or batch_error(response)})
+                    break
+
+                items = {item["id"]: item for item in batch}
+                for result in response["data"]["results"]:
+                    item = items.get(result.get("id"))
+                    if item is not None:
+                        outcomes.append({**result, "input": item})
+                self.outbox.remove(list(items))
+                if self.cache and response["data"].get("succeeded"):
+                    self.cache.invalidate(self.base_url, ["view", "average"])
+            return outcomes
+        finally:
+            self.sync_lock.release()
+
+    # Function for syncing after a request that reached the server, if ratings are queued
+    # The outcomes are added to the response under "synced"
+    def flush_outbox(self, response):
+        if self.outbox is None or not self.username or response.get("status_code") is None:
+            return
+        if self.outbox.count(self.base_url, self.username):
+            outcomes = self.sync()
+            if outcomes:
+                response["synced"] = outcomes
+
+    # Function for checking a rating against the cached catalog
+    # Returns an error response like the server's, or None when the rating looks
+    # valid or there is no cached catalog to check it against
+    def validate_rating(self, professor_id, module_code, year, semester, stars):
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self.base_url, "list", "")
+        if cached is None:
+            return None
+
+        error = rating_error(cached[0], professor_id, module_code, year, semester, stars)
+        if error and cached[2] >= CACHE_TTLS["list"]:
+            # The catalog may be out of date, check again with the current one
+            response = self.list_modules()
+            if response.get("status_code") != 200:
+                return None
+            error = rating_error(response["data"], professor_id, module_code, year, semester, stars)
+        return error
+
     # Function to send view request to the server
     def view(self):
-        url = f"{self.base_url}/view/"
-        response = self.make_request("get", url)
+        response = self.read_stream("view")
         return response
 
     # Function to send average request to the server
@@ -98,12 +475,170 @@ class APIClient:
             "module_code": module_code
         }
 
-        response = self.make_request("post", url, json=data)
+        # Read-only, so it can be retried like a GET
+        response = self.cached_request("average", "post", url, params=data, json=data, idempotent=True)
+        return response
+
+    # Function that answers from the cache while a response is fresh
+    # Stale responses are revalidated with If-None-Match, a 304 reuses the cached body.
+    # Only successful responses are cached, and they are marked with "cached": True.
+    def cached_request(self, kind, method, url, params=None, **kwargs):
+        if self.cache is None:
+            return self.make_request(method, url, **kwargs)
+
+        key = json.dumps(params, sort_keys=True) if params else ""
+        cached = self.cache.get(self.base_url, kind, key)
+        if cached is not None and cached[2] < CACHE_TTLS[kind]:
+            return {"status_code": 200, "headers": {}, "data": cached[0], "cached": True}
+
+        headers = {}
+        if cached is not None and cached[1]:
+            headers["If-None-Match"] = cached[1]
+        response = self.make_request(method, url, headers=headers, **kwargs)
+
+        if response.get("status_code") == 304 and cached is not None:
+            self.cache.touch(self.base_url, kind, key)
+            return {"status_code": 200, "headers": response["headers"], "data": cached[0], "cached": True}
+        if response.get("status_code") == 200 and isinstance(response.get("data"), dict):
+            self.cache.set(self.base_url, kind, key, response["data"], response["headers"].get("ETag"))
+        return response
+
+    # Function for fetching a list (the module list or the professor ratings) item by item
+    # Returns a response like make_request's, with "items" to iterate over when it
+    # succeeded. The server is asked for NDJSON, one item per line. A server without it
+    # answers 406, then the JSON response is parsed as it arrives instead. Only one item
+    # at a time is held unless the list is short enough to cache.
+    def stream(self, kind):
+        path, key = STREAMS[kind]
+        url = f"{self.base_url}{path}"
+
+        cached = self.cache.get(self.base_url, kind, "") if self.cache else None
+        if cached is not None and cached[2] < CACHE_TTLS[kind]:
+            return {"status_code": 200, "headers": {}, "items": iter_list(cached[0].get(key, [])), "cached": True}
+
+        headers = {"Accept": "application/x-ndjson"}
+        if cached is not None and cached[1]:
+            headers["If-None-Match"] = cached[1]
+        response = self.make_request("get", url, headers=headers, stream=True)
+        if response.get("status_code") == 406:
+            headers["Accept"] = "application/json"
+            response = self.make_request("get", url, headers=headers, stream=True)
+
+        if response.get("status_code") == 304 and cached is not None:
+            self.cache.touch(self.base_url, kind, "")
+            return {"status_code": 200, "headers": response["headers"], "items": iter_list(cached[0].get(key, [])),
+                    "cached": True}
+        if response.get("status_code") == 200:
+            response["items"] = self.stream_items(kind, key, response.pop("raw"))
+        return response
+
+    # Function for a whole streamed list, as a response with the usual "data"
+    def read_stream(self, kind):
+        response = self.stream(kind)
+        if response.get("status_code") != 200:
+            return response
+        try:
+            response["data"] = {STREAMS[kind][1]: list(response.pop("items"))}
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return {"error": f"Response was cut off: {e}", "status_code": None}
         return response
 
+    # Function for the items of a streamed response, cached once they have all arrived
+    def stream_items(self, kind, key, raw):
+        kept = [] if self.cache else None
+        try:
+            if raw.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+                items = (json.loads(line) for line in raw.iter_lines(chunk_size=65536) if line)
+            else:
+                items = iter_json_array(raw.iter_content(chunk_size=65536), key)
+            for item in items:
+                if kept is not None:
+                    kept.append(item)
+                    if len(kept) > CACHE_MAX_ITEMS:
+                        kept = None
+                yield item
+        finally:
+            raw.close()
+
+        # Only reached when the whole list was read
+        if kept is not None:
+            self.cache.set(self.base_url, kind, "", {key: kept}, raw.headers.get("ETag"))
+
     # Function that builds and sends requests and receives responses
-    def make_request(self, method, url, **kwargs):
-        
+    # With stream=True a successful response isn't read, it is returned under "raw".
+    # Failed attempts are retried with exponential backoff and jitter, see retry_delay().
+    # idempotent says whether the request may be repeated after it reached the server,
+    # by default only for GET, HEAD, OPTIONS, PUT and DELETE.
+    def make_request(self, method, url, idempotent=None, **kwargs):
+        if idempotent is None:
+            idempotent = method.lower() in IDEMPOTENT_METHODS
+        kwargs.setdefault("timeout", self.timeout)
+        self.count("requests")
+
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.count("fast_failures")
+                return {
+                    "error": f"Circuit open: {self.base_url} keeps failing, "
+                             f"not trying again for {self.breaker.remaining():.0f} s",
+                    "status_code": None,
+                    "connection_error": True,
+                    # Nothing was sent
+                    "connect_failed": True,
+                    "circuit_open": True
+                }
+
+            start = time.perf_counter()
+            result = self.send(method, url, **kwargs)
+            elapsed = time.perf_counter() - start
+
+            failed = result.get("status_code") is None or result["status_code"] >= 500
+            opened = self.breaker.record(not failed)
+            with self.stats_lock:
+                self.stats["attempts"] += 1
+                self.stats["failures"] += failed
+                self.stats["timeouts"] += bool(result.get("timeout"))
+                self.stats["circuit_opened"] += opened
+                self.latency.record(elapsed * 1_000_000)
+
+            delay = None if opened else self.retry_delay(result, attempt, idempotent)
+            if delay is None:
+                return result
+            if "raw" in result:
+                result["raw"].close()
+            attempt += 1
+            self.count("retries")
+            time.sleep(delay)
+
+    # Function for the seconds to wait before retrying a failed attempt, None to not retry
+    # A request that never reached the server (connection refused or connect timeout) or was
+    # turned away with 429 or 503 can always be retried. Other failures only when the
+    # request is idempotent. A Retry-After from the server is waited for, unless it is
+    # longer than max_retry_after.
+    def retry_delay(self, result, attempt, idempotent):
+        if attempt >= self.retries:
+            return None
+
+        status_code = result.get("status_code")
+        network_error = status_code is None and (result.get("connection_error") or result.get("timeout"))
+        if result.get("connect_failed") or status_code in [429, 503]:
+            retryable = True
+        else:
+            retryable = idempotent and (network_error or status_code in [502, 504])
+        if not retryable:
+            return None
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+        retry_after = parse_retry_after(header(result.get("headers"), "Retry-After"))
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+            delay += retry_after
+        return delay
+
+    # Function that sends one attempt of a request
+    def send(self, method, url, **kwargs):
         try:
             # If we have a token but it's not in headers yet, add it
             if self.token and "Authorization" not in self.session.headers:
@@ -115,6 +650,10 @@ class APIClient:
                 "headers": dict(response.headers),
             }
 
+            if kwargs.get("stream") and response.status_code == 200:
+                result["raw"] = response
+                return result
+
             try:
                 result["data"] = response.json()
             except ValueError:
@@ -122,10 +661,20 @@ class APIClient:
 
             return result
 
-        except requests.exceptions.ConnectionError:
+        except requests.exceptions.ConnectionError as e:
             return {
                 "error": f"Connection error: Could not connect to {url}",
-                "status_code": None
+                "status_code": None,
+                "connection_error": True,
+                # Nothing was sent, so any request can be retried
+                "connect_failed": connect_failed(e),
+                "timeout": isinstance(e, requests.exceptions.ConnectTimeout)
+            }
+        except requests.exceptions.Timeout:
+            return {
+                "error": f"Timed out waiting for a response from {url}",
+                "status_code": None,
+                "timeout": True
             }
         except Exception as e:
             return {
@@ -133,6 +682,113 @@ class APIClient:
                 "status_code": None
             }
 
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    # Function for the transport statistics: requests made, attempts sent (retries
+    # included), failures, timeouts, circuit breaker activity and attempt latency in ms
+    def transport_stats(self):
+        with self.stats_lock:
+            return {**self.stats, "circuit_open": self.breaker.remaining() > 0,
+                    "latency_ms": self.latency.summary()}
+
+# Function for whether a connection error happened before the request was sent
+def connect_failed(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+# Function for iterating over a list that is already in memory, closable like a streamed one
+def iter_list(items):
+    yield from items
+
+# Function for the items of the list under <key> in a JSON object, parsed as the chunks arrive
+# Used for servers without NDJSON, only the item being parsed is held in memory
+def iter_json_array(chunks, key):
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+
+    # Function for appending the next chunk, dropping what has been parsed already
+    def more():
+        nonlocal buffer, position
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer = buffer[position:] + text.decode(chunk)
+        position = 0
+        return True
+
+    start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    while True:
+        found = start.search(buffer)
+        if found:
+            position = found.end()
+            break
+        if not more():
+            raise ValueError(f"Response has no {key} list")
+
+    while True:
+        # Skip to the next item, or the end of the list
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            if not more():
+                raise ValueError("Response ended in the middle of the list")
+            continue
+        if buffer[position] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item isn't complete yet
+            if not more():
+                raise ValueError("Response ended in the middle of the list")
+            continue
+        position = end
+        yield item
+
+# Function for the error message of a failed batch request
+def batch_error(response):
+    if isinstance(response.get("data"), dict) and "error" in response["data"]:
+        return response["data"]["error"]
+    return f"Batch request failed with status {response.get('status_code')}"
+
+# Function for the error the server would give a rating, judged from the module list
+# Returns None when the catalog doesn't rule the rating out
+def rating_error(catalog, professor_id, module_code, year, semester, stars):
+    def error(message, status_code):
+        return {"status_code": status_code, "headers": {}, "data": {"error": message}, "local": True}
+
+    try:
+        year = int(year)
+    except (TypeError, ValueError):
+        return error("Year must be a valid number", 400)
+    if semester not in [1, 2, "1", "2"]:
+        return error("Semester must be either 1 or 2", 400)
+    try:
+        if int(stars) != float(stars) or not 1 <= int(stars) <= 5:
+            raise ValueError
+    except (TypeError, ValueError):
+        return error("Rating must be an integer between 1 and 5", 400)
+
+    modules = [module for module in catalog.get("modules", []) if module["code"] == module_code]
+    if not modules:
+        return error(f"Module with code {module_code} not found", 404)
+    instance = next((module for module in modules
+                     if module["year"] == year and module["semester"] == int(semester)), None)
+    if instance is None:
+        return error(f"Module instance for {module_code} in year {year}, semester {semester} not found", 404)
+    if professor_id not in [professor["id"] for professor in instance["professors"]]:
+        return error(f"Professor {professor_id} does not teach module {module_code} in year {year}, "
+                     f"semester {semester}", 400)
+    return None
+
 # Gets user input for registration and invokes APIClient registration function
 def register(api_client, verbose=False): 
     # Get user input
@@ -180,6 +836,7 @@ def login(url, api_client):
 
     if response.get("status_code") == 200:
         print(f"{response.get('data', {}).get('message', 'Login successful')}")
+        print_sync_outcomes(response.get("synced"))
         return True
     elif response.get("status_code") == 404:
         print("URL not found, please check for any spellig mistakes")
@@ -198,86 +855,112 @@ def login(url, api_client):
 
     return False
 
-#  Invokes APIClient list function
-def list_modules(api_client):
-    response = api_client.list_modules()
-    
-    # Handle all responses and errors
-    if response.get("status_code") == 200:
-        modules = response.get("data", {}).get("modules", [])
-        if not modules:
-            print("No modules found")
+# Context manager for command output, through a pager when asked for and the output is a terminal
+# Yields a function that writes one line. Quitting the pager early just ends the output.
+@contextmanager
+def paged_output(pager=False):
+    process = None
+    if pager and sys.stdout.isatty():
+        try:
+            process = subprocess.Popen(os.environ.get("PAGER") or "less -FRX", shell=True,
+                                       stdin=subprocess.PIPE, text=True, encoding="utf-8")
+        except OSError:
+            process = None
+
+    def write(line):
+        if process is None:
+            print(line)
         else:
-            # Format the module data for user to see
-            formatted_output = ["Modules List:\n"]
-            
-            # Add header
-            header = "│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format(
-                "Code", "Name", "Year", "Semester", "Taught by")
-            formatted_output.append(header)
-            
-            for module in modules:
-                code = module["code"]
-                desc = module["description"][:30]  # Truncate long descriptions
-                year = module["year"]
-                sem = module["semester"]
-                professors = module["professors"]
-                
-                # Add separator line
-                formatted_output.append("-" * 105)
-                
-                if not professors:
-                    # No professors for this module
-                    row = "│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format(
-                        code, desc, year, sem, "No Professors")
-                    formatted_output.append(row)
-                else:
-                    # Process first professor
-                    first_prof = professors[0]
-                    first_prof_name = first_prof["name"]
-                    first_prof_name_list = first_prof_name.split()
-                    formatted_name = ""
-                    
-                    # Format professor name (initials + last name)
-                    for name in first_prof_name_list[:-1]:
-                        formatted_name += name[0] + ". "
-                    formatted_name += first_prof_name_list[-1]
-                    
-                    prof_str = f"{first_prof['id']}, Professor {formatted_name}"
-                    
-                    # First row with module details and first professor
-                    row = "│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format(
-                        code, desc, year, sem, prof_str[:35])
-                    formatted_output.append(row)
-                    
-                    # Add additional professors on separate rows
-                    for prof in professors[1:]:
-                        prof_name = prof["name"]
-                        prof_name_list = prof_name.split()
-                        formatted_name = ""
-                        
-                        for name in prof_name_list[:-1]:
-                            formatted_name += name[0] + ". "
-                        formatted_name += prof_name_list[-1]
-                        
-                        prof_str = f"{prof['id']}, Professor {formatted_name}"
-                        row = "│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format(
-                            "", "", "", "", prof_str[:35])
-                        formatted_output.append(row)
-            
-            print("\n".join(formatted_output))
-    else:
-        if "error" in response.get('data', {}):
-            error_message = response.get('data', {}).get('error')
-            print(f"ERROR: {error_message}")
-        elif "error" in response:
-            error_message = response.get('error')
-            print(f"ERROR: {error_message}")
+            # Flushed line by line so the pager shows the first rows straight away
+            process.stdin.write(line + "\n")
+            process.stdin.flush()
+
+    try:
+        yield write
+    except BrokenPipeError:
+        pass
+    finally:
+        if process is not None:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+
+# Function for formatting a professor name as initials and last name
+def short_name(name):
+    name_parts = name.split()
+    formatted_name = ""
+    for part in name_parts[:-1]:
+        formatted_name += part[0] + ". "
+    formatted_name += name_parts[-1] if name_parts else ""
+    return formatted_name
+
+# Function for the table rows of one module instance
+def module_rows(module):
+    code = module["code"]
+    desc = module["description"][:30]  # Truncate long descriptions
+    year = module["year"]
+    sem = module["semester"]
+    professors = module["professors"]
+
+    # Add separator line
+    yield "-" * 105
+
+    if not professors:
+        # No professors for this module
+        yield "│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format(code, desc, year, sem, "No Professors")
+        return
+
+    # First row with module details and first professor, additional professors on separate rows
+    for index, prof in enumerate(professors):
+        prof_str = f"{prof['id']}, Professor {short_name(prof['name'])}"
+        if index == 0:
+            yield "│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format(code, desc, year, sem, prof_str[:35])
         else:
-            print("ERROR: Failed to retrieve modules")
+            yield "│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format("", "", "", "", prof_str[:35])
+
+# Function for printing the error of a failed list response
+def print_response_error(response, default):
+    if isinstance(response.get("data"), dict) and "error" in response["data"]:
+        print(f"ERROR: {response['data']['error']}")
+    elif response.get("error"):
+        print(f"ERROR: {response['error']}")
+    else:
+        print(f"ERROR: {default}")
+
+#  Invokes APIClient list function
+# Rows are printed as the modules arrive, so long lists start showing straight away
+def list_modules(api_client, pager=False):
+    response = api_client.stream("list")
+
+    # Handle all responses and errors
+    if response.get("status_code") != 200:
+        print_response_error(response, "Failed to retrieve modules")
+        return
+
+    items = response["items"]
+    count = 0
+    try:
+        with paged_output(pager) as write:
+            for module in items:
+                if count == 0:
+                    # Format the module data for user to see
+                    write("Modules List:\n")
+                    write("│ {:<8} │ {:<30} │ {:<4} │ {:<8} │ {:<40} │".format(
+                        "Code", "Name", "Year", "Semester", "Taught by"))
+                for row in module_rows(module):
+                    write(row)
+                count += 1
+            if count == 0:
+                write("No modules found")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"ERROR: The module list was cut off after {count} modules: {e}")
+    finally:
+        items.close()
 
 # Invokes APIClient rate_professor function using data from arguments
-def rate_professor(professor_id, module_code, year, semester, stars, api_client):
+def rate_professor(professor_id, module_code, year, semester, stars, api_client, defer=False):
     
     # Convert inputs to proper types
     try:
@@ -294,11 +977,17 @@ def rate_professor(professor_id, module_code, year, semester, stars, api_client)
         module_code=module_code,
         year=year,
         semester=semester,
-        stars=stars
+        stars=stars,
+        defer=defer
     )
     
     # Handle resoponse messages and errors
-    if response.get("status_code") == 201:
+    if response.get("queued"):
+        if response.get("error"):
+            print(f"WARNING: {response.get('error')}")
+        print(f"Rating saved offline ({response['data']['queued']} waiting). "
+              "It will be sent on the next successful connection, or type 'sync' to send it now")
+    elif response.get("status_code") == 201:
         # Format the response for client to see 
         data = response.get("data", {})
         professor = data.get("professor", {})
@@ -336,54 +1025,82 @@ def rate_professor(professor_id, module_code, year, semester, stars, api_client)
                 
             print(f"ERROR: {error_message}")
 
+    print_sync_outcomes(response.get("synced"))
+
+# Sends the ratings saved offline and prints what happened to each one
+def sync(api_client):
+    if api_client.outbox is None:
+        print("ERROR: There is no offline rating queue")
+        return
+    waiting = api_client.outbox.count(api_client.base_url, api_client.username)
+    if not waiting:
+        print("No ratings waiting to be sent")
+        return
+
+    outcomes = api_client.sync()
+    if outcomes is None:
+        print("A sync is already running")
+        return
+    print_sync_outcomes(outcomes)
+
+# Prints the outcome of every rating sent from the offline queue
+def print_sync_outcomes(outcomes):
+    if not outcomes:
+        return
+    sent = 0
+    for outcome in outcomes:
+        item = outcome.get("input")
+        if item is None:
+            # The batch itself failed, the ratings are still queued
+            print(f"ERROR: Could not send queued ratings: {outcome.get('error')}")
+            continue
+        sent += 1
+        rating = f"{item['professor_id']} {item['module_code']} {item['year']} semester {item['semester']}: {item['stars']}"
+        if outcome["status_code"] < 300:
+            print(f"  SENT {rating}{' (already received)' if outcome.get('duplicate') else ''}")
+        else:
+            print(f"  FAILED {rating}: {outcome.get('error')}")
+    if sent:
+        print(f"Sent {sent} queued rating{'s' if sent != 1 else ''}")
+
 # Invokes APIClient view function
-def view(api_client):
+# Ratings are printed as they arrive, like the module list
+def view(api_client, pager=False):
     # Invike view request
-    response = api_client.view()
+    response = api_client.stream("view")
 
     # Handle all responses and error messages
-    if response.get("status_code") == 200:
-        professors = response.get("data", {}).get("professors", [])
-        
-        if not professors:
-            print("No professor ratings available")
-        else:
-            # Format the professor ratings for the user to see
-            formatted_output = ["Professor Ratings:\n"]
-            
-            for professor in professors:
-                # Format professor name (initials + last name)
-                name = professor.get("name", "")
-                name_parts = name.split()
-                formatted_name = ""
-                
-                for part in name_parts[:-1]:
-                    formatted_name += part[0] + ". "
-                formatted_name += name_parts[-1] if name_parts else ""
-                
-                avg_rating = professor.get("average_rating", 0)
+    if response.get("status_code") != 200:
+        print_response_error(response, "Failed to retrieve professor ratings")
+        return
+
+    items = response["items"]
+    count = 0
+    try:
+        with paged_output(pager) as write:
+            for professor in items:
+                if count == 0:
+                    # Format the professor ratings for the user to see
+                    write("Professor Ratings:\n")
+                count += 1
+
+                formatted_name = short_name(professor.get("name", ""))
                 rating_count = professor.get("rating_count", 0)
                 prof_id = professor.get("id", "")
-                
-                # Round to nearest integer for display
-                rounded_rating = round(avg_rating)
-                
+
                 if rating_count > 0:
-                    star_display = f"{'★' * rounded_rating + '☆' * (5 - rounded_rating):<53}" 
-                    formatted_output.append(f"The rating of Professor {formatted_name} ({prof_id}) is {star_display}")
+                    # Round to nearest integer for display
+                    rounded_rating = round(professor.get("average_rating") or 0)
+                    star_display = f"{'★' * rounded_rating + '☆' * (5 - rounded_rating):<53}"
+                    write(f"The rating of Professor {formatted_name} ({prof_id}) is {star_display}")
                 else:
-                    formatted_output.append(f"Professor {formatted_name} ({prof_id}) doesn't have a rating")
-            
-            print("\n".join(formatted_output))
-    else:
-        if "error" in response.get("data", {}):
-            err_msg = response.get("data", {}).get("error")
-            print(f"ERROR: {err_msg}")
-        elif "error" in response:
-            err_msg = response.get("error")
-            print(f"ERROR: {err_msg}")
-        else:
-            print("ERROR: Failed to retrieve professor ratings")
+                    write(f"Professor {formatted_name} ({prof_id}) doesn't have a rating")
+            if count == 0:
+                write("No professor ratings available")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"ERROR: The professor ratings were cut off after {count} professors: {e}")
+    finally:
+        items.close()
 
 # Invokes APIClient average function using arguments
 def average(professor_id, module_code, api_client):
@@ -431,9 +1148,554 @@ def average(professor_id, module_code, api_client):
         else:
             print("ERROR: Failed to retrieve professor average rating")
 
-def main():
+# Requests the load generator can send, the mix picks between them by weight
+OPERATIONS = ["register", "login", "list", "view", "average", "rate"]
+DEFAULT_MIX = "list=3,view=3,average=2,rate=1"
+PERCENTILES = [50, 90, 95, 99, 99.9]
+
+# Latency histogram in the style of HdrHistogram
+# Buckets get wider as values grow, so each recorded value is kept to within
+# 1 part in 2 ** SUB_BUCKET_BITS and memory stays small however many are recorded
+class LatencyHistogram:
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    # Function for recording a latency in microseconds
+    def record(self, value):
+        value = max(0, int(value))
+        shift = max(0, value.bit_length() - self.SUB_BUCKET_BITS)
+        key = (shift, value >> shift)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    # Function for the value at a percentile, the top of the bucket it falls in
+    def percentile(self, percent):
+        if not self.total:
+            return 0
+        rank = max(1, math.ceil(self.total * percent / 100))
+        seen = 0
+        # (shift, sub-bucket) keys sort in value order
+        for shift, sub_bucket in sorted(self.counts):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= rank:
+                return min(((sub_bucket + 1) << shift) - 1, self.max)
+        return self.max
+
+    # Function for the latency summary in milliseconds
+    def summary(self):
+        result = {
+            "min": (self.min or 0) / 1000,
+            "mean": self.sum / self.total / 1000 if self.total else 0,
+        }
+        for percent in PERCENTILES:
+            result[f"p{percent:g}"] = self.percentile(percent) / 1000
+        result["max"] = self.max / 1000
+        return result
+
+
+# Results of one kind of request, shared by all virtual users
+class EndpointStats:
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.requests = 0
+        self.errors = 0
+        self.statuses = {}
+
+    def record(self, elapsed, response):
+        status = response.get("status_code")
+        self.requests += 1
+        self.histogram.record(elapsed * 1_000_000)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        if status is None or status >= 400:
+            self.errors += 1
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        self.requests += other.requests
+        self.errors += other.errors
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+
+    def summary(self, seconds):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.errors / self.requests if self.requests else 0,
+            "throughput": self.requests / seconds if seconds else 0,
+            "statuses": self.statuses,
+            "latency_ms": self.histogram.summary()
+        }
+
+
+# Function for turning a mix such as "list=3,rate=1" into operation weights
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown request '{name}' in mix, use {', '.join(OPERATIONS)}")
+        try:
+            weights[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f"Weight for '{name}' must be a number")
+        if weights[name] < 0:
+            raise ValueError(f"Weight for '{name}' must not be negative")
+    if not any(weights.values()):
+        raise ValueError("The mix must give at least one request a weight")
+    return weights
+
+
+# Function for the professor and module instance pairs average and rate can use
+def load_targets(api_client):
+    response = api_client.list_modules()
+    if response.get("status_code") != 200:
+        return None
+    targets = []
+    for module in response.get("data", {}).get("modules", []):
+        for professor in module["professors"]:
+            targets.append((professor["id"], module["code"], module["year"], module["semester"]))
+    return targets
+
+
+# Simulated user of the load test
+# Registers and logs in its own account, then sends requests picked from the
+# mix with a random think time in between until the test ends
+class VirtualUser:
+
+    def __init__(self, number, run, args, weights, targets, stats, lock):
+        # Uncached and without retries, every request in the mix has to reach the server once
+        self.api_client = APIClient(args.url, cache=False, outbox=False, timeout=(args.connect_timeout, args.read_timeout),
+                                    retries=0, breaker_threshold=0)
+        self.username = f"lt{run}u{number}"
+        self.password = f"Load{run}x1"
+        self.args = args
+        self.weights = weights
+        self.targets = targets
+        self.stats = stats
+        self.lock = lock
+        self.registered = 0
+
+    # Function for timing one request and adding it to the results
+    def timed(self, operation, function, *args, **kwargs):
+        start = time.perf_counter()
+        response = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.stats.setdefault(operation, EndpointStats()).record(elapsed, response)
+        return response
+
+    def register(self, username):
+        return self.timed("register", self.api_client.register, username, f"{username}@loadtest.invalid",
+                          self.password)
+
+    def login(self):
+        return self.timed("login", self.api_client.login, f"{self.api_client.base_url}/login/",
+                          self.username, self.password)
+
+    def step(self, operation):
+        if operation == "register":
+            # Extra registrations use throwaway accounts, this user stays logged in as itself
+            self.registered += 1
+            self.register(f"{self.username}r{self.registered}")
+        elif operation == "login":
+            self.login()
+        elif operation == "list":
+            self.timed("list", self.api_client.list_modules)
+        elif operation == "view":
+            self.timed("view", self.api_client.view)
+        elif operation == "average":
+            professor_id, module_code, _, _ = random.choice(self.targets)
+            self.timed("average", self.api_client.average, professor_id, module_code)
+        elif operation == "rate":
+            professor_id, module_code, year, semester = random.choice(self.targets)
+            # Update mode, so rating the same pair twice isn't counted as an error
+            self.timed("rate", self.api_client.rate_professor, professor_id, module_code, year, semester,
+                       random.randint(1, 5), update=True)
+
+    def think(self, stop):
+        if self.args.think_time:
+            stop.wait(random.uniform(0.5, 1.5) * self.args.think_time)
+
+    def run(self, start_at, stop_at, stop):
+        if stop.wait(max(0, start_at - time.monotonic())):
+            return
+
+        self.register(self.username)
+        self.login()
+
+        operations = list(self.weights)
+        weights = [self.weights[operation] for operation in operations]
+        sent = 0
+        while not stop.is_set() and time.monotonic() < stop_at:
+            if self.args.iterations and sent >= self.args.iterations:
+                break
+            self.think(stop)
+            if stop.is_set() or time.monotonic() >= stop_at:
+                break
+            self.step(random.choices(operations, weights)[0])
+            sent += 1
+
+
+# Runs the load test described by the command line arguments
+def loadtest(args):
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return 1
+    if args.users < 1:
+        print("ERROR: --users must be at least 1")
+        return 1
+
+    # The users rate and average pairs from the module list, loaded once up front
+    targets = load_targets(APIClient(args.url, cache=False, outbox=False, **transport_options(args)))
+    if targets is None:
+        print(f"ERROR: Could not load the module list from {args.url}")
+        return 1
+    if not targets and (weights.get("average") or weights.get("rate")):
+        print("ERROR: The server has no module instances to rate or average")
+        return 1
+
+    # Unique per run, so usernames from earlier runs don't clash
+    run = format(int(time.time() * 1000) % 36 ** 6, "x")
+    stats = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+    started = time.monotonic()
+    stop_at = started + args.duration
+    users = [VirtualUser(number, run, args, weights, targets, stats, lock) for number in range(args.users)]
+
+    print(f"Load testing {args.url} with {args.users} users for {args.duration:g} s "
+          f"(ramp-up {args.ramp_up:g} s, think time {args.think_time:g} s, mix {args.mix})")
+
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        futures = [
+            pool.submit(user.run, started + args.ramp_up * number / args.users, stop_at, stop)
+            for number, user in enumerate(users)
+        ]
+        try:
+            while not all(future.done() for future in futures):
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            print("Stopping...")
+            stop.set()
+    for future in futures:
+        if future.exception():
+            print(f"ERROR: A virtual user failed: {future.exception()}")
+    elapsed = time.monotonic() - started
+
+    total = EndpointStats()
+    for endpoint in stats.values():
+        total.merge(endpoint)
+
+    results = {
+        "url": args.url,
+        "users": args.users,
+        "duration": args.duration,
+        "ramp_up": args.ramp_up,
+        "think_time": args.think_time,
+        "mix": weights,
+        "elapsed": elapsed,
+        "endpoints": {name: stats[name].summary(elapsed) for name in OPERATIONS if name in stats},
+        "total": total.summary(elapsed)
+    }
+
+    print_loadtest_results(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Results written to {args.output}")
+    return 1 if total.errors else 0
+
+
+# Prints the load test results as a table
+def print_loadtest_results(results):
+    columns = ["p50", "p90", "p99", "p99.9", "max"]
+    header = "{:<10} {:>8} {:>7} {:>7} {:>9}".format("Request", "Count", "Errors", "Err %", "Req/s")
+    header += "".join(f" {column + ' ms':>10}" for column in columns)
+    print(f"\nCompleted in {results['elapsed']:.1f} s\n")
+    print(header)
+    print("-" * len(header))
+
+    rows = list(results["endpoints"].items()) + [("total", results["total"])]
+    for name, summary in rows:
+        if name == "total":
+            print("-" * len(header))
+        row = "{:<10} {:>8} {:>7} {:>7.2f} {:>9.1f}".format(
+            name, summary["requests"], summary["errors"], summary["error_rate"] * 100, summary["throughput"])
+        row += "".join(f" {summary['latency_ms'][column]:>10.1f}" for column in columns)
+        print(row)
+
+    failures = {code: count for code, count in results["total"]["statuses"].items()
+                if code == "None" or int(code) >= 400}
+    if failures:
+        print("\nFailed responses: " + ", ".join(
+            f"{count} x {'connection error' if code == 'None' else code}" for code, count in failures.items()))
+
+
+# Columns of the batch input files, in order when a file has no header row
+RATING_COLUMNS = ["professor_id", "module_code", "year", "semester", "stars"]
+PAIR_COLUMNS = ["professor_id", "module_code"]
+
+# Function for reading the rows of a CSV file as dicts, "-" reads standard input
+# The first row is taken as a header when it names the first column
+def read_csv_rows(path, columns):
+    source = sys.stdin if path == "-" else open(path, newline="")
+    try:
+        reader = csv.reader(source)
+        header = None
+        for row in reader:
+            if not row or not "".join(row).strip() or row[0].startswith("#"):
+                continue
+            row = [value.strip() for value in row]
+            if header is None:
+                if row[0] == columns[0]:
+                    header = row
+                    continue
+                header = columns
+            yield dict(zip(header, row))
+    finally:
+        if source is not sys.stdin:
+            source.close()
+
+
+# Function for running a function over many items on a bounded thread pool
+# At most <workers> calls run at a time and only a few more items are read
+# ahead, so big input files aren't loaded at once. Results come out in input order.
+def run_batch(items, function, workers):
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for item in items:
+            pending.append((item, pool.submit(function, item)))
+            if len(pending) >= workers * 2:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+# Function for one NDJSON line describing the outcome of a request
+def batch_record(number, item, response):
+    status_code = response.get("status_code")
+    record = {"line": number, "input": item, "status": status_code,
+              "ok": status_code is not None and status_code < 400}
+    if response.get("synced"):
+        record["synced"] = response["synced"]
+    if response.get("queued"):
+        record["queued"] = True
+        record["data"] = response["data"]
+    elif "error" in response:
+        record["error"] = response["error"]
+    elif isinstance(response.get("data"), dict) and "error" in response["data"]:
+        record["error"] = response["data"]["error"]
+    else:
+        record["data"] = response.get("data")
+    return record
+
+
+# Function for running a batch and writing its outcomes to standard output as NDJSON
+# The summary goes to standard error so the output stays machine-readable
+def write_batch(items, function, workers):
+    start = time.perf_counter()
+    count = 0
+    queued = 0
+    failures = {}
+    for number, (item, response) in enumerate(run_batch(items, function, workers), 1):
+        record = batch_record(number, item, response)
+        print(json.dumps(record), flush=True)
+        count += 1
+        if record.get("queued"):
+            queued += 1
+        elif not record["ok"]:
+            key = "connection error" if record["status"] is None else str(record["status"])
+            failures[key] = failures.get(key, 0) + 1
+
+    elapsed = time.perf_counter() - start
+    failed = sum(failures.values())
+    summary = f"{count} requests in {elapsed:.2f} s ({count / elapsed if elapsed else 0:.1f}/s), {failed} failed"
+    if failures:
+        summary += " (" + ", ".join(f"{number} x {key}" for key, number in failures.items()) + ")"
+    if queued:
+        summary += f", {queued} saved offline"
+    print(summary, file=sys.stderr)
+    return 1 if failed else 0
+
+
+# Function for logging in for a batch command, returns the login response or None when it fails
+# When the server can't be reached and ratings can be queued, the user is only
+# set locally so the ratings go to the outbox
+def batch_login(api_client, args, offline=False):
+    username = args.username or input("Enter username: ")
+    if offline:
+        api_client.username = username
+        return {}
+
+    password = os.environ.get("RATING_PASSWORD") or getpass.getpass("Enter password: ")
+    response = api_client.login(f"{api_client.base_url}/login/", username, password)
+    if response.get("connection_error") and api_client.outbox is not None and args.command == "rate":
+        print(f"WARNING: {response['error']}, ratings will be saved offline", file=sys.stderr)
+        api_client.username = username
+        return response
+    if response.get("status_code") != 200:
+        error = response.get("error") or (response.get("data") or {}).get("error", "Login failed")
+        print(f"ERROR: {error}", file=sys.stderr)
+        return None
+    return response
+
+
+# Function for printing the outcomes of sending queued ratings as NDJSON
+# Returns how many of them failed
+def write_sync_outcomes(outcomes):
+    failed = 0
+    for outcome in outcomes or []:
+        status_code = outcome.get("status_code")
+        record = {"synced": True, "id": outcome.get("id"), "input": outcome.get("input"), "status": status_code,
+                  "ok": status_code is not None and status_code < 300}
+        if outcome.get("duplicate"):
+            record["duplicate"] = True
+        if outcome.get("error"):
+            record["error"] = outcome["error"]
+        else:
+            record["data"] = {key: value for key, value in outcome.items()
+                              if key not in ["id", "input", "status_code", "duplicate", "error"]}
+        print(json.dumps(record), flush=True)
+        if not record["ok"]:
+            failed += 1
+    return failed
+
+
+# Sends every rating in a CSV file, concurrently
+def batch_rate(args):
+    api_client = client_for_args(args, args.workers)
+    if args.defer and api_client.outbox is None:
+        print("ERROR: There is no offline rating queue", file=sys.stderr)
+        return 1
+    login_response = batch_login(api_client, args, offline=args.defer)
+    if login_response is None:
+        return 1
+    failed = write_sync_outcomes(login_response.get("synced"))
+
+    def send(item):
+        return api_client.rate_professor(item.get("professor_id"), item.get("module_code"),
+                                         to_int(item.get("year")), to_int(item.get("semester")),
+                                         to_int(item.get("stars")), update=args.update, defer=args.defer)
+
+    return write_batch(read_csv_rows(args.source, RATING_COLUMNS), send, args.workers) or (1 if failed else 0)
+
+
+# Sends the ratings saved offline, in batches
+def batch_sync(args):
+    api_client = client_for_args(args)
+    if api_client.outbox is None:
+        print("ERROR: There is no offline rating queue", file=sys.stderr)
+        return 1
+    start = time.perf_counter()
+    # Logging in sends the queue already
+    login_response = batch_login(api_client, args)
+    if login_response is None:
+        return 1
+    outcomes = (login_response.get("synced") or []) + (api_client.sync(args.batch_size) or [])
+    failed = write_sync_outcomes(outcomes)
+
+    left = api_client.outbox.count(api_client.base_url, api_client.username)
+    sent = sum(1 for outcome in outcomes if outcome.get("input") is not None)
+    print(f"{sent} ratings sent in {time.perf_counter() - start:.2f} s, {failed} failed, {left} still queued",
+          file=sys.stderr)
+    return 1 if failed or left else 0
+
+
+# Looks up the average rating of every professor and module pair in a CSV file, concurrently
+def batch_average(args):
+    api_client = client_for_args(args, args.workers)
+
+    def send(item):
+        return api_client.average(item.get("professor_id"), item.get("module_code"))
+
+    return write_batch(read_csv_rows(args.pairs, PAIR_COLUMNS), send, args.workers)
+
+
+# Prints the module list as it arrives, as NDJSON with one module instance per line for --json
+def batch_list(args):
+    api_client = client_for_args(args)
+    if not args.json:
+        list_modules(api_client, args.pager)
+        return 0
+
+    response = api_client.stream("list")
+    if response.get("status_code") != 200:
+        error = response.get("error") or (response.get("data") or {}).get("error", "Failed to retrieve modules")
+        print(f"ERROR: {error}", file=sys.stderr)
+        return 1
+    items = response["items"]
+    try:
+        for module in items:
+            print(json.dumps(module))
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"ERROR: The module list was cut off: {e}", file=sys.stderr)
+        return 1
+    finally:
+        items.close()
+    return 0
+
+
+# Function for the APIClient options set on the command line
+def transport_options(args):
+    return {"timeout": (args.connect_timeout, args.read_timeout), "retries": args.retries}
+
+
+# Function for creating the client of a command from its arguments
+# The clients are remembered on args so main() can print their statistics
+def client_for_args(args, pool_size=None):
+    api_client = APIClient(getattr(args, "url", URL), pool_size=args.pool_size or pool_size or 10,
+                           cache=not args.no_cache, **transport_options(args))
+    args.clients.append(api_client)
+    return api_client
+
+
+# Prints the transport statistics of a client to standard error
+def print_transport_stats(api_client):
+    stats = api_client.transport_stats()
+    latency = stats["latency_ms"]
+    print(f"{stats['requests']} requests, {stats['attempts']} attempts, {stats['retries']} retries, "
+          f"{stats['failures']} failed attempts ({stats['timeouts']} timeouts), "
+          f"circuit opened {stats['circuit_opened']} times, {stats['fast_failures']} failed fast", file=sys.stderr)
+    if api_client.latency.total:
+        print(f"Attempt latency: p50 {latency['p50']:.1f} ms, p90 {latency['p90']:.1f} ms, "
+              f"p99 {latency['p99']:.1f} ms, max {latency['max']:.1f} ms", file=sys.stderr)
+
+
+# Function for converting a CSV value to an int, leaving bad values for the server to reject
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+# Runs the interactive command loop
+def interactive(args):
     # Initialize API client object
-    api_client = APIClient(URL)
+    api_client = client_for_args(args)
 
     print("Welcome to the professor rating client!\n")
     print("To exit the client type 'q' or 'quit'")
@@ -457,10 +1719,10 @@ def main():
 
         # List, view and average commands work whether logged in or out
         elif command[0] == "list":
-            list_modules(api_client)
+            list_modules(api_client, "--pager" in command[1:])
 
         elif command[0] == "view":
-            view(api_client)
+            view(api_client, "--pager" in command[1:])
 
         elif command[0] == "average":
             if len(command) < 3:
@@ -475,8 +1737,8 @@ def main():
                 print("Available commands:")
                 print("1) register: Register a new user")
                 print("2) login <api_url>: Login to provided api using existing account")
-                print("3) list: List all modules and professors")
-                print("4) view: List ratings of all professors")
+                print("3) list [--pager]: List all modules and professors")
+                print("4) view [--pager]: List ratings of all professors")
                 print("5) average <professor_id> <module_code>: Display average rating for a professor in a module")
                 print("6) q/quit/exit: Exit the application")
 
@@ -490,7 +1752,7 @@ def main():
                 if len(command) < 2:
                     print("Please use the command as following: 'login <URL>'")
                 else:
-                    if command[2][-1] != "/"
+                    if command[1][-1] != "/":
                         print("URL must end with a front slash '/'")
                     else:
                         success = login(command[1],api_client)
@@ -504,12 +1766,13 @@ def main():
             # Print help information
             if command[0] in ["h", "help"]:
                 print("Available commands:")
-                print("1) list: List all modules and professors")
+                print("1) list [--pager]: List all modules and professors")
                 print("2) average <professor_id> <module_code>: Display average rating for a professor in a module")
-                print("3) view: List ratings of all professors")
-                print("4) rate <professor_id> <module_code> <year> <semester> <rating>: Rate a professor for a specific module")
-                print("5) logout: Log out of your account")
-                print("6) q/quit/exit: Exit the application")
+                print("3) view [--pager]: List ratings of all professors")
+                print("4) rate <professor_id> <module_code> <year> <semester> <rating> [--defer]: Rate a professor for a specific module, --defer saves it to send later")
+                print("5) sync: Send the ratings saved offline")
+                print("6) logout: Log out of your account")
+                print("7) q/quit/exit: Exit the application")
 
             
             elif command[0] == "logout":
@@ -535,11 +1798,106 @@ def main():
                     print("Please use the command as following: 'rate <professor_id> <module_code> <year> <semester> <rating>'")
                 
                 else:
-                    rate_professor(command[1], command[2], command[3], command[4], command[5], api_client)
+                    defer = "--defer" in command[6:]
+                    rate_professor(command[1], command[2], command[3], command[4], command[5], api_client, defer)
+
+            elif command[0] == "sync":
+                sync(api_client)
 
             else:
                 print("Invalid command: type 'h' or 'help' for a list of logged-in commands.")
 
 
+# Entry point: the interactive client by default, or a subcommand
+def main():
+    parser = argparse.ArgumentParser(description="Client for the professor rating service")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always ask the server, instead of using cached lists and ratings")
+    parser.add_argument("--connect-timeout", type=float, default=3.05,
+                        help="Seconds to wait for a connection to the server (default 3.05)")
+    parser.add_argument("--read-timeout", type=float, default=30,
+                        help="Seconds to wait for the server to respond (default 30)")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="Times a failed request is retried, with backoff (default 3)")
+    parser.add_argument("--pool-size", type=int,
+                        help="Keep-alive connections to the server (default 10, or --workers)")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print retry and latency statistics to standard error at the end")
+    subparsers = parser.add_subparsers(dest="command")
+
+    loadtest_parser = subparsers.add_parser("loadtest", help="Simulate concurrent users against a server")
+    loadtest_parser.add_argument("--url", default=URL, help=f"API URL (default {URL})")
+    loadtest_parser.add_argument("--users", type=int, default=10, help="Concurrent virtual users (default 10)")
+    loadtest_parser.add_argument("--duration", type=float, default=60,
+                                 help="Seconds to run for, ramp-up included (default 60)")
+    loadtest_parser.add_argument("--iterations", type=int, default=0,
+                                 help="Requests per user after login, 0 to run for the whole duration")
+    loadtest_parser.add_argument("--ramp-up", type=float, default=0,
+                                 help="Seconds over which the users are started (default 0)")
+    loadtest_parser.add_argument("--think-time", type=float, default=1.0,
+                                 help="Average seconds a user waits between requests (default 1)")
+    loadtest_parser.add_argument("--mix", default=DEFAULT_MIX,
+                                 help=f"Weighted request mix (default {DEFAULT_MIX})")
+    loadtest_parser.add_argument("--output", help="File to write the results to as JSON")
+
+    rate_parser = subparsers.add_parser("rate", help="Submit the ratings in a CSV file")
+    rate_parser.add_argument("--from", dest="source", required=True,
+                             help="CSV file of professor_id,module_code,year,semester,stars, - for standard input")
+    rate_parser.add_argument("--username", help="Account to rate as, the password is read from "
+                                                "RATING_PASSWORD or prompted for")
+    rate_parser.add_argument("--update", action="store_true", help="Replace earlier ratings instead of failing")
+    rate_parser.add_argument("--defer", action="store_true",
+                             help="Save the ratings offline without contacting the server, send them with sync")
+
+    sync_parser = subparsers.add_parser("sync", help="Send the ratings saved offline")
+    sync_parser.add_argument("--username", help="Account the ratings were saved for, the password is read from "
+                                                "RATING_PASSWORD or prompted for")
+    sync_parser.add_argument("--batch-size", type=int, default=50, help="Ratings sent per request (default 50)")
+
+    average_parser = subparsers.add_parser("average", help="Look up the average ratings for a CSV file of pairs")
+    average_parser.add_argument("--pairs", required=True,
+                                help="CSV file of professor_id,module_code, - for standard input")
+
+    list_parser = subparsers.add_parser("list", help="Print the module list")
+    list_parser.add_argument("--json", action="store_true", help="Print NDJSON, one module per line")
+    list_parser.add_argument("--pager", action="store_true", help="Show the table in a pager ($PAGER or less)")
+
+    for batch_parser in [rate_parser, average_parser, list_parser, sync_parser]:
+        batch_parser.add_argument("--url", default=URL, help=f"API URL (default {URL})")
+    for batch_parser in [rate_parser, average_parser]:
+        batch_parser.add_argument("--workers", type=int, default=8,
+                                  help="Requests sent at a time, over as many connections (default 8)")
+
+    args = parser.parse_args()
+    args.clients = []
+    if args.retries < 0 or (args.pool_size is not None and args.pool_size < 1):
+        parser.error("--retries must be 0 or more and --pool-size at least 1")
+    try:
+        return run_command(parser, args)
+    finally:
+        if args.stats:
+            for api_client in args.clients:
+                print_transport_stats(api_client)
+
+
+# Function for running the command chosen on the command line
+def run_command(parser, args):
+    if args.command == "loadtest":
+        return loadtest(args)
+    if args.command in ["rate", "average"] and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.command == "sync" and not 1 <= args.batch_size <= 100:
+        parser.error("--batch-size must be between 1 and 100")
+    batch_commands = {"rate": batch_rate, "average": batch_average, "list": batch_list, "sync": batch_sync}
+    if args.command in batch_commands:
+        try:
+            return batch_commands[args.command](args)
+        except BrokenPipeError:
+            # Output piped into a command that stopped reading early, such as head
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+    interactive(args)
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,259 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from email.utils import formatdate
+from unittest import mock
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from client import APIClient, CircuitBreaker, ResponseCache, RatingOutbox, iter_json_array
+
+# Run from this directory with: python -m unittest tests
+
+BASE_URL = "http://rating.test/api"
+
+
+# Function for a response as the mocked session returns it
+def response(status_code, data=None, headers=None):
+    result = requests.Response()
+    result.status_code = status_code
+    result._content = json.dumps(data).encode() if data is not None else b""
+    result.headers.update(headers or {})
+    return result
+
+
+# Function for the error of a request that never reached the server
+def refused():
+    return requests.exceptions.ConnectionError(
+        MaxRetryError(None, "/api/rate/", NewConnectionError(None, "Connection refused")))
+
+
+# Function for the error of a request that was sent, but got no response
+def dropped():
+    return requests.exceptions.ConnectionError("Connection aborted, remote end closed connection")
+
+
+# Tests for which failed attempts are retried and how long the client waits
+class RetryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.api = APIClient(BASE_URL, cache=False, outbox=False, retries=3, backoff=0.5, backoff_max=10,
+                             max_retry_after=30)
+        # Always the longest delay the backoff allows
+        patcher = mock.patch("client.random.uniform", side_effect=lambda low, high: high)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_what_is_retried(self):
+        cases = [
+            # (result, idempotent, retried)
+            ({"status_code": None, "connection_error": True, "connect_failed": True}, False, True),
+            ({"status_code": None, "connection_error": True, "connect_failed": False}, False, False),
+            ({"status_code": None, "connection_error": True, "connect_failed": False}, True, True),
+            ({"status_code": None, "timeout": True}, False, False),
+            ({"status_code": None, "timeout": True}, True, True),
+            ({"status_code": 429}, False, True),
+            ({"status_code": 503}, False, True),
+            ({"status_code": 502}, False, False),
+            ({"status_code": 504}, True, True),
+            ({"status_code": 500}, True, False),
+            ({"status_code": 400}, True, False),
+        ]
+        for result, idempotent, retried in cases:
+            with self.subTest(result=result, idempotent=idempotent):
+                self.assertEqual(self.api.retry_delay(result, 0, idempotent) is not None, retried)
+
+    def test_backoff_doubles_up_to_the_cap_and_attempts_run_out(self):
+        result = {"status_code": 503}
+        self.assertEqual([self.api.retry_delay(result, attempt, True) for attempt in range(3)], [0.5, 1, 2])
+        self.api.retries = 10
+        self.assertEqual(self.api.retry_delay(result, 8, True), 10)
+        self.assertIsNone(self.api.retry_delay(result, 10, True))
+
+    def test_retry_after_is_waited_for_unless_too_long(self):
+        self.assertEqual(self.api.retry_delay({"status_code": 429, "headers": {"Retry-After": "4"}}, 0, False), 4.5)
+        self.assertIsNone(self.api.retry_delay({"status_code": 429, "headers": {"retry-after": "31"}}, 0, False))
+
+        later = formatdate(time.time() + 20, usegmt=True)
+        delay = self.api.retry_delay({"status_code": 503, "headers": {"Retry-After": later}}, 0, False)
+        self.assertTrue(19 <= delay <= 20.5, delay)
+
+    @mock.patch("client.time.sleep")
+    def test_refused_post_is_sent_again(self, sleep):
+        with mock.patch.object(self.api.session, "request", side_effect=[refused(), response(201, {"stars": 4})]):
+            result = self.api.make_request("post", f"{BASE_URL}/rate/", json={})
+        self.assertEqual(result["status_code"], 201)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(self.api.transport_stats()["retries"], 1)
+
+    @mock.patch("client.time.sleep")
+    def test_dropped_post_is_not_sent_again(self, sleep):
+        with mock.patch.object(self.api.session, "request", side_effect=[dropped()]) as request:
+            result = self.api.make_request("post", f"{BASE_URL}/rate/", json={})
+        self.assertTrue(result["connection_error"])
+        self.assertFalse(result["connect_failed"])
+        self.assertEqual(request.call_count, 1)
+        sleep.assert_not_called()
+
+
+# Tests for the circuit breaker: opening, the half-open trial request and closing again
+class BreakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("client.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_opens_then_lets_one_trial_through(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=30)
+        self.assertFalse(breaker.record(False))
+        self.assertTrue(breaker.record(False))
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.remaining(), 30)
+
+        # Half open: one trial, the others still fail fast
+        self.now += 30
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        # A failed trial opens it again straight away
+        self.assertFalse(breaker.record(False))
+        self.assertFalse(breaker.allow())
+
+        self.now += 30
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.remaining(), 0)
+
+    def test_threshold_zero_never_opens(self):
+        breaker = CircuitBreaker(threshold=0)
+        for _ in range(10):
+            self.assertFalse(breaker.record(False))
+        self.assertTrue(breaker.allow())
+
+    @mock.patch("client.time.sleep")
+    def test_open_circuit_fails_fast(self, sleep):
+        api = APIClient(BASE_URL, cache=False, outbox=False, retries=0, breaker_threshold=1)
+        with mock.patch.object(api.session, "request", side_effect=[response(500, {})]) as request:
+            self.assertEqual(api.make_request("get", f"{BASE_URL}/list/")["status_code"], 500)
+            result = api.make_request("get", f"{BASE_URL}/list/")
+        self.assertTrue(result["circuit_open"])
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(api.transport_stats()["fast_failures"], 1)
+
+
+# Tests for parsing a JSON list as it arrives, whatever the chunks look like
+class StreamTests(unittest.TestCase):
+    DOCUMENT = {"total": 2, "modules": [{"code": "CD1", "description": "Café ★ {[\"x\"]}"},
+                                        {"code": "PG1", "professors": [{"id": "P1"}, {"id": "P2"}]}, "]"]}
+
+    def parse(self, chunks):
+        return list(iter_json_array(chunks, "modules"))
+
+    def test_every_chunk_boundary(self):
+        data = json.dumps(self.DOCUMENT, ensure_ascii=False).encode()
+        for split in range(len(data) + 1):
+            with self.subTest(split=split):
+                self.assertEqual(self.parse([data[:split], data[split:]]), self.DOCUMENT["modules"])
+        # One byte at a time splits the multi-byte characters too
+        self.assertEqual(self.parse([data[n:n + 1] for n in range(len(data))]), self.DOCUMENT["modules"])
+
+    def test_cut_off_and_missing_lists(self):
+        data = json.dumps(self.DOCUMENT).encode()
+        with self.assertRaises(ValueError):
+            self.parse([data[:len(data) // 2]])
+        with self.assertRaises(ValueError):
+            self.parse([b'{"professors": []}'])
+        self.assertEqual(self.parse([b'{"modules": [', b"]}"]), [])
+
+
+# Tests for the offline rating queue: what gets queued, and sending it again after a failed sync
+class OutboxTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.outbox = RatingOutbox(os.path.join(directory.name, "outbox.sqlite3"))
+        self.api = APIClient(BASE_URL, cache=False, outbox=self.outbox, retries=0, breaker_threshold=0)
+        self.api.username = "student"
+
+    def queued(self):
+        return self.outbox.pending(BASE_URL, "student")
+
+    def test_rating_is_queued_only_when_it_never_reached_the_server(self):
+        with mock.patch.object(self.api.session, "request", side_effect=[dropped()]):
+            result = self.api.rate_professor("P1", "CD1", 2024, 1, 4)
+        self.assertFalse(result.get("queued"))
+        self.assertTrue(result["connection_error"])
+        self.assertEqual(self.queued(), [])
+
+        with mock.patch.object(self.api.session, "request", side_effect=[refused()]):
+            result = self.api.rate_professor("P1", "CD1", 2024, 1, 4)
+        self.assertTrue(result["queued"])
+        self.assertEqual([item["stars"] for item in self.queued()], [4])
+
+    def test_queuing_the_same_rating_again_replaces_it(self):
+        first = self.api.rate_professor("P1", "CD1", 2024, 1, 2, defer=True)["data"]["id"]
+        second = self.api.rate_professor("P1", "CD1", 2024, 1, 5, defer=True)["data"]["id"]
+        self.assertNotEqual(first, second)
+        self.assertEqual([(item["id"], item["stars"]) for item in self.queued()], [(second, 5)])
+
+    def test_resent_batch_keeps_its_ids(self):
+        self.api.rate_professor("P1", "CD1", 2024, 1, 4, defer=True)
+        self.api.rate_professor("P2", "CD1", 2024, 1, 3, defer=True)
+        ids = [item["id"] for item in self.queued()]
+
+        # The first sync reached the server but the response was lost
+        results = {"results": [{"id": rating_id, "status_code": 201} for rating_id in ids],
+                   "succeeded": 2, "failed": 0}
+        with mock.patch.object(self.api.session, "request", side_effect=[dropped(), response(200, results)]) as request:
+            outcomes = self.api.sync()
+            self.assertEqual(outcomes[0]["id"], None)
+            self.assertEqual([item["id"] for item in self.queued()], ids)
+            outcomes = self.api.sync()
+
+        sent = [[item["id"] for item in call.kwargs["json"]["ratings"]] for call in request.call_args_list]
+        self.assertEqual(sent, [ids, ids])
+        self.assertEqual([outcome["id"] for outcome in outcomes], ids)
+        self.assertEqual(self.queued(), [])
+
+
+# Tests for dropping cached averages once a rating changes them
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = ResponseCache(os.path.join(directory.name, "cache.sqlite3"))
+        self.addCleanup(self.cache.db.close)
+        self.api = APIClient(BASE_URL, cache=self.cache, outbox=False, retries=0)
+        for kind in ["view", "average"]:
+            self.cache.set(BASE_URL, kind, "", {"professors": []}, '"v1"')
+
+    def cached_kinds(self):
+        return [kind for kind in ["list", "view", "average"] if self.cache.get(BASE_URL, kind, "") is not None]
+
+    def test_rating_invalidates_view_and_average(self):
+        catalog = {"modules": [{"code": "CD1", "year": 2024, "semester": 1, "professors": [{"id": "P1"}]}]}
+        self.cache.set(BASE_URL, "list", "", catalog, '"l1"')
+        with mock.patch.object(self.api.session, "request", side_effect=[response(400, {"error": "No"}),
+                                                                         response(201, {"stars": 4})]):
+            self.api.rate_professor("P1", "CD1", 2024, 1, 4)
+            self.assertEqual(self.cached_kinds(), ["list", "view", "average"])
+            self.api.rate_professor("P1", "CD1", 2024, 1, 4)
+        self.assertEqual(self.cached_kinds(), ["list"])
+
+    def test_fresh_response_is_served_from_the_cache(self):
+        with mock.patch.object(self.api.session, "request") as request:
+            result = self.api.cached_request("average", "post", f"{BASE_URL}/average/")
+        self.assertTrue(result["cached"])
+        request.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from django.conf import settings
+
+logger = logging.getLogger("rate.access")
+
+# Phases of a request timed for the access log, each moment counts towards one of them
+# auth is the token authentication (its query included), db the other queries, render
+# turning the response data into bytes, and validation the rest of the view: parsing
+# and checking the request and building the response data
+PHASES = ["auth", "validation", "db", "render"]
+
+
+# Per request phase clock
+# The time between two switches is added to the phase that was running, so the
+# phases never overlap. Time outside any phase (middleware, admission queueing,
+# compression) is only part of the total.
+class RequestTimings:
+
+    def __init__(self):
+        self.start = self.mark = time.perf_counter()
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.current = None
+        self.queries = 0
+
+    # Function for making <phase> the running phase, returns the one it replaces
+    def switch(self, phase):
+        now = time.perf_counter()
+        if self.current is not None:
+            self.seconds[self.current] += now - self.mark
+        self.mark = now
+        previous, self.current = self.current, phase
+        return previous
+
+    @contextmanager
+    def phase(self, name):
+        previous = self.switch(name)
+        try:
+            yield
+        finally:
+            self.switch(previous)
+
+    # Post render callback of the response, ends the render phase
+    def rendered(self, response):
+        self.switch(None)
+
+    # Database execute wrapper, queries run by the view itself count as db
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        if self.current != "validation":
+            return execute(sql, params, many, context)
+        with self.phase("db"):
+            return execute(sql, params, many, context)
+
+    def fields(self):
+        fields = {f"{name}_ms": round(seconds * 1000, 3) for name, seconds in self.seconds.items()}
+        fields["queries"] = self.queries
+        return fields
+
+
+# Function for timing part of a request as <name>, for requests that are being logged
+# Takes the Django request or DRF's wrapper of it
+def request_phase(request, name):
+    timings = getattr(getattr(request, "_request", request), "_access_timings", None)
+    return timings.phase(name) if timings is not None else nullcontext()
+
+
+# Rotating file handler for a log file shared by several processes
+# Lines are appended (O_APPEND), so writes from different workers don't mix. One
+# process rotates at a time under an flock on <file>.lock, the others notice the
+# file was replaced and reopen it instead of rotating it again.
+class SharedRotatingFileHandler(RotatingFileHandler):
+
+    def replaced(self):
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record):
+        if self.stream is not None and self.replaced():
+            self.reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with open(self.baseFilename + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self.stream is not None and self.replaced():
+                    self.reopen()
+                else:
+                    super().doRollover()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Formats the access log record (a dict) as one line of JSON
+class JSONLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(record.msg, separators=(",", ":"), default=str)
+
+
+# Hands access log records to a listener thread that formats and writes them
+# The request thread only puts the record on a bounded queue, records that don't
+# fit are counted and dropped rather than making the request wait. Each process
+# starts its own listener on first use, so workers forked by "manage.py serve"
+# don't depend on a thread that only exists in the master.
+class AsyncAccessLogHandler(QueueHandler):
+
+    def __init__(self, target, queue_size):
+        super().__init__(queue.Queue(queue_size))
+        self.target = target
+        self.queue_size = queue_size
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.dropped = 0
+
+    def start(self):
+        with self.start_lock:
+            if self.pid != os.getpid():
+                # A queue inherited over fork may have been locked by a thread that is gone
+                self.queue = queue.Queue(self.queue_size)
+                self.listener = QueueListener(self.queue, self.target)
+                self.listener.start()
+                self.pid = os.getpid()
+
+    # Function for writing out what is queued and stopping the listener thread
+    def stop(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                self.listener.stop()
+                self.pid = None
+        self.target.flush()
+
+    # The record is formatted on the listener thread, not here
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_handler_lock = threading.Lock()
+
+
+# Function for the access log handler, attached to the rate.access logger on first use
+def access_log_handler():
+    global _handler
+    with _handler_lock:
+        if _handler is None:
+            target = SharedRotatingFileHandler(settings.ACCESS_LOG_FILE, maxBytes=settings.ACCESS_LOG_MAX_BYTES,
+                                               backupCount=settings.ACCESS_LOG_BACKUP_COUNT, delay=True)
+            target.setFormatter(JSONLinesFormatter())
+            _handler = AsyncAccessLogHandler(target, settings.ACCESS_LOG_QUEUE_SIZE)
+            logger.addHandler(_handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            atexit.register(flush_access_log)
+        return _handler
+
+
+# Function for writing out the queued access log records, at exit and before a
+# "manage.py serve" worker exits
+def flush_access_log():
+    if _handler is not None:
+        _handler.stop()
@@ -1,10 +1,120 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
 # Register your models here.
-from .models import Professor, Module, Rating, Module_instance
+from .models import Professor, Module, Rating, Module_instance, Shard_map, Archived_year
 from django.contrib.auth.models import User
 
-admin.site.register(Professor)
-admin.site.register(Module)
-admin.site.register(Module_instance)
-admin.site.register(Rating)
+# Counts above this are reported as an estimate instead of being counted exactly
+ESTIMATED_COUNT_CAP = 10000
+
+
+# Paginator that never runs a full COUNT(*) over a big table
+# Unfiltered lists use the row estimate from the planner statistics (kept fresh by
+# ANALYZE), filtered lists count at most ESTIMATED_COUNT_CAP rows
+class EstimatedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = table_row_estimate(queryset.model, queryset.db)
+            if estimate is not None:
+                return estimate
+        return queryset[:ESTIMATED_COUNT_CAP].count()
+
+
+# Function for reading a table's row estimate from the database statistics
+# Returns None when the backend or the statistics can't tell
+def table_row_estimate(model, using):
+    connection = connections[using]
+    table = model._meta.db_table
+
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+
+    return None
+
+
+# Shared settings for the changelists, constant time no matter how many rows there are
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 100
+
+
+@admin.register(Professor)
+class ProfessorAdmin(ScalableAdmin):
+    list_display = ('id', 'name')
+    search_fields = ('id', 'name')
+    ordering = ('id',)
+
+
+@admin.register(Module)
+class ModuleAdmin(ScalableAdmin):
+    list_display = ('code', 'desc')
+    search_fields = ('code', 'desc')
+    ordering = ('code',)
+
+
+@admin.register(Module_instance)
+class Module_instanceAdmin(ScalableAdmin):
+    list_display = ('__str__', 'mod', 'year', 'sem')
+    list_filter = ('year', 'sem')
+    search_fields = ('=mod__code', 'mod__desc')
+    autocomplete_fields = ('mod', 'prof')
+    ordering = ('-year', 'mod', 'sem')
+
+    # __str__ uses mod.code, this also covers the autocomplete results used by RatingAdmin
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('mod')
+
+
+# Stars filter with fixed choices, the default filter reads every distinct value from the table
+class StarsFilter(admin.SimpleListFilter):
+    title = 'stars'
+    parameter_name = 'stars'
+
+    def lookups(self, request, model_admin):
+        return [(str(stars), str(stars)) for stars in range(1, 6)]
+
+    def queryset(self, request, queryset):
+        if self.value() in {str(stars) for stars in range(1, 6)}:
+            return queryset.filter(stars=int(self.value()))
+        return queryset
+
+
+@admin.register(Rating)
+class RatingAdmin(ScalableAdmin):
+    list_display = ('id', 'professor', 'module', 'user', 'stars', 'created_at')
+    list_select_related = ('professor', 'module__mod', 'user')
+    list_filter = (StarsFilter, 'created_at')
+    search_fields = ('=professor__id', '=user__username')
+    raw_id_fields = ('user',)
+    autocomplete_fields = ('professor', 'module')
+
+
+# Year to shard assignments, picked up by the workers within SHARD_MAP_TTL seconds
+@admin.register(Shard_map)
+class Shard_mapAdmin(admin.ModelAdmin):
+    list_display = ('key', 'alias')
+
+
+# Closed years, added by manage.py archive_year
+@admin.register(Archived_year)
+class Archived_yearAdmin(admin.ModelAdmin):
+    list_display = ('year', 'archived_at', 'rating_count')
+    readonly_fields = ('rating_count',)
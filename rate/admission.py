@@ -0,0 +1,232 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from django.conf import settings
+from django.http import JsonResponse
+
+logger = logging.getLogger("rate.admission")
+
+# Seconds a queued request sleeps between checks for a free slot
+QUEUE_POLL_INTERVAL = 0.005
+# Seconds to wait for the shared lock, which is only ever held for microseconds.
+# Waiting longer means a worker died holding it.
+LOCK_TIMEOUT = 1.0
+
+
+# Admission state shared by every worker forked after it is created
+# "manage.py serve" loads the middleware before forking, so its workers share
+# one set of limits and buckets. Under servers that load the app per worker the
+# limits apply per process.
+#
+# Concurrency is counted per process row, so the slots held by a worker that was
+# killed mid-request are freed when a new worker takes over its row. Token
+# buckets are hashed into a fixed table, users that collide share a bucket.
+#
+# A worker killed while holding the lock never gives it back. Each process that
+# then times out waiting for it fails open: requests are let through uncounted
+# and unthrottled until "manage.py serve" is restarted.
+class AdmissionState:
+    # Index of the throttled count in the counters array
+    THROTTLED = 0
+    # Returned by acquire() for a request let through without the lock, it isn't released
+    UNCOUNTED = "uncounted"
+
+    def __init__(self, classes, processes, buckets):
+        self.classes = list(classes)
+        self.processes = processes
+        self.buckets = buckets
+        self.lock = multiprocessing.Lock()
+        # Per process row: pid, then in-flight and queued per class
+        self.rows = multiprocessing.RawArray("q", processes * (1 + 2 * len(self.classes)))
+        # throttled, then admitted and shed per class
+        self.counters = multiprocessing.RawArray("q", 1 + 2 * len(self.classes))
+        # tokens and last refill time per bucket
+        self.tokens = multiprocessing.RawArray("d", buckets * 2)
+        self.row = None
+        self.row_pid = None
+        # Set in a process that timed out on the lock, it doesn't wait for it again
+        self.lock_broken = False
+
+    # Context manager for holding the lock, gives False when it can't be had
+    @contextmanager
+    def locked(self):
+        if self.lock_broken or not self.lock.acquire(timeout=LOCK_TIMEOUT):
+            if not self.lock_broken:
+                logger.error("Admission lock held for over %s s, a worker died holding it. Admission "
+                             "control is off in process %d until the server is restarted", LOCK_TIMEOUT, os.getpid())
+                self.lock_broken = True
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.lock.release()
+
+    @property
+    def row_size(self):
+        return 1 + 2 * len(self.classes)
+
+    # Function for finding this process' row, claiming a free or dead one on first use
+    # Called with the lock held
+    def own_row(self):
+        pid = os.getpid()
+        if self.row_pid == pid:
+            return self.row
+
+        size = self.row_size
+        for row in range(self.processes):
+            owner = self.rows[row * size]
+            if owner == pid or owner == 0 or not pid_alive(owner):
+                self.rows[row * size] = pid
+                for column in range(1, size):
+                    self.rows[row * size + column] = 0
+                self.row, self.row_pid = row, pid
+                return row
+        raise RuntimeError("No free admission rows, raise ADMISSION_MAX_PROCESSES")
+
+    def total(self, index, queued=False):
+        size = self.row_size
+        column = 1 + index + (len(self.classes) if queued else 0)
+        return sum(self.rows[row * size + column] for row in range(self.processes) if self.rows[row * size])
+
+    def add(self, index, amount, queued=False):
+        column = 1 + index + (len(self.classes) if queued else 0)
+        self.rows[self.own_row() * self.row_size + column] += amount
+
+    def try_admit(self, index, limit):
+        if limit is None or self.total(index) < limit:
+            self.add(index, 1)
+            self.counters[1 + 2 * index] += 1
+            return True
+        return False
+
+    # Function for admitting a request of a class, returns False when it is shed
+    # A full class queues the request for up to queue_timeout seconds, unless
+    # its queue is full too, then it is shed straight away. UNCOUNTED when the
+    # lock is broken, the request goes ahead and must not be released.
+    def acquire(self, index, config):
+        limit = config.get("concurrency")
+        with self.locked() as held:
+            if not held:
+                return self.UNCOUNTED
+            if self.try_admit(index, limit):
+                return True
+            if self.total(index, queued=True) >= config.get("queue", 0):
+                self.counters[2 + 2 * index] += 1
+                return False
+            self.add(index, 1, queued=True)
+
+        deadline = time.monotonic() + config.get("queue_timeout", 0)
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(QUEUE_POLL_INTERVAL)
+                with self.locked() as held:
+                    if not held:
+                        return self.UNCOUNTED
+                    if self.try_admit(index, limit):
+                        return True
+            with self.locked() as held:
+                if held:
+                    self.counters[2 + 2 * index] += 1
+            return False
+        finally:
+            with self.locked() as held:
+                if held:
+                    self.add(index, -1, queued=True)
+
+    def release(self, index):
+        with self.locked() as held:
+            if held:
+                self.add(index, -1)
+
+    # Function for taking a token from a client's bucket
+    # Returns 0 when the request may go ahead, otherwise the seconds until it may
+    def take_token(self, key, rate, burst):
+        slot = zlib.crc32(key.encode()) % self.buckets * 2
+        now = time.monotonic()
+        with self.locked() as held:
+            if not held:
+                return 0
+            tokens, last = self.tokens[slot], self.tokens[slot + 1]
+            tokens = burst if last == 0 else min(burst, tokens + (now - last) * rate)
+            wait = 0
+            if tokens < 1:
+                wait = (1 - tokens) / rate
+                self.counters[self.THROTTLED] += 1
+            else:
+                tokens -= 1
+            self.tokens[slot], self.tokens[slot + 1] = tokens, now
+        return wait
+
+    # Read without the lock when it is broken, the numbers may be slightly off
+    def stats(self):
+        with self.locked():
+            classes = {}
+            for index, name in enumerate(self.classes):
+                config = settings.ADMISSION_CLASSES[name]
+                classes[name] = {
+                    "concurrency": config.get("concurrency"),
+                    "queue": config.get("queue", 0),
+                    "in_flight": self.total(index),
+                    "queued": self.total(index, queued=True),
+                    "admitted": self.counters[1 + 2 * index],
+                    "shed": self.counters[2 + 2 * index]
+                }
+            return {
+                "classes": classes,
+                "throttled": self.counters[self.THROTTLED],
+                "processes": sum(1 for row in range(self.processes) if self.rows[row * self.row_size]),
+                "fail_open": self.lock_broken
+            }
+
+
+# Function for checking whether a process still exists
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+# Function for getting the admission state, created on first use
+def admission_state():
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = AdmissionState(settings.ADMISSION_CLASSES, settings.ADMISSION_MAX_PROCESSES,
+                                    settings.ADMISSION_BUCKETS)
+        return _state
+
+
+# Function for finding the admission class of a path, first matching prefix wins
+# Returns (index, name, config), or None for paths that are not controlled
+def classify(path):
+    for index, (name, config) in enumerate(settings.ADMISSION_CLASSES.items()):
+        if path.startswith(tuple(config["paths"])):
+            return index, name, config
+    return None
+
+
+# Function for the key of a client's token bucket, without touching the database
+# The client address: the Authorization header isn't checked yet at this point, so a
+# client making up a new token for every request would get a fresh bucket each time
+def client_key(request):
+    return request.META.get("REMOTE_ADDR", "")
+
+
+# Function for a fail-fast error response with Retry-After
+def rejected(message, status, retry_after):
+    response = JsonResponse({"error": message}, status=status)
+    response["Retry-After"] = str(max(1, round(retry_after)))
+    return response
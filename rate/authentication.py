@@ -0,0 +1,28 @@
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from .accesslog import request_phase
+
+
+# Function for checking whether a token is older than AUTH_TOKEN_MAX_AGE
+def token_expired(token):
+    max_age = settings.AUTH_TOKEN_MAX_AGE
+    return bool(max_age) and token.created < timezone.now() - timedelta(seconds=max_age)
+
+
+# Token authentication that refuses tokens older than AUTH_TOKEN_MAX_AGE
+# Expired tokens are deleted by "manage.py maintain", logging in again issues a new one
+class ExpiringTokenAuthentication(TokenAuthentication):
+
+    # Timed as the auth phase of the access log
+    def authenticate(self, request):
+        with request_phase(request, "auth"):
+            return super().authenticate(request)
+
+    def authenticate_credentials(self, key):
+        user, token = super().authenticate_credentials(key)
+        if token_expired(token):
+            raise exceptions.AuthenticationFailed("Token has expired, log in again")
+        return user, token
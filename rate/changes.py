@@ -0,0 +1,118 @@
+from django.db import router
+from .models import Professor, Module, Module_instance, Rating, Change
+from .sharding import fan_out
+
+# Maximum number of changes returned by one /api/changes/ page
+DEFAULT_LIMIT = 500
+MAX_LIMIT = 5000
+
+
+# Function for appending a row change to the change log
+def record_change(entity, key, op="upsert"):
+    Change.objects.using(router.db_for_write(Change)).create(entity=entity, key=str(key), op=op)
+
+
+# Function for appending the same change to many rows, for bulk moves
+def record_changes(entity, keys, op="upsert"):
+    Change.objects.using(router.db_for_write(Change)).bulk_create(
+        [Change(entity=entity, key=str(key), op=op) for key in keys], batch_size=500)
+
+
+# Functions that load the current state of changed rows, one query per entity
+def load_professors(keys):
+    return {p.id: {"id": p.id, "name": p.name} for p in Professor.objects.filter(id__in=keys)}
+
+
+def load_modules(keys):
+    return {m.code: {"code": m.code, "description": m.desc} for m in Module.objects.filter(code__in=keys)}
+
+
+def load_module_instances(keys):
+    instances = Module_instance.objects.filter(id__in=keys).prefetch_related("prof")
+    return {
+        str(i.id): {
+            "id": i.id,
+            "code": i.mod_id,
+            "year": i.year,
+            "semester": i.sem,
+            "professors": [p.id for p in i.prof.all()]
+        }
+        for i in instances
+    }
+
+
+# Rating ids are only unique per database, ratings on a shard are keyed "<alias>:<id>"
+def rating_key(alias, pk):
+    return str(pk) if alias == "default" else f"{alias}:{pk}"
+
+
+def load_ratings(keys):
+    ids = {}
+    for key in keys:
+        alias, _, pk = key.rpartition(":")
+        ids.setdefault(alias or "default", []).append(pk)
+
+    def load(alias, db):
+        rows = Rating.objects.using(db).filter(id__in=ids[alias]).values("id", "stars", "professor_id", "module_id")
+        return {
+            rating_key(alias, r["id"]): {
+                "id": r["id"],
+                "stars": r["stars"],
+                "professor_id": r["professor_id"],
+                "module_instance_id": r["module_id"]
+            }
+            for r in rows
+        }
+
+    ratings = {}
+    for rows in fan_out(Rating, load, ids):
+        ratings.update(rows)
+    return ratings
+
+
+LOADERS = {
+    "professor": load_professors,
+    "module": load_modules,
+    "module_instance": load_module_instances,
+    "rating": load_ratings,
+}
+
+
+# Function for reading the changes after a cursor
+# Several changes to the same row within a page collapse into the latest one,
+# upserts carry the row's current state and deletes only carry the key
+def read_changes(since, limit):
+    changes = list(Change.objects.filter(seq__gt=since).order_by("seq")[:limit + 1])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    latest = {}
+    for change in changes:
+        latest[(change.entity, change.key)] = change
+
+    # Load the current rows for every upserted key, grouped by entity
+    keys = {}
+    for change in latest.values():
+        if change.op == "upsert":
+            keys.setdefault(change.entity, []).append(change.key)
+    rows = {entity: LOADERS[entity](entity_keys) for entity, entity_keys in keys.items()}
+
+    results = []
+    for change in sorted(latest.values(), key=lambda c: c.seq):
+        data = None
+        if change.op == "upsert":
+            data = rows[change.entity].get(change.key)
+        results.append({
+            "seq": change.seq,
+            "entity": change.entity,
+            "key": change.key,
+            # A row that has gone since the change was logged is reported as deleted
+            "op": change.op if change.op == "delete" or data is not None else "delete",
+            "data": data
+        })
+
+    return {
+        "changes": results,
+        "cursor": changes[-1].seq if changes else since,
+        "has_more": has_more
+    }
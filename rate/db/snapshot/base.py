@@ -0,0 +1,77 @@
+import sqlite3
+import time
+from django.db.backends.sqlite3 import base
+
+
+# SQLite backend that serves reads from a private in-memory copy of the database file
+# The copy is made with the SQLite backup API when the connection opens, and is
+# refreshed when the file's PRAGMA data_version shows another connection committed.
+# The version is checked at most once every OPTIONS["max_staleness"] seconds, so
+# reads are never more than that far behind and never wait on writer locks.
+# A pinned snapshot isn't refreshed, read_only views pin it so that all of their
+# queries read one state of the database (see rate/routers.py).
+class DatabaseWrapper(base.DatabaseWrapper):
+    display_name = "SQLite (in-memory snapshot)"
+    # Number of pin_snapshot() calls not yet undone
+    pins = 0
+
+    # max_staleness is ours, it is taken out before the kwargs reach sqlite3.connect
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.max_staleness = kwargs.pop("max_staleness", 1.0)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        # Test databases are already in memory (the replica mirrors default there),
+        # read them directly instead of copying
+        if self.is_in_memory_db():
+            conn = super().get_new_connection(conn_params)
+            conn.execute("PRAGMA read_uncommitted = 1")
+            self.source = None
+            return conn
+
+        self.source = sqlite3.connect(f"file:{conn_params['database']}?mode=ro", uri=True, check_same_thread=False)
+        conn = super().get_new_connection({**conn_params, "database": ":memory:"})
+        self.load_snapshot(conn)
+        return conn
+
+    def load_snapshot(self, conn):
+        # Read the version first, a commit during the copy then triggers another refresh
+        self.snapshot_version = self.data_version()
+        self.source.backup(conn)
+        self.snapshot_checked = time.monotonic()
+
+    def data_version(self):
+        return self.source.execute("PRAGMA data_version").fetchone()[0]
+
+    # Function for reloading the snapshot if the source moved and the staleness bound has passed
+    def refresh_snapshot(self):
+        if self.source is None or self.in_atomic_block or self.pins:
+            return
+        if time.monotonic() - self.snapshot_checked < self.max_staleness:
+            return
+
+        self.snapshot_checked = time.monotonic()
+        if self.data_version() != self.snapshot_version:
+            self.load_snapshot(self.connection)
+
+    # Function for holding the snapshot still until unpin_snapshot()
+    # It is brought up to date first, within the staleness bound like any query
+    def pin_snapshot(self):
+        if self.connection is not None:
+            self.refresh_snapshot()
+        self.pins += 1
+
+    def unpin_snapshot(self):
+        self.pins -= 1
+
+    def _cursor(self, name=None):
+        if self.connection is not None:
+            self.refresh_snapshot()
+        return super()._cursor(name)
+
+    def _close(self):
+        super()._close()
+        if getattr(self, "source", None) is not None:
+            self.source.close()
+            self.source = None
@@ -0,0 +1,189 @@
+import gzip
+import hashlib
+import threading
+import time
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.response import Response
+from .accesslog import request_phase
+
+# brotli and zstandard are optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compression functions keyed by their Content-Encoding token
+COMPRESSORS = {
+    "gzip": lambda body: gzip.compress(body, compresslevel=6, mtime=0),
+}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=5)
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda body: zstandard.ZstdCompressor(level=3).compress(body)
+
+
+# Function for compressing a body with one of the supported encodings
+def compress(body, encoding):
+    if encoding == "identity":
+        return body
+    return COMPRESSORS[encoding](body)
+
+
+# Function for picking the best encoding the client accepts
+# Client q-values win, ties are broken by the order in RESPONSE_COMPRESSION_ENCODINGS
+def negotiate_encoding(accept_encoding):
+    if not accept_encoding:
+        return "identity"
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        token = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if token:
+            accepted[token] = q
+
+    best, best_q = "identity", 0.0
+    for encoding in settings.RESPONSE_COMPRESSION_ENCODINGS:
+        if encoding not in COMPRESSORS:
+            continue
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+# Function for compressing a finished response in place if it is worth it
+def compress_response(request, response):
+    if response.streaming or response.has_header("Content-Encoding"):
+        return response
+    if response.status_code != 200 or len(response.content) < settings.RESPONSE_COMPRESSION_MIN_SIZE:
+        return response
+
+    patch_vary_headers(response, ("Accept-Encoding",))
+    encoding = negotiate_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    if encoding == "identity":
+        return response
+
+    compressed = compress(response.content, encoding)
+    if len(compressed) >= len(response.content):
+        return response
+
+    response.content = compressed
+    response["Content-Length"] = str(len(compressed))
+    response["Content-Encoding"] = encoding
+    # The body changed, so a strong ETag no longer holds
+    etag = response.get("ETag")
+    if etag and etag.startswith('"'):
+        response["ETag"] = "W/" + etag
+    return response
+
+
+# In-process version counters for cached payloads, bumped by the signals in rate/signals.py
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def bump_version(key):
+    with _versions_lock:
+        _versions[key] = _versions.get(key, 0) + 1
+
+
+# Keys like "catalog:2024" are slices of "catalog" and share its version
+def current_version(key):
+    return _versions.get(key.partition(":")[0], 0)
+
+
+# Cache of payloads that are already encoded, and compressed per Content-Encoding
+# Entries are dropped when their version moves or after ENCODED_CACHE_TTL seconds,
+# the TTL bounds staleness for changes made by other processes
+class EncodedPayloadCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, media_type, encoding):
+        entry = self._entries.get((key, media_type))
+        if entry is None:
+            return None
+
+        version, created, variants, etag = entry
+        if version != current_version(key) or time.monotonic() - created > settings.ENCODED_CACHE_TTL:
+            return None
+
+        body = variants.get(encoding)
+        if body is None:
+            # Compress once per encoding and keep the result next to the identity body
+            body = compress(variants["identity"], encoding)
+            with self._lock:
+                variants[encoding] = body
+        return body, etag
+
+    def set(self, key, media_type, body, version):
+        etag = '"%s"' % hashlib.md5(body, usedforsecurity=False).hexdigest()
+        with self._lock:
+            self._entries[(key, media_type)] = (version, time.monotonic(), {"identity": body}, etag)
+        return etag
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+encoded_cache = EncodedPayloadCache()
+
+
+# Function for answering a DRF request from the encoded cache
+# build_payload is only called on a miss, the payload is rendered with the negotiated renderer
+def cached_response(request, key, build_payload):
+    renderer = request.accepted_renderer
+
+    # HTML (browsable API) responses are never cached
+    if renderer.format == "api":
+        return Response(build_payload())
+
+    media_type = request.accepted_media_type
+    encoding = "identity"
+    version = current_version(key)
+
+    cached = encoded_cache.get(key, media_type, "identity")
+    if cached is None:
+        payload = build_payload()
+        with request_phase(request, "render"):
+            body = renderer.render(payload, media_type, {"request": request})
+        etag = encoded_cache.set(key, media_type, body, version)
+    else:
+        body, etag = cached
+
+    if len(body) >= settings.RESPONSE_COMPRESSION_MIN_SIZE:
+        encoding = negotiate_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding != "identity":
+            hit = encoded_cache.get(key, media_type, encoding)
+            body = hit[0] if hit else compress(body, encoding)
+
+    content_type = media_type
+    if renderer.charset:
+        content_type = f"{media_type}; charset={renderer.charset}"
+
+    response = HttpResponse(body, content_type=content_type)
+    response["ETag"] = etag if encoding == "identity" else "W/" + etag
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept", "Accept-Encoding"))
+    return response
@@ -0,0 +1,389 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Professor, Module_instance, Rating, Rating_receipt, Archived_year
+from .ratings import upsert_rating
+from .sharding import shard_for_year
+
+logger = logging.getLogger("rate.ingest")
+
+# Files in RATING_INGEST_DIR: writers append to LIVE_LOG, the applier renames it to
+# a sealed segment (ratings.<ns>.log) before draining it
+LIVE_LOG = "ratings.log"
+WRITE_LOCK = "ratings.lock"
+APPLIER_LOCK = "applier.lock"
+
+
+# Function for getting the path of a file in the ingest directory
+def ingest_path(name):
+    return os.path.join(settings.RATING_INGEST_DIR, name)
+
+
+# Context manager holding an exclusive flock on a file in the ingest directory
+# Shared by every process on the host, blocking=False raises BlockingIOError when held
+@contextmanager
+def file_lock(name, blocking=True):
+    os.makedirs(settings.RATING_INGEST_DIR, exist_ok=True)
+    with open(ingest_path(name), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Function for fsyncing a directory, makes a created or renamed file durable
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Durable append-only log of accepted ratings, one per process
+# Requests hand their record to a writer thread and wait for it to be on disk.
+# The writer collects everything queued within RATING_INGEST_FSYNC_WINDOW and
+# writes it with a single fsync, so concurrent requests share the fsync cost.
+class IngestLog:
+
+    class Entry:
+        def __init__(self, line):
+            self.line = line
+            self.done = threading.Event()
+            self.error = None
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []
+        self.thread = None
+
+    # Function for appending a record, returns once it has been fsynced
+    def append(self, record):
+        entry = self.Entry(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        with self.cond:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="ingest-log", daemon=True)
+                self.thread.start()
+            self.pending.append(entry)
+            self.cond.notify()
+
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+            # Let the requests arriving right behind this one join the batch
+            time.sleep(settings.RATING_INGEST_FSYNC_WINDOW)
+            with self.cond:
+                batch, self.pending = self.pending, []
+
+            error = None
+            try:
+                self.write(b"".join(entry.line for entry in batch))
+            except OSError as e:
+                error = e
+            for entry in batch:
+                entry.error = error
+                entry.done.set()
+
+    def write(self, data):
+        path = ingest_path(LIVE_LOG)
+        # The applier renames the live log, so it's reopened for every batch
+        with file_lock(WRITE_LOCK):
+            created = not os.path.exists(path)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if created:
+                fsync_dir(settings.RATING_INGEST_DIR)
+
+
+ingest_log = IngestLog()
+
+
+# Function for accepting a validated rating into the log, returns its receipt id
+# A batch passes the client's own id for the rating, it becomes the receipt id
+def enqueue_rating(user, professor, module_instance, stars, update=False, receipt=None):
+    receipt = receipt or uuid.uuid4().hex
+    ingest_log.append({
+        "id": receipt,
+        "user": user.pk,
+        "professor": professor.pk,
+        "module": module_instance.pk,
+        "year": module_instance.year,
+        "stars": stars,
+        "update": update,
+        # Becomes the rating's created_at, also identifies the rating on replay
+        "at": timezone.now().isoformat()
+    })
+    return receipt
+
+
+# Function for listing the sealed segments waiting to be applied, oldest first
+def sealed_segments():
+    if not os.path.isdir(settings.RATING_INGEST_DIR):
+        return []
+    names = sorted(name for name in os.listdir(settings.RATING_INGEST_DIR)
+                   if name.startswith("ratings.") and name.endswith(".log") and name != LIVE_LOG)
+    return [ingest_path(name) for name in names]
+
+
+# Function for sealing the live log so the applier can drain it
+# Writers reopen the live log for every batch, so they start a fresh one
+def seal_log():
+    path = ingest_path(LIVE_LOG)
+    with file_lock(WRITE_LOCK):
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            os.rename(path, ingest_path(f"ratings.{time.time_ns():020d}.log"))
+            fsync_dir(settings.RATING_INGEST_DIR)
+
+
+# Function for reading the records of a log file
+def read_records(path):
+    with open(path, "rb") as log:
+        for line in log:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Torn last line of a write cut short by a crash, it was never acknowledged
+                continue
+
+
+# Index of the records waiting in the log, kept per process
+# Each file is read from where the last lookup stopped, so a lookup only reads what
+# was appended since instead of the whole backlog. Sealed segments never change,
+# a live log that was sealed is read again under its segment name.
+class PendingIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> (inode, bytes read, receipt ids read from it)
+        self.files = {}
+        # receipt id -> record
+        self.records = {}
+        # (user, professor, module) -> receipt ids of the records rating it
+        self.ratings = {}
+
+    def refresh(self):
+        paths = sealed_segments() + [ingest_path(LIVE_LOG)]
+        for path in list(self.files):
+            if path not in paths:
+                self.forget(path)
+
+        for path in paths:
+            try:
+                with open(path, "rb") as log:
+                    inode = os.fstat(log.fileno()).st_ino
+                    if path in self.files and self.files[path][0] != inode:
+                        self.forget(path)
+                    _, offset, ids = self.files.get(path, (inode, 0, []))
+                    log.seek(offset)
+                    data = log.read()
+            except FileNotFoundError:
+                self.forget(path)
+                continue
+
+            # A line still being written is read again next time
+            complete = data[:data.rfind(b"\n") + 1]
+            for line in complete.splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.records[record["id"]] = record
+                self.ratings.setdefault(rating_of(record), set()).add(record["id"])
+                ids.append(record["id"])
+            self.files[path] = (inode, offset + len(complete), ids)
+
+    def forget(self, path):
+        _, _, ids = self.files.pop(path, (None, 0, []))
+        for receipt in ids:
+            record = self.records.pop(receipt, None)
+            if record is not None:
+                receipts = self.ratings.get(rating_of(record), set())
+                receipts.discard(receipt)
+                if not receipts:
+                    self.ratings.pop(rating_of(record), None)
+
+    def find(self, receipt):
+        with self.lock:
+            self.refresh()
+            return self.records.get(receipt)
+
+    def find_rating(self, user, professor, module):
+        with self.lock:
+            self.refresh()
+            return sorted((self.records[receipt] for receipt in self.ratings.get((user, professor, module), ())),
+                          key=lambda record: record["at"])
+
+
+# Function for the (user, professor, module) a record rates
+def rating_of(record):
+    return record.get("user"), record.get("professor"), record.get("module")
+
+
+pending_index = PendingIndex()
+
+
+# Function for finding a record that has not been applied yet
+def find_pending(receipt):
+    return pending_index.find(receipt)
+
+
+# Function for the records of a user's rating of a professor for a module instance
+# that have not been applied yet, oldest first
+def find_pending_ratings(user, professor, module_instance):
+    return pending_index.find_rating(user.pk, professor.pk, module_instance.pk)
+
+
+# Function for applying one record inside the batch transaction, returns its receipt
+def apply_record(record, using, closed_years):
+    def receipt(status, error=""):
+        return Rating_receipt(id=record["id"], user_id=record["user"], status=status, error=error)
+
+    if record["year"] in closed_years:
+        return receipt("rejected", f"Ratings for year {record['year']} are closed")
+
+    created_at = parse_datetime(record["at"])
+    if record["update"]:
+        upsert_rating(User(pk=record["user"]), Professor(pk=record["professor"]),
+                      Module_instance(pk=record["module"], year=record["year"]), record["stars"],
+                      using=using, created_at=created_at)
+        return receipt("applied")
+
+    existing = Rating.objects.using(using).filter(
+        user_id=record["user"], professor_id=record["professor"], module_id=record["module"]).first()
+    if existing is not None:
+        # The same record replayed after a crash between the rating and receipt commits
+        if existing.created_at == created_at and existing.stars == record["stars"]:
+            return receipt("applied")
+        return receipt("rejected", "Already rated this professor for this module instance")
+
+    try:
+        with transaction.atomic(using=using):
+            Rating.objects.using(using).create(stars=record["stars"], professor_id=record["professor"],
+                                               module_id=record["module"], user_id=record["user"],
+                                               created_at=created_at)
+    except IntegrityError:
+        # Rated through the synchronous path since the existence check
+        return receipt("rejected", "Already rated this professor for this module instance")
+    return receipt("applied")
+
+
+# Function for applying a batch of records, one transaction per database
+# Records that already have a receipt were applied before a crash and are skipped.
+# Returns the number of records applied or rejected, dropped records aren't counted.
+def apply_batch(records):
+    done = set(Rating_receipt.objects.filter(id__in=[r["id"] for r in records]).values_list("id", flat=True))
+    records = [r for r in records if r["id"] not in done]
+    if not records:
+        return 0
+
+    # Rows deleted since the record was accepted would fail the deferred foreign key
+    # checks at commit and stall the whole batch
+    users = set(User.objects.filter(pk__in={r["user"] for r in records}).values_list("pk", flat=True))
+    professors = set(Professor.objects.filter(pk__in={r["professor"] for r in records}).values_list("pk", flat=True))
+    modules = set(Module_instance.objects.filter(pk__in={r["module"] for r in records}).values_list("pk", flat=True))
+    closed_years = set(Archived_year.objects.values_list("year", flat=True))
+
+    # A receipt needs its user, the ratings of deleted users are dropped and logged
+    by_alias = {}
+    for record in records:
+        if record["user"] in users:
+            by_alias.setdefault(shard_for_year(record["year"]), []).append(record)
+        else:
+            logger.warning("Dropped rating %s, user %s no longer exists", record["id"], record["user"])
+
+    for using, group in by_alias.items():
+        with transaction.atomic(using="default"), transaction.atomic(using=using):
+            receipts = []
+            for record in group:
+                if record["professor"] not in professors or record["module"] not in modules:
+                    receipts.append(Rating_receipt(id=record["id"], user_id=record["user"], status="rejected",
+                                                   error="Professor or module instance no longer exists"))
+                else:
+                    receipts.append(apply_record(record, using, closed_years))
+            Rating_receipt.objects.bulk_create(receipts)
+
+    return sum(len(group) for group in by_alias.values())
+
+
+# Function for draining every accepted rating into the database
+# A segment is removed once all of its records are applied, a crash before that
+# replays it and apply_batch skips what was already done. A segment that keeps
+# failing is put aside after RATING_INGEST_MAX_ATTEMPTS drains, so the segments
+# behind it aren't held up for ever.
+def drain(batch_size=None):
+    batch_size = batch_size or settings.RATING_INGEST_BATCH
+    seal_log()
+
+    applied = 0
+    for path in sealed_segments():
+        try:
+            applied += apply_segment(path, batch_size)
+        except Exception:
+            if failed_attempt(path) < settings.RATING_INGEST_MAX_ATTEMPTS:
+                raise
+            quarantine(path)
+            continue
+        os.remove(path)
+        if os.path.exists(path + ".attempts"):
+            os.remove(path + ".attempts")
+    return applied
+
+
+def apply_segment(path, batch_size):
+    applied = 0
+    batch = []
+    for record in read_records(path):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            applied += apply_batch(batch)
+            batch = []
+    if batch:
+        applied += apply_batch(batch)
+    return applied
+
+
+# Function for counting a failed drain of a segment, returns the failures so far
+# Counted in <segment>.attempts, so restarting the applier doesn't reset it
+def failed_attempt(path):
+    attempts_path = path + ".attempts"
+    try:
+        with open(attempts_path) as f:
+            attempts = int(f.read() or 0) + 1
+    except (FileNotFoundError, ValueError):
+        attempts = 1
+    with open(attempts_path, "w") as f:
+        f.write(str(attempts))
+    return attempts
+
+
+# Function for putting aside a segment that can't be applied
+# It's renamed to <segment>.quarantined with its records that had no receipt yet
+# still in it, rename it back to ratings.<ns>.log to have it applied again
+def quarantine(path):
+    logger.exception("Quarantined %s after %s failed attempts", path, settings.RATING_INGEST_MAX_ATTEMPTS)
+    os.rename(path, path + ".quarantined")
+    os.remove(path + ".attempts")
+    fsync_dir(settings.RATING_INGEST_DIR)
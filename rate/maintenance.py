@@ -0,0 +1,381 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from .models import Module_instance, Rating, Rating_summary, Daily_rating, Archived_year
+from .sharding import shard_aliases, shard_for_year
+from .sketches import add_users
+
+logger = logging.getLogger("rate.maintenance")
+
+# Units of work, a short statement each (vacuum, tokens) or one batch of reads (checks)
+VACUUM_SLICE_PAGES = 256
+TOKEN_SLICE = 500
+SUMMARY_SLICE = 200
+DAILY_SLICE_DAYS = 14
+
+TASKS = ["optimize", "checkpoint", "purge_tokens", "vacuum", "check_summaries", "check_daily"]
+
+
+# Function for the size of a SQLite database in bytes, and the bytes on its freelist
+def sqlite_size(cursor):
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    pages = cursor.execute("PRAGMA page_count").fetchone()[0]
+    free = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * page_size, free * page_size
+
+
+# Function for listing the SQLite databases that are maintained, default and the shards
+def maintained_databases():
+    return [alias for alias in shard_aliases() if connections[alias].vendor == "sqlite"]
+
+
+# Tasks: each one takes the time budget and the repair flag and returns one
+# result per database, {"task", "database", "bytes", "detail"}
+
+# Refreshes the planner statistics, bounded by analysis_limit rows per index
+def optimize(budget, repair, state):
+    results = []
+    for alias in maintained_databases():
+        with connections[alias].cursor() as cursor:
+            cursor.execute("PRAGMA analysis_limit = 1000")
+            cursor.execute("ANALYZE")
+            cursor.execute("PRAGMA optimize")
+        results.append({"database": alias, "bytes": 0, "detail": "statistics refreshed"})
+    return results
+
+
+# Copies the WAL back into the database without waiting on readers, and truncates
+# the WAL file when every frame made it
+def checkpoint(budget, repair, state):
+    results = []
+    for alias in maintained_databases():
+        with connections[alias].cursor() as cursor:
+            mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+            if mode != "wal":
+                results.append({"database": alias, "bytes": 0, "detail": f"skipped, journal_mode is {mode}"})
+                continue
+
+            wal = f"{connections[alias].settings_dict['NAME']}-wal"
+            before = os.path.getsize(wal) if os.path.exists(wal) else 0
+            busy, frames, done = cursor.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            if not busy and frames == done:
+                cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            after = os.path.getsize(wal) if os.path.exists(wal) else 0
+        results.append({"database": alias, "bytes": before - after,
+                        "detail": f"{done} of {frames} frames checkpointed"})
+    return results
+
+
+# Deletes API tokens older than AUTH_TOKEN_MAX_AGE, their pages go to the freelist
+def purge_tokens(budget, repair, state):
+    if not settings.AUTH_TOKEN_MAX_AGE:
+        return [{"database": "default", "bytes": 0, "detail": "skipped, AUTH_TOKEN_MAX_AGE is not set"}]
+
+    cutoff = timezone.now() - timedelta(seconds=settings.AUTH_TOKEN_MAX_AGE)
+    deadline = time.monotonic() + budget
+    deleted = 0
+    while time.monotonic() < deadline:
+        keys = list(Token.objects.filter(created__lt=cutoff).values_list("key", flat=True)[:TOKEN_SLICE])
+        if not keys:
+            break
+        deleted += Token.objects.filter(key__in=keys).delete()[0]
+    return [{"database": "default", "bytes": 0, "detail": f"{deleted} expired tokens deleted"}]
+
+
+# Returns free pages to the file system a slice at a time
+# Needs auto_vacuum=INCREMENTAL, set once with "manage.py maintain --enable-incremental-vacuum"
+def vacuum(budget, repair, state):
+    results = []
+    for alias in maintained_databases():
+        deadline = time.monotonic() + budget
+        with connections[alias].cursor() as cursor:
+            if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                results.append({"database": alias, "bytes": 0,
+                                "detail": "skipped, incremental vacuum is not enabled"})
+                continue
+
+            page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+            before, free = sqlite_size(cursor)
+            while free and time.monotonic() < deadline:
+                # The pragma frees one page per step and execute() only steps once for a
+                # statement without result columns, executescript() runs it to the end
+                cursor.executescript(f"PRAGMA incremental_vacuum({VACUUM_SLICE_PAGES})")
+                free = sqlite_size(cursor)[1]
+            after, free = sqlite_size(cursor)
+        results.append({"database": alias, "bytes": before - after,
+                         "detail": f"{(before - after) // page_size} pages freed, {free} free bytes left"})
+    return results
+
+
+# Function for switching databases to incremental vacuum, a one-off full VACUUM
+def enable_incremental_vacuum():
+    results = []
+    for alias in maintained_databases():
+        with connections[alias].cursor() as cursor:
+            before = sqlite_size(cursor)[0]
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+            after = sqlite_size(cursor)[0]
+        results.append({"task": "enable_incremental_vacuum", "database": alias, "ms": 0,
+                        "bytes": before - after, "detail": "auto_vacuum set to incremental"})
+    return results
+
+
+# Function for the expected summary values of some module instances, from the ratings
+def expected_summaries(alias, module_ids):
+    expected = {}
+    rows = Rating.objects.using(alias).filter(module_id__in=module_ids).values(
+        "professor_id", "module_id", "stars").annotate(n=Count("id"))
+    for row in rows:
+        values = expected.setdefault((row["professor_id"], row["module_id"]), [0] * 7)
+        values[0] += row["n"]
+        values[1] += row["n"] * row["stars"]
+        values[1 + row["stars"]] += row["n"]
+    return expected
+
+
+SUMMARY_FIELDS = ["count", "total", "stars_1", "stars_2", "stars_3", "stars_4", "stars_5"]
+
+
+# Compares Rating_summary with the ratings, a slice of module instances at a time
+# The slice is read without a transaction, a mismatch is counted again inside the
+# transaction that repairs it. The budget is checked before every summary, an
+# unfinished slice is carried on from its first unchecked module instance.
+# Archived years are skipped, their summaries are all that is left of them
+def check_summaries(budget, repair, state):
+    deadline = time.monotonic() + budget
+    archived = list(Archived_year.objects.values_list("year", flat=True))
+    instances = Module_instance.objects.exclude(year__in=archived).order_by("id")
+    position = state.get("check_summaries", 0)
+    checked = mismatched = 0
+
+    while time.monotonic() < deadline:
+        batch = list(instances.filter(id__gt=position).values_list("id", "year")[:SUMMARY_SLICE])
+        if not batch:
+            # Done, start over on the next run
+            position = 0
+            break
+
+        by_alias = {}
+        for module_id, year in batch:
+            by_alias.setdefault(shard_for_year(year), []).append(module_id)
+
+        # (module_id, professor_id) -> alias, expected values, summary
+        found = {}
+        for alias, module_ids in by_alias.items():
+            expected = expected_summaries(alias, module_ids)
+            actual = {
+                (s.professor_id, s.module_id): s
+                for s in Rating_summary.objects.using(alias).filter(module_id__in=module_ids)
+            }
+            for key in expected.keys() | actual.keys():
+                found[(key[1], key[0])] = (alias, expected.get(key, [0] * 7), actual.get(key))
+
+        done = batch[-1][0]
+        for (module_id, professor_id), (alias, values, summary) in sorted(found.items()):
+            if time.monotonic() >= deadline:
+                done = max((i for i, _ in batch if i < module_id), default=position)
+                break
+
+            checked += 1
+            if summary is not None and [getattr(summary, f) for f in SUMMARY_FIELDS] == values:
+                continue
+            if summary is None and not any(values):
+                continue
+
+            mismatched += 1
+            logger.warning("Rating_summary %s on %s is %s, ratings give %s", (professor_id, module_id), alias,
+                           summary and [getattr(summary, f) for f in SUMMARY_FIELDS], values)
+            if repair:
+                repair_summary(alias, professor_id, module_id)
+        position = done
+
+    state["check_summaries"] = position
+    return [{"database": "all", "bytes": 0,
+             "detail": f"{checked} summaries checked, {mismatched} mismatched{' and repaired' if repair and mismatched else ''}"}]
+
+
+# Function for rewriting a summary and its rater sketch from the ratings, in one transaction
+def repair_summary(alias, professor_id, module_id):
+    with transaction.atomic(using=alias):
+        values = expected_summaries(alias, [module_id]).get((professor_id, module_id), [0] * 7)
+        users = Rating.objects.using(alias).filter(
+            professor_id=professor_id, module_id=module_id).values_list("user_id", flat=True)
+        defaults = dict(zip(SUMMARY_FIELDS, values), raters=add_users(None, users))
+        Rating_summary.objects.using(alias).update_or_create(
+            professor_id=professor_id, module_id=module_id, defaults=defaults)
+
+
+# Function for the per day and professor counts of the ratings created in [start, end)
+# Includes the archived ratings, they are still counted in Daily_rating
+def expected_daily(start, end):
+    expected = {}
+
+    def add(day, professor_id, count, total):
+        values = expected.setdefault((day, professor_id), [0, 0])
+        values[0] += count
+        values[1] += total
+
+    low = datetime.combine(start, datetime.min.time(), tzinfo=dt_timezone.utc)
+    high = datetime.combine(end, datetime.min.time(), tzinfo=dt_timezone.utc)
+    for alias in shard_aliases():
+        rows = Rating.objects.using(alias).filter(created_at__gte=low, created_at__lt=high).annotate(
+            day=TruncDate("created_at", tzinfo=dt_timezone.utc)).values("day", "professor_id").annotate(
+            count=Count("id"), total=Sum("stars"))
+        for row in rows:
+            add(row["day"], row["professor_id"], row["count"], row["total"])
+
+    for year in Archived_year.objects.values_list("year", flat=True):
+        path = os.path.join(settings.ARCHIVE_DIR, f"ratings_{year}.sqlite3")
+        if not os.path.exists(path):
+            continue
+        archive = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = archive.execute(
+                "SELECT substr(created_at, 1, 10), professor_id, COUNT(*), SUM(stars) FROM rating "
+                "WHERE created_at >= ? AND created_at < ? GROUP BY 1, 2", [start.isoformat(), end.isoformat()])
+            for day, professor_id, count, total in rows:
+                add(date.fromisoformat(day), professor_id, count, total)
+        finally:
+            archive.close()
+    return expected
+
+
+# Compares Daily_rating with the ratings, DAILY_SLICE_DAYS days at a time
+# Like check_summaries, only repairs run in a transaction and the budget is checked
+# before every rollup, an unfinished slice is carried on from its first unchecked day
+def check_daily(budget, repair, state):
+    deadline = time.monotonic() + budget
+    today = timezone.now().date()
+    firsts = [Daily_rating.objects.order_by("day").values_list("day", flat=True).first()]
+    for alias in shard_aliases():
+        created_at = Rating.objects.using(alias).filter(created_at__isnull=False).order_by(
+            "created_at").values_list("created_at", flat=True).first()
+        firsts.append(created_at and created_at.astimezone(dt_timezone.utc).date())
+    first = min((day for day in firsts if day is not None), default=None)
+    position = state.get("check_daily")
+    start = date.fromisoformat(position) if position else first
+    checked = mismatched = 0
+
+    while start is not None and start <= today and time.monotonic() < deadline:
+        end = start + timedelta(days=DAILY_SLICE_DAYS)
+        expected = expected_daily(start, end)
+        actual = {
+            (d.day, d.professor_id): d
+            for d in Daily_rating.objects.filter(day__gte=start, day__lt=end)
+        }
+        for key in sorted(expected.keys() | actual.keys()):
+            if time.monotonic() >= deadline:
+                end = key[0]
+                break
+
+            values = expected.get(key, [0, 0])
+            daily = actual.get(key)
+            checked += 1
+            if (daily is not None and [daily.count, daily.total] == values) or (daily is None and not any(values)):
+                continue
+
+            mismatched += 1
+            logger.warning("Daily_rating %s is %s, ratings give %s", key,
+                           daily and [daily.count, daily.total], values)
+            if repair:
+                repair_daily(*key)
+        start = end
+
+    # Start over on the next run once today has been checked
+    state["check_daily"] = start.isoformat() if start is not None and start <= today else None
+    return [{"database": "all", "bytes": 0,
+             "detail": f"{checked} rollups checked, {mismatched} mismatched{' and repaired' if repair and mismatched else ''}"}]
+
+
+# Function for rewriting a professor's daily rollup from the ratings, in one transaction
+def repair_daily(day, professor_id):
+    with transaction.atomic(using="default"):
+        values = expected_daily(day, day + timedelta(days=1)).get((day, professor_id), [0, 0])
+        Daily_rating.objects.update_or_create(day=day, professor_id=professor_id,
+                                              defaults={"count": values[0], "total": values[1]})
+
+
+TASK_FUNCTIONS = {
+    "optimize": optimize,
+    "checkpoint": checkpoint,
+    "purge_tokens": purge_tokens,
+    "vacuum": vacuum,
+    "check_summaries": check_summaries,
+    "check_daily": check_daily,
+}
+
+
+# Function for running maintenance tasks, returns one result per task and database
+# Only one process runs maintenance at a time, the others get None. The lock file
+# also keeps where the integrity checks stopped, so the next run carries on.
+def run_maintenance(tasks=None, budget=None, repair=False, blocking=False):
+    budget = settings.MAINTENANCE_TASK_BUDGET if budget is None else budget
+    path = settings.MAINTENANCE_LOCK_FILE
+    with open(path, "a+") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        try:
+            lock.seek(0)
+            try:
+                state = json.loads(lock.read() or "{}")
+            except ValueError:
+                state = {}
+
+            results = []
+            for name in tasks or TASKS:
+                start = time.perf_counter()
+                task_results = TASK_FUNCTIONS[name](budget, repair, state)
+                elapsed = (time.perf_counter() - start) * 1000
+                for result in task_results:
+                    result.update(task=name, ms=round(elapsed, 1))
+                    logger.info("maintenance %s on %s took %.1f ms, reclaimed %d bytes: %s", name,
+                                result["database"], elapsed, result["bytes"], result["detail"])
+                results.extend(task_results)
+
+            lock.seek(0)
+            lock.truncate()
+            lock.write(json.dumps(state))
+            return results
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Optional in-process scheduler, started when MAINTENANCE_INTERVAL is set by one
+# worker of "manage.py serve" and on the ASGI startup event, always after any fork.
+# Every process may run one, the lock file makes sure only one of them does the
+# work each time.
+_scheduler = None
+
+
+def scheduler_loop():
+    while True:
+        time.sleep(settings.MAINTENANCE_INTERVAL)
+        try:
+            run_maintenance()
+        except Exception:
+            logger.exception("maintenance run failed")
+        finally:
+            # This thread's connections are not closed by the request cycle
+            connections.close_all()
+
+
+def start_scheduler():
+    global _scheduler
+    if settings.MAINTENANCE_INTERVAL and _scheduler is None:
+        _scheduler = threading.Thread(target=scheduler_loop, name="maintenance", daemon=True)
+        _scheduler.start()
@@ -0,0 +1,44 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from rate.ingest import APPLIER_LOCK, drain, file_lock
+
+
+# Background applier for the write-behind rating ingestion (RATING_INGEST_ASYNC)
+# Drains the accepted ratings log into the database, by default forever. Only one
+# applier runs per ingest directory, a second one exits straight away.
+class Command(BaseCommand):
+    help = "Apply ratings accepted by the write-behind ingestion log"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Drain the log once and exit")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds to wait between drains")
+        parser.add_argument("--batch-size", type=int, default=settings.RATING_INGEST_BATCH,
+                            help="Ratings applied per transaction")
+
+    def handle(self, *args, **options):
+        try:
+            with file_lock(APPLIER_LOCK, blocking=False):
+                self.run(options)
+        except BlockingIOError:
+            raise CommandError("Another applier is already running")
+
+    def run(self, options):
+        while True:
+            close_old_connections()
+            start = time.perf_counter()
+            try:
+                applied = drain(options["batch_size"])
+            except Exception as e:
+                # Tried again next time, until the segment is quarantined
+                self.stderr.write(f"Applying ratings failed: {e!r}")
+                applied = 0
+            if applied:
+                self.stdout.write(f"Applied {applied} ratings in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
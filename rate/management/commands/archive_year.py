@@ -0,0 +1,163 @@
+import os
+import sqlite3
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from rate.changes import rating_key, record_changes
+from rate.models import Module_instance, Rating, Rating_summary, Archived_year
+from rate.sharding import shard_for_year
+from rate.sketches import build_sketches
+
+# Columns copied to the archive, in order
+ARCHIVE_COLUMNS = ("id", "stars", "previous_stars", "professor_id", "module_id", "user_id", "created_at")
+
+
+# Moves the ratings of a closed academic year out of the live table
+# The rows are copied to ARCHIVE_DIR/ratings_<year>.sqlite3, the summaries of the
+# year are recomputed from the archive so they stay exact, then the live rows are
+# deleted. Every step can be repeated, so an interrupted run is finished by running
+# the command again. The change log gets a delete for every archived rating, so
+# /api/changes/ consumers drop them too.
+class Command(BaseCommand):
+    help = "Archive the ratings of an academic year, leaving only their summaries in the live tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument("year", type=int)
+        parser.add_argument("--chunk-size", type=int, default=5000,
+                            help="Ratings copied and deleted per transaction")
+
+    def handle(self, *args, **options):
+        year = options["year"]
+        chunk_size = options["chunk_size"]
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be at least 1")
+
+        instance_ids = list(Module_instance.objects.filter(year=year).values_list("id", flat=True))
+        if not instance_ids:
+            raise CommandError(f"No module instances for year {year}")
+
+        # Close the year first so no new ratings arrive while it is being moved
+        Archived_year.objects.get_or_create(year=year)
+
+        using = shard_for_year(year)
+        os.makedirs(settings.ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(settings.ARCHIVE_DIR, f"ratings_{year}.sqlite3")
+        archive = sqlite3.connect(path)
+        try:
+            self.create_archive_table(archive)
+
+            live, copied = self.copy_ratings(archive, using, instance_ids, chunk_size)
+            self.stdout.write(f"Copied {copied} of {live} ratings from {using} to {path}, "
+                              f"{live - copied} were archived already")
+
+            # The summaries are not rebuilt and nothing is deleted unless every live rating is in the archive
+            self.verify_archive(archive, using, instance_ids, chunk_size)
+
+            summaries, total = self.rebuild_summaries(archive, using, instance_ids)
+            self.stdout.write(f"Rebuilt {summaries} summaries from {total} archived ratings")
+
+            deleted = self.delete_ratings(archive, using, instance_ids, chunk_size)
+            self.stdout.write(f"Deleted {deleted} ratings from {using}")
+
+            archive.execute("VACUUM")
+        finally:
+            archive.close()
+
+        Archived_year.objects.filter(year=year).update(rating_count=total)
+        self.stdout.write(self.style.SUCCESS(f"Archived year {year}"))
+
+    # Function for creating the archive table, ratings may have no user or creation time (NULL)
+    def create_archive_table(self, archive):
+        with archive:
+            archive.execute(
+                "CREATE TABLE IF NOT EXISTS rating (id INTEGER PRIMARY KEY, stars INTEGER NOT NULL, "
+                "previous_stars INTEGER, professor_id TEXT NOT NULL, module_id INTEGER NOT NULL, "
+                "user_id INTEGER, created_at TEXT)"
+            )
+
+    # Function for copying the year's live ratings to the archive in id order
+    # Rows already in the archive from an earlier run are left as they are, any
+    # other failed insert (a constraint) stops the command.
+    # Returns the number of live ratings and how many of them were copied
+    def copy_ratings(self, archive, using, instance_ids, chunk_size):
+        live = 0
+        copied = 0
+        last_id = 0
+        while True:
+            rows = list(Rating.objects.using(using).filter(module_id__in=instance_ids, id__gt=last_id)
+                        .order_by("id").values_list(*ARCHIVE_COLUMNS)[:chunk_size])
+            if not rows:
+                return live, copied
+
+            with archive:
+                before = archive.total_changes
+                archive.executemany(
+                    f"INSERT INTO rating ({', '.join(ARCHIVE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO NOTHING",
+                    [row[:-1] + (row[-1] and row[-1].isoformat(),) for row in rows]
+                )
+                copied += archive.total_changes - before
+            live += len(rows)
+            last_id = rows[-1][0]
+
+    # Function for checking that every live rating of the year is in the archive
+    def verify_archive(self, archive, using, instance_ids, chunk_size):
+        live = 0
+        archived = 0
+        last_id = 0
+        while True:
+            ids = list(Rating.objects.using(using).filter(module_id__in=instance_ids, id__gt=last_id)
+                       .order_by("id").values_list("id", flat=True)[:chunk_size])
+            if not ids:
+                break
+            placeholders = ", ".join(["?"] * len(ids))
+            archived += archive.execute(f"SELECT COUNT(*) FROM rating WHERE id IN ({placeholders})", ids).fetchone()[0]
+            live += len(ids)
+            last_id = ids[-1]
+
+        if archived != live:
+            raise CommandError(f"Only {archived} of {live} live ratings are in the archive, nothing was changed")
+
+    # Function for replacing the year's summaries with exact counts and rater sketches from the archive
+    # Returns the number of summaries and ratings
+    def rebuild_summaries(self, archive, using, instance_ids):
+        columns = ", ".join(f"SUM(stars = {n})" for n in range(1, 6))
+        groups = archive.execute(
+            f"SELECT professor_id, module_id, COUNT(*), SUM(stars), {columns} FROM rating GROUP BY professor_id, module_id"
+        ).fetchall()
+        sketches = build_sketches(archive.execute("SELECT professor_id, module_id, user_id FROM rating"))
+
+        summaries = [
+            Rating_summary(professor_id=professor_id, module_id=module_id, count=count, total=total,
+                           stars_1=s1, stars_2=s2, stars_3=s3, stars_4=s4, stars_5=s5,
+                           raters=sketches.get((professor_id, module_id)))
+            for professor_id, module_id, count, total, s1, s2, s3, s4, s5 in groups
+        ]
+        with transaction.atomic(using=using):
+            Rating_summary.objects.using(using).filter(module_id__in=instance_ids).delete()
+            Rating_summary.objects.using(using).bulk_create(summaries, batch_size=500)
+
+        return len(summaries), sum(summary.count for summary in summaries)
+
+    # Function for deleting the archived ratings from the live table
+    # Raw deletes skip the rating signals, which would take them off the summaries
+    # and daily rollups again. Only rows present in the archive are deleted, and
+    # only the ones this run deleted are logged as changes.
+    def delete_ratings(self, archive, using, instance_ids, chunk_size):
+        table = Rating._meta.db_table
+        deleted = 0
+        last_id = 0
+        while True:
+            ids = [row[0] for row in archive.execute(
+                "SELECT id FROM rating WHERE id > ? ORDER BY id LIMIT ?", [last_id, chunk_size])]
+            if not ids:
+                return deleted
+
+            placeholders = ", ".join(["%s"] * len(ids))
+            with transaction.atomic(using=using), connections[using].cursor() as cursor:
+                cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders}) RETURNING id", ids)
+                gone = [row[0] for row in cursor.fetchall()]
+                # In the same transaction when the ratings are on default
+                record_changes("rating", [rating_key(using, pk) for pk in gone], "delete")
+            deleted += len(gone)
+            last_id = ids[-1]
@@ -0,0 +1,71 @@
+import time
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from rate.renderers import FastJSONRenderer, MessagePackRenderer, msgpack, orjson
+from rate.encoding import COMPRESSORS, compress
+from rate.snapshots import build_module_list
+
+
+# Benchmarks encoding CPU time and bytes on the wire for the /api/list/ payload
+class Command(BaseCommand):
+    help = "Benchmark response encodings and compression for the module list payload"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--synthetic", type=int, default=0,
+                            help="Use N generated module instances instead of the database")
+        parser.add_argument("--repeat", type=int, default=20,
+                            help="Number of timed runs per format (best run is reported)")
+
+    def handle(self, *args, **options):
+        if options["synthetic"]:
+            payload = synthetic_module_list(options["synthetic"])
+        else:
+            payload = build_module_list()
+
+        renderers = [("json (stdlib)", JSONRenderer())]
+        if orjson is not None:
+            renderers.append(("json (orjson)", FastJSONRenderer()))
+        if msgpack is not None:
+            renderers.append(("msgpack", MessagePackRenderer()))
+
+        self.stdout.write(f"{len(payload['modules'])} module instances, best of {options['repeat']} runs\n")
+        self.stdout.write("{:<16} {:<10} {:>12} {:>12} {:>12}".format(
+            "Format", "Encoding", "Bytes", "Encode ms", "Compress ms"))
+
+        for name, renderer in renderers:
+            encode_time, body = best_time(lambda: renderer.render(payload, renderer.media_type, {}), options["repeat"])
+
+            for encoding in ["identity"] + list(COMPRESSORS):
+                compress_time, compressed = best_time(lambda: compress(body, encoding), options["repeat"])
+                self.stdout.write("{:<16} {:<10} {:>12} {:>12.3f} {:>12.3f}".format(
+                    name, encoding, len(compressed), encode_time * 1000, compress_time * 1000))
+
+
+# Function for timing a callable, returns the fastest run and its result
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+# Function for generating a catalog shaped like build_module_list's output
+def synthetic_module_list(count):
+    modules = []
+    for i in range(count):
+        modules.append({
+            "code": f"M{i % 5000:04d}",
+            "description": f"Synthetic module number {i % 5000}",
+            "year": 2000 + i % 25,
+            "semester": i % 2 + 1,
+            "professors": [
+                {"id": f"P{(i + j) % 900:03d}", "name": f"Professor Number {(i + j) % 900}"}
+                for j in range(i % 3 + 1)
+            ]
+        })
+    return {"modules": modules}
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from rate.maintenance import TASKS, enable_incremental_vacuum, run_maintenance
+
+
+# Runs the database maintenance tasks once, each within a time budget
+class Command(BaseCommand):
+    help = "Refresh statistics, checkpoint, vacuum, purge expired tokens and check the derived rating data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--task", action="append", choices=TASKS,
+                            help="Task to run, can be repeated (default all)")
+        parser.add_argument("--budget", type=float,
+                            help="Seconds each task may work for (default MAINTENANCE_TASK_BUDGET)")
+        parser.add_argument("--repair", action="store_true",
+                            help="Fix summaries and daily rollups that don't match the ratings")
+        parser.add_argument("--wait", action="store_true",
+                            help="Wait for a maintenance run in another process instead of exiting")
+        parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                            help="Switch the databases to incremental vacuum, runs a full VACUUM once")
+
+    def handle(self, *args, **options):
+        results = []
+        if options["enable_incremental_vacuum"]:
+            results += enable_incremental_vacuum()
+
+        run = run_maintenance(options["task"], options["budget"], options["repair"], blocking=options["wait"])
+        if run is None:
+            raise CommandError("Maintenance is already running in another process")
+        results += run
+
+        self.stdout.write("{:<26} {:<14} {:>10} {:>12}  {}".format("Task", "Database", "ms", "Reclaimed", "Detail"))
+        for result in results:
+            self.stdout.write("{:<26} {:<14} {:>10.1f} {:>12}  {}".format(
+                result["task"], result["database"], result["ms"], result["bytes"], result["detail"]))
@@ -0,0 +1,140 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max
+from rate.changes import rating_key, record_changes
+from rate.maintenance import SUMMARY_FIELDS, expected_summaries
+from rate.models import Module_instance, Rating, Rating_summary, Archived_year, Shard_map
+from rate.sharding import SHARD_MAP_TTL, holds_ratings, reload_shard_map, shard_aliases
+from rate.sketches import build_sketches, merge
+
+# Columns copied to the new shard, the id is given by the new shard
+MOVED_COLUMNS = ("stars", "previous_stars", "professor_id", "module_id", "user_id", "created_at")
+
+
+# Moves the ratings and summaries of an academic year to another rating shard
+# The year is routed to the new shard first and, once every process has read the
+# new shard map, the ratings are copied over and deleted from wherever they are
+# left. Ratings get new ids on the new shard, the change log deletes the old keys
+# and upserts the new ones. A rating whose user rated again on the new shard in the
+# meantime is dropped, the newer one is kept. Every step can be repeated, so an
+# interrupted run is finished by running the command again (ratings without a user
+# copied just before the interruption are the exception, they may end up twice).
+class Command(BaseCommand):
+    help = "Move the ratings and summaries of an academic year to another rating shard"
+
+    def add_arguments(self, parser):
+        parser.add_argument("year", type=int)
+        parser.add_argument("alias", help="Database in RATING_SHARDS, or default")
+        parser.add_argument("--chunk-size", type=int, default=5000,
+                            help="Ratings copied and deleted per transaction")
+        parser.add_argument("--wait", type=float, default=SHARD_MAP_TTL,
+                            help="Seconds to wait for the other processes to read the new shard map")
+
+    def handle(self, *args, **options):
+        year = options["year"]
+        target = options["alias"]
+        chunk_size = options["chunk_size"]
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be at least 1")
+        if target not in shard_aliases():
+            raise CommandError(f"{target} is not in RATING_SHARDS")
+
+        instance_ids = list(Module_instance.objects.filter(year=year).values_list("id", flat=True))
+        if not instance_ids:
+            raise CommandError(f"No module instances for year {year}")
+
+        # New ratings land on the target from now on
+        if target == "default":
+            Shard_map.objects.filter(key=str(year)).delete()
+        else:
+            Shard_map.objects.update_or_create(key=str(year), defaults={"alias": target})
+        reload_shard_map()
+        if options["wait"] > 0:
+            self.stdout.write(f"Waiting {options['wait']:.0f} s for every process to route {year} to {target}")
+            time.sleep(options["wait"])
+
+        sources = [alias for alias in shard_aliases() if alias != target and holds_ratings(alias, instance_ids)]
+        for source in sources:
+            moved, dropped = self.move_ratings(source, target, instance_ids, chunk_size)
+            self.stdout.write(f"Moved {moved} ratings from {source} to {target}, "
+                              f"dropped {dropped} rated again on {target}")
+
+        # Archived years have no ratings left to count, their summaries are carried over
+        if Archived_year.objects.filter(year=year).exists():
+            summaries = self.copy_summaries(sources, target, instance_ids)
+        else:
+            summaries = self.rebuild_summaries(target, instance_ids)
+        for source in sources:
+            Rating_summary.objects.using(source).filter(module_id__in=instance_ids).delete()
+        self.stdout.write(f"Wrote {summaries} summaries on {target}")
+
+        self.stdout.write(self.style.SUCCESS(f"Moved year {year} to {target}"))
+
+    # Function for moving the year's ratings from one shard to another in id order
+    # Raw deletes skip the rating signals, the summaries are rebuilt afterwards.
+    # Returns the number of ratings moved and dropped as duplicates
+    def move_ratings(self, source, target, instance_ids, chunk_size):
+        table = Rating._meta.db_table
+        moved = 0
+        dropped = 0
+        while True:
+            rows = list(Rating.objects.using(source).filter(module_id__in=instance_ids)
+                        .order_by("id").values_list("id", *MOVED_COLUMNS)[:chunk_size])
+            if not rows:
+                return moved, dropped
+
+            with transaction.atomic(using=target):
+                last_id = Rating.objects.using(target).aggregate(last=Max("id"))["last"] or 0
+                Rating.objects.using(target).bulk_create(
+                    [Rating(**dict(zip(MOVED_COLUMNS, row[1:]))) for row in rows], ignore_conflicts=True)
+                new_ids = list(Rating.objects.using(target).filter(module_id__in=instance_ids, id__gt=last_id)
+                               .values_list("id", flat=True))
+
+            ids = [row[0] for row in rows]
+            placeholders = ", ".join(["%s"] * len(ids))
+            with transaction.atomic(using=source), connections[source].cursor() as cursor:
+                cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+
+            record_changes("rating", [rating_key(source, pk) for pk in ids], "delete")
+            record_changes("rating", [rating_key(target, pk) for pk in new_ids], "upsert")
+            moved += len(new_ids)
+            dropped += len(rows) - len(new_ids)
+
+    # Function for replacing the year's summaries on the target with exact counts and rater sketches
+    # Returns the number of summaries
+    def rebuild_summaries(self, target, instance_ids):
+        with transaction.atomic(using=target):
+            Rating_summary.objects.using(target).filter(module_id__in=instance_ids).delete()
+            expected = expected_summaries(target, instance_ids)
+            sketches = build_sketches(Rating.objects.using(target).filter(module_id__in=instance_ids)
+                                      .values_list("professor_id", "module_id", "user_id"))
+            Rating_summary.objects.using(target).bulk_create([
+                Rating_summary(professor_id=professor_id, module_id=module_id, raters=sketches.get((professor_id, module_id)),
+                               **dict(zip(SUMMARY_FIELDS, values)))
+                for (professor_id, module_id), values in expected.items()
+            ], batch_size=500)
+        return len(expected)
+
+    # Function for replacing the year's summaries on the target with the ones on the sources
+    # A closed year gets no new ratings, so the target has none of its own.
+    # Returns the number of summaries
+    def copy_summaries(self, sources, target, instance_ids):
+        if not sources:
+            return 0
+        with transaction.atomic(using=target):
+            merged = {}
+            for alias in sources:
+                for summary in Rating_summary.objects.using(alias).filter(module_id__in=instance_ids):
+                    values, sketches = merged.setdefault((summary.professor_id, summary.module_id), ([0] * 7, []))
+                    for i, field in enumerate(SUMMARY_FIELDS):
+                        values[i] += getattr(summary, field)
+                    sketches.append(summary.raters)
+
+            Rating_summary.objects.using(target).filter(module_id__in=instance_ids).delete()
+            Rating_summary.objects.using(target).bulk_create([
+                Rating_summary(professor_id=professor_id, module_id=module_id, raters=merge(sketches),
+                               **dict(zip(SUMMARY_FIELDS, values)))
+                for (professor_id, module_id), (values, sketches) in merged.items()
+            ], batch_size=500)
+        return len(merged)
@@ -0,0 +1,68 @@
+import csv
+import os
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rate.provisioning import USER_COLUMNS, provision_users
+
+# Columns of the results file
+RESULT_COLUMNS = ["username", "email", "status", "error", "id", "password", "token"]
+
+
+# Creates the accounts of a cohort from a CSV file in bulk
+# The file has the columns username,email,password (optionally with a header row),
+# an empty password gets a generated one. The outcome of every row is written as
+# CSV, with the generated passwords and issued tokens, so keep the output private.
+class Command(BaseCommand):
+    help = "Create user accounts in bulk from a CSV file of username,email,password"
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file", help="CSV file to read, - for standard input")
+        parser.add_argument("--output", help="Write the results CSV here instead of standard output")
+        parser.add_argument("--tokens", action="store_true", help="Issue an API token for every new account")
+        parser.add_argument("--workers", type=int,
+                            help="Processes hashing passwords (default the number of CPU cores)")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Accounts inserted per transaction")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only check the accounts for errors and conflicts")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1 or (options["workers"] is not None and options["workers"] < 1):
+            raise CommandError("--batch-size and --workers must be at least 1")
+
+        accounts = self.read_accounts(options["csv_file"])
+        start = time.perf_counter()
+        results = provision_users(accounts, issue_tokens=options["tokens"], workers=options["workers"],
+                                  batch_size=options["batch_size"], dry_run=options["dry_run"])
+        elapsed = time.perf_counter() - start
+
+        output = open(options["output"], "w", newline="") if options["output"] else self.stdout
+        try:
+            writer = csv.DictWriter(output, RESULT_COLUMNS, extrasaction="ignore", lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(results)
+        finally:
+            if options["output"]:
+                output.close()
+
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "no accounts"
+        self.stderr.write(f"{len(results)} accounts in {elapsed:.1f} s: {summary}")
+
+    # Function for reading the accounts, a first row of column names is skipped
+    def read_accounts(self, path):
+        if path != "-" and not os.path.exists(path):
+            raise CommandError(f"{path} not found")
+
+        source = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8-sig")
+        try:
+            rows = [row for row in csv.reader(source) if any(cell.strip() for cell in row)]
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        if rows and [cell.strip().lower() for cell in rows[0]][:2] == USER_COLUMNS[:2]:
+            rows = rows[1:]
+        return [dict(zip(USER_COLUMNS, row)) for row in rows]
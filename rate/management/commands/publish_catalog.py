@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rate.snapshots import publish_catalog
+
+
+# Publishes the catalog snapshot files /api/list/ is served from
+# Catalog changes made through the ORM are published on their own, run this after
+# changing the catalog any other way (raw SQL, restoring a backup)
+class Command(BaseCommand):
+    help = "Render the catalog behind /api/list/ to versioned, pre-compressed snapshot files"
+
+    def handle(self, *args, **options):
+        if not settings.CATALOG_SNAPSHOT_DIR:
+            raise CommandError("CATALOG_SNAPSHOT_DIR is not set")
+
+        manifest = publish_catalog()
+        for name, formats in sorted(manifest["files"].items()):
+            for fmt, entry in sorted(formats.items()):
+                encodings = ", ".join(entry["encodings"]) or "no compression"
+                self.stdout.write(f"{name:>5} {fmt:<6} {entry['file']} ({encodings})")
+        self.stdout.write(f"Published to {settings.CATALOG_SNAPSHOT_DIR}")
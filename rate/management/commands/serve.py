@@ -0,0 +1,290 @@
+import os
+import random
+import select
+import signal
+import sys
+import time
+from io import BytesIO
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer, get_internal_wsgi_application
+from django.db import connections
+from django.urls import get_resolver
+from rate.accesslog import flush_access_log
+from rate.maintenance import start_scheduler
+from rate.sharding import close_pool
+from rate.snapshots import publish_catalog
+
+
+# WSGI server that counts the requests it has handled, for recycling
+# handle_request() only waits for a connection up to timeout, the workers do
+# their own waiting so they can notice SIGTERM
+class PreforkWSGIServer(WSGIServer):
+    requests = 0
+    timeout = 0
+
+    def process_request(self, request, client_address):
+        self.requests += 1
+        super().process_request(request, client_address)
+
+
+# Request handler that stays quiet unless access logging is asked for
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    access_log = False
+
+    def log_message(self, format, *args):
+        if self.access_log:
+            super().log_message(format, *args)
+
+
+# Preforking WSGI server for production
+# The master loads Django and the WSGI app, resolves the URLconf and runs the
+# warm-up requests before forking, so every worker starts with the code, URL
+# resolver and encoded caches already in (copy-on-write shared) memory. Each
+# worker warms its own database connections before accepting, and exits after
+# --max-requests (plus jitter) so the master can replace it. With MAINTENANCE_INTERVAL
+# set, one worker at a time runs the maintenance scheduler thread, the master forks
+# no threads.
+class Command(BaseCommand):
+    help = "Run the app on a preforking WSGI server with warmed-up workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("addrport", nargs="?", default="127.0.0.1:8000",
+                            help="Address and port to listen on")
+        parser.add_argument("--workers", type=int, default=0,
+                            help="Worker processes (default 2 x usable CPU cores + 1)")
+        parser.add_argument("--max-requests", type=int, default=1000,
+                            help="Requests a worker handles before it is replaced, 0 for never")
+        parser.add_argument("--max-requests-jitter", type=int, default=50,
+                            help="Random extra requests per worker, so they don't all restart together")
+        parser.add_argument("--graceful-timeout", type=float, default=30,
+                            help="Seconds workers get to finish their request on shutdown")
+        parser.add_argument("--access-log", action="store_true",
+                            help="Log every request")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        host, _, port = options["addrport"].rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            raise CommandError(f"{options['addrport']} is not a valid address:port")
+        host = host.strip("[]") or "127.0.0.1"
+
+        self.options = options
+        self.workers = {}
+        self.scheduler_pid = None
+        self.stopping = False
+        worker_count = options["workers"] or default_worker_count()
+        QuietWSGIRequestHandler.access_log = options["access_log"]
+
+        # Preload: import the app and populate the URL resolver once, in the master
+        self.application = get_internal_wsgi_application()
+        get_resolver().url_patterns
+        preloaded = time.perf_counter()
+
+        # Start from a snapshot of the catalog as it is now, the catalog may have
+        # changed while no server was running
+        if settings.CATALOG_SNAPSHOT_DIR:
+            manifest = publish_catalog()
+            self.stdout.write(f"Published catalog snapshot {manifest['files']['all']['json']['file']}")
+
+        warmed = self.warm_up()
+        warm_up_done = time.perf_counter()
+        self.stdout.write(f"Warmed up {warmed} of {len(settings.SERVE_WARMUP_PATHS)} paths")
+
+        # SQLite connections (and the in-memory replica snapshot) must not cross a fork,
+        # and neither may the threads the warm-up started: the shard fan-out pool and
+        # the access log writer. Workers start their own.
+        connections.close_all()
+        close_pool()
+        flush_access_log()
+
+        self.server = PreforkWSGIServer((host, port), QuietWSGIRequestHandler, ipv6=":" in host)
+        self.server.set_app(self.application)
+        # Workers share the listening socket, the ones that lose an accept go back to waiting
+        self.server.socket.setblocking(False)
+
+        self.ready_read, self.ready_write = os.pipe()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for n in range(worker_count):
+            self.spawn(scheduler=n == 0)
+        ready = self.wait_ready(worker_count)
+        done = time.perf_counter()
+
+        self.stdout.write(
+            f"Serving on http://{options['addrport']} with {ready}/{worker_count} workers, "
+            f"ready in {(done - start) * 1000:.0f} ms "
+            f"(preload {(preloaded - start) * 1000:.0f} ms, warm-up {(warm_up_done - preloaded) * 1000:.0f} ms, "
+            f"workers {(done - warm_up_done) * 1000:.0f} ms)"
+        )
+        self.stdout.flush()
+
+        self.supervise()
+
+    # Function for sending the warm-up requests through the app in the master
+    # Primes the import of every view, the renderers and the encoded caches
+    def warm_up(self):
+        warmed = 0
+        for path in settings.SERVE_WARMUP_PATHS:
+            status = call_application(self.application, path)
+            if status.startswith("2"):
+                warmed += 1
+            else:
+                self.stderr.write(f"Warm-up request to {path} returned {status}")
+        return warmed
+
+    def spawn(self, scheduler=False):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            if scheduler:
+                self.scheduler_pid = pid
+            return
+
+        # Worker, never returns
+        code = 0
+        try:
+            self.run_worker(scheduler)
+        except Exception:
+            code = 1
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    def run_worker(self, scheduler):
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+        # Ctrl-C reaches the whole process group, the master shuts the workers down
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        os.close(self.ready_read)
+        random.seed()
+
+        # Open this worker's database connections (and load the replica snapshot)
+        # before it takes traffic, then tell the master it is ready
+        for path in settings.SERVE_WARMUP_PATHS[:1]:
+            call_application(self.application, path)
+        os.write(self.ready_write, b".")
+        os.close(self.ready_write)
+        if scheduler:
+            start_scheduler()
+
+        max_requests = self.options["max_requests"]
+        if max_requests:
+            max_requests += random.randint(0, self.options["max_requests_jitter"])
+
+        # Wake up every second to notice SIGTERM, a worker that loses the accept race gets
+        # BlockingIOError, which the server ignores
+        while not stopping and not (max_requests and self.server.requests >= max_requests):
+            if select.select([self.server.socket], [], [], 1.0)[0]:
+                self.server.handle_request()
+        connections.close_all()
+        # The worker exits with os._exit, which skips the logging shutdown
+        flush_access_log()
+
+    # Function for waiting until the workers have warmed up, returns how many did
+    def wait_ready(self, count):
+        ready = 0
+        deadline = time.monotonic() + 60
+        while ready < count and time.monotonic() < deadline and not self.stopping:
+            readable, _, _ = select.select([self.ready_read], [], [], 0.5)
+            if readable:
+                ready += len(os.read(self.ready_read, count - ready))
+        return ready
+
+    # Master loop: replaces workers that exit until asked to stop
+    def supervise(self):
+        while not self.stopping:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+
+            started = self.workers.pop(pid, None)
+            if started is not None and not self.stopping:
+                if os.waitstatus_to_exitcode(status) != 0:
+                    self.stderr.write(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}")
+                    # Don't fork in a tight loop when workers die straight away
+                    if time.monotonic() - started < 1:
+                        time.sleep(1)
+                # The scheduler moves on to the replacement
+                self.spawn(scheduler=pid == self.scheduler_pid)
+                self.drain_ready()
+
+        self.shutdown()
+
+    def drain_ready(self):
+        while select.select([self.ready_read], [], [], 0)[0]:
+            os.read(self.ready_read, 1024)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    # Function for stopping the workers, they finish the request they are on
+    def shutdown(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + self.options["graceful_timeout"]
+        while self.workers and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.workers.pop(pid, None)
+            else:
+                time.sleep(0.1)
+
+        for pid in self.workers:
+            os.kill(pid, signal.SIGKILL)
+        self.server.server_close()
+        self.stdout.write("Stopped")
+
+
+# Function for the default worker count, from the CPU cores this process may use
+def default_worker_count():
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return 2 * cores + 1
+
+
+# Function for calling the WSGI app with a synthetic GET request, returns the status line
+def call_application(application, path):
+    allowed = [host for host in settings.ALLOWED_HOSTS if "*" not in host and not host.startswith(".")]
+    host = allowed[0] if allowed else "localhost"
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": host,
+        "SERVER_PORT": "80",
+        "HTTP_HOST": host,
+        "HTTP_ACCEPT": "application/json",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result["status"] = status
+
+    body = application(environ, start_response)
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+    return result.get("status", "500")
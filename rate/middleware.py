@@ -0,0 +1,193 @@
+import random
+import time
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.db import connections
+from django.utils.module_loading import import_string
+from .accesslog import RequestTimings, access_log_handler, logger as access_logger
+from .encoding import compress_response
+from .admission import AdmissionState, admission_state, classify, client_key, rejected
+from .nplusone import detect_nplusone
+
+
+# Compresses response bodies with gzip, brotli or zstd depending on Accept-Encoding
+# Bodies smaller than RESPONSE_COMPRESSION_MIN_SIZE and responses that are
+# already encoded (e.g. served from the encoded cache) are left untouched
+class CompressionMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        return compress_response(request, response)
+
+
+# Reports repeated queries per request when NPLUSONE_DETECTION is "warn" or "raise"
+# Off by default, and then removed from the stack entirely
+class NPlusOneMiddleware:
+
+    def __init__(self, get_response):
+        if not settings.NPLUSONE_DETECTION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with detect_nplusone(settings.NPLUSONE_DETECTION, label=f"{request.method} {request.path}"):
+            return self.get_response(request)
+
+
+# Structured access log, one JSON line per request (see rate/accesslog.py)
+# Off unless ACCESS_LOG_FILE is set. ACCESS_LOG_SAMPLE_RATE of the requests are
+# logged with their phase timings, server errors are always logged (without them
+# when the request wasn't sampled). Lines are written by a background thread.
+class AccessLogMiddleware:
+
+    def __init__(self, get_response):
+        if not settings.ACCESS_LOG_FILE:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.handler = access_log_handler()
+        self.sample_rate = settings.ACCESS_LOG_SAMPLE_RATE
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        timings = None
+        if random.random() < self.sample_rate:
+            timings = request._access_timings = RequestTimings()
+            wrappers = [connection.execute_wrappers for connection in connections.all()]
+            for execute_wrappers in wrappers:
+                execute_wrappers.append(timings)
+
+        try:
+            response = self.get_response(request)
+        finally:
+            if timings is not None:
+                timings.switch(None)
+                for execute_wrappers in wrappers:
+                    execute_wrappers.remove(timings)
+
+        if timings is not None or response.status_code >= 500:
+            self.log(request, response, time.perf_counter() - start, timings)
+        return response
+
+    # The view (and DRF authentication inside it) counts as validation until another phase starts
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timings = getattr(request, "_access_timings", None)
+        if timings is not None:
+            timings.switch("validation")
+        return None
+
+    # DRF responses are rendered after this, until the post render callback
+    def process_template_response(self, request, response):
+        timings = getattr(request, "_access_timings", None)
+        if timings is not None:
+            timings.switch("render")
+            response.add_post_render_callback(timings.rendered)
+        return response
+
+    def log(self, request, response, seconds, timings):
+        user = getattr(request, "user", None)
+        match = request.resolver_match
+        content_length = request.META.get("CONTENT_LENGTH") or ""
+        record = {
+            "time": datetime.now(dt_timezone.utc).isoformat(timespec="milliseconds"),
+            "method": request.method,
+            "path": request.path,
+            "endpoint": match.route if match else None,
+            "status": response.status_code,
+            "user": user.pk if user is not None and user.is_authenticated else None,
+            "request_bytes": int(content_length) if content_length.isdigit() else 0,
+            "response_bytes": None if response.streaming else len(response.content),
+            "total_ms": round(seconds * 1000, 3),
+            "sample_rate": self.sample_rate if timings is not None else None,
+        }
+        if timings is not None:
+            record.update(timings.fields())
+        access_logger.info(record)
+
+
+# Admission control for the API (see rate/admission.py)
+# Every controlled request takes a token from its client's bucket (429 when it
+# is empty), then a slot in its class. A class at its concurrency limit queues
+# the request briefly, and sheds it with 503 when the queue is full or the wait
+# runs out. Both carry Retry-After. Classes without a limit are never shed.
+class AdmissionMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Created here so that "manage.py serve" shares it with the workers it forks
+        self.state = admission_state()
+
+    def __call__(self, request):
+        match = classify(request.path_info)
+        if match is None:
+            return self.get_response(request)
+        index, name, config = match
+
+        rate = settings.ADMISSION_RATE_LIMIT
+        if rate:
+            wait = self.state.take_token(client_key(request), rate["rate"], rate["burst"])
+            if wait:
+                return rejected("Too many requests, slow down", 429, wait)
+
+        admitted = self.state.acquire(index, config)
+        if not admitted:
+            return rejected(f"Server busy, {name} requests are being shed", 503, settings.ADMISSION_RETRY_AFTER)
+        try:
+            return self.get_response(request)
+        finally:
+            if admitted is not AdmissionState.UNCOUNTED:
+                self.state.release(index)
+
+
+# Runs the SITE_MIDDLEWARE stack (sessions, CSRF, auth, messages, clickjacking)
+# for every path except those under LEAN_PATH_PREFIXES
+# The JSON API authenticates with DRF tokens and never uses sessions or messages,
+# so its requests skip those middleware entirely. The admin and any other pages
+# get the full stack, including its process_view and process_exception hooks.
+class PathDispatchMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.lean_prefixes = tuple(settings.LEAN_PATH_PREFIXES)
+
+        self.view_hooks = []
+        self.exception_hooks = []
+        handler = get_response
+        for middleware_path in reversed(settings.SITE_MIDDLEWARE):
+            middleware = import_string(middleware_path)(handler)
+            if hasattr(middleware, "process_view"):
+                self.view_hooks.insert(0, middleware.process_view)
+            if hasattr(middleware, "process_exception"):
+                self.exception_hooks.append(middleware.process_exception)
+            handler = convert_exception_to_response(middleware)
+        self.site_handler = handler
+
+    def is_lean(self, request):
+        return request.path_info.startswith(self.lean_prefixes)
+
+    def __call__(self, request):
+        if self.is_lean(request):
+            return self.get_response(request)
+        return self.site_handler(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.is_lean(request):
+            return None
+        for hook in self.view_hooks:
+            response = hook(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    def process_exception(self, request, exception):
+        if self.is_lean(request):
+            return None
+        for hook in self.exception_hooks:
+            response = hook(request, exception)
+            if response is not None:
+                return response
+        return None
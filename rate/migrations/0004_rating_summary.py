@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+# Build the summaries for ratings that already exist
+def backfill_summaries(apps, schema_editor):
+    Rating = apps.get_model('rate', 'Rating')
+    Rating_summary = apps.get_model('rate', 'Rating_summary')
+    db = schema_editor.connection.alias
+
+    groups = Rating.objects.using(db).values('professor_id', 'module_id').annotate(count=Count('id'), total=Sum('stars'))
+    Rating_summary.objects.using(db).bulk_create([
+        Rating_summary(professor_id=g['professor_id'], module_id=g['module_id'], count=g['count'], total=g['total'])
+        for g in groups
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0003_alter_professor_id_alter_professor_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rating',
+            name='previous_stars',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='Rating_summary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0)),
+                ('module', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rate.module_instance')),
+                ('professor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rate.professor')),
+            ],
+            options={
+                'unique_together': {('professor', 'module')},
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
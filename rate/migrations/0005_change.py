@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:20
+
+from django.db import migrations, models
+
+
+# Seed the log with every existing row so a consumer starting at since=0 gets a full copy
+def backfill_changes(apps, schema_editor):
+    Change = apps.get_model('rate', 'Change')
+    db = schema_editor.connection.alias
+
+    for entity, model in [('professor', 'Professor'), ('module', 'Module'),
+                          ('module_instance', 'Module_instance'), ('rating', 'Rating')]:
+        keys = apps.get_model('rate', model).objects.using(db).values_list('pk', flat=True).order_by('pk')
+        Change.objects.using(db).bulk_create(
+            [Change(entity=entity, key=str(key), op='upsert') for key in keys], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0004_rating_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('entity', models.CharField(max_length=20)),
+                ('key', models.CharField(max_length=64)),
+                ('op', models.CharField(choices=[('upsert', 'upsert'), ('delete', 'delete')], max_length=6)),
+            ],
+        ),
+        migrations.RunPython(backfill_changes, migrations.RunPython.noop),
+    ]
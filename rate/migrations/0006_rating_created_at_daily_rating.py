@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:22
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0005_change'),
+    ]
+
+    operations = [
+        # Existing ratings were made at a time nobody recorded, they are added without one
+        # (and left out of the daily rollups) before new ratings default to the current time
+        migrations.AddField(
+            model_name='rating',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='rating',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.CreateModel(
+            name='Daily_rating',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('total', models.IntegerField(default=0)),
+                ('professor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rate.professor')),
+            ],
+            options={
+                'unique_together': {('day', 'professor')},
+            },
+        ),
+    ]
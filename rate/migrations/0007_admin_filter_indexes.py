@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0006_rating_created_at_daily_rating'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='module_instance',
+            index=models.Index(fields=['year', 'sem'], name='rate_module_year_2211eb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['stars'], name='rate_rating_stars_647c62_idx'),
+        ),
+    ]
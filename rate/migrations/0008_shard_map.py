@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0007_admin_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Shard_map',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=20, unique=True)),
+                ('alias', models.CharField(max_length=40)),
+            ],
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:27
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# Fill in the star histograms of the existing summaries
+def backfill_histograms(apps, schema_editor):
+    Rating = apps.get_model('rate', 'Rating')
+    Rating_summary = apps.get_model('rate', 'Rating_summary')
+    db = schema_editor.connection.alias
+
+    histograms = {}
+    for g in Rating.objects.using(db).values('professor_id', 'module_id', 'stars').annotate(n=Count('id')):
+        histograms.setdefault((g['professor_id'], g['module_id']), {})[g['stars']] = g['n']
+
+    summaries = list(Rating_summary.objects.using(db).all())
+    for summary in summaries:
+        histogram = histograms.get((summary.professor_id, summary.module_id), {})
+        for n in range(1, 6):
+            setattr(summary, f'stars_{n}', histogram.get(n, 0))
+    Rating_summary.objects.using(db).bulk_update(summaries, [f'stars_{n}' for n in range(1, 6)], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0008_shard_map'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Archived_year',
+            fields=[
+                ('year', models.IntegerField(primary_key=True, serialize=False)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('rating_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='rating_summary',
+            name='stars_1',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rating_summary',
+            name='stars_2',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rating_summary',
+            name='stars_3',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rating_summary',
+            name='stars_4',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rating_summary',
+            name='stars_5',
+            field=models.IntegerField(default=0),
+        ),
+        # Hinted so it also runs on the rating shards
+        migrations.RunPython(backfill_histograms, migrations.RunPython.noop, hints={'model_name': 'rating_summary'}),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0009_rating_histogram_archived_year'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rating_receipt',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('applied', 'applied'), ('rejected', 'rejected')], max_length=8)),
+                ('error', models.CharField(blank=True, max_length=200)),
+                ('applied_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:56
+
+import hashlib
+
+from django.db import migrations, models
+
+# Copied from rate/sketches.py as it was when this migration was written, so later
+# changes there don't change what this migration does. The sketches must match
+# the ones rate/sketches.py builds with the same PRECISION.
+PRECISION = 10
+SKETCH_SIZE = 1 << PRECISION
+_RANK_BITS = 64 - PRECISION
+
+
+def register_rank(user_id):
+    value = int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), "big")
+    rest = value & ((1 << _RANK_BITS) - 1)
+    return value >> _RANK_BITS, _RANK_BITS - rest.bit_length() + 1
+
+
+def add_users(sketch, user_ids):
+    registers = None
+    for user_id in user_ids:
+        if user_id is None:
+            continue
+        index, rank = register_rank(user_id)
+        current = registers if registers is not None else sketch
+        if current is not None and current[index] >= rank:
+            continue
+        if registers is None:
+            registers = bytearray(sketch) if sketch is not None else bytearray(SKETCH_SIZE)
+        registers[index] = rank
+    return sketch if registers is None else bytes(registers)
+
+
+def build_sketches(rows):
+    users = {}
+    for professor_id, module_id, user_id in rows:
+        users.setdefault((professor_id, module_id), []).append(user_id)
+    return {key: add_users(None, user_ids) for key, user_ids in users.items()}
+
+
+# Build the rater sketches of the existing summaries from their ratings
+def backfill_raters(apps, schema_editor):
+    Rating = apps.get_model('rate', 'Rating')
+    Rating_summary = apps.get_model('rate', 'Rating_summary')
+    db = schema_editor.connection.alias
+
+    sketches = build_sketches(
+        Rating.objects.using(db).values_list('professor_id', 'module_id', 'user_id').iterator(chunk_size=5000))
+
+    summaries = list(Rating_summary.objects.using(db).all())
+    for summary in summaries:
+        summary.raters = sketches.get((summary.professor_id, summary.module_id))
+    Rating_summary.objects.using(db).bulk_update(summaries, ['raters'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0010_rating_receipt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rating_summary',
+            name='raters',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(backfill_raters, migrations.RunPython.noop, hints={'model_name': 'rating_summary'}),
+    ]
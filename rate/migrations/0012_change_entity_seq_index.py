@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rate', '0011_rating_summary_raters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['entity', 'seq'], name='rate_change_entity_d5078d_idx'),
+        ),
+    ]
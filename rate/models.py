@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 # Create your models here.
 class Professor (models.Model):
@@ -21,19 +23,144 @@ class Module_instance (models.Model):
     year = models.IntegerField()
     sem = models.IntegerField(choices={1:"1",2:"2"}, null=True)
     mod = models.ForeignKey(Module, on_delete=models.PROTECT)
+
+    class Meta:
+        # Used by the admin year/semester filters
+        indexes = [models.Index(fields=['year', 'sem'])]
     
     def __str__ (self):
         return f"{self.mod.code} {self.year} {self.sem}"
 
+    # A new year may live on another rating shard, the ratings would be left behind on the old one
+    def clean(self):
+        from .sharding import shard_for_year, holds_ratings
+
+        if self.pk is None:
+            return
+        old_year = Module_instance.objects.filter(pk=self.pk).values_list("year", flat=True).first()
+        if old_year is None or old_year == self.year:
+            return
+        old_alias = shard_for_year(old_year)
+        if old_alias != shard_for_year(self.year) and holds_ratings(old_alias, [self.pk]):
+            raise ValidationError({"year": f"{old_year} and {self.year} are on different rating shards "
+                                           f"and this module instance has ratings on {old_alias}"})
+
 
 class Rating (models.Model):
     stars = models.IntegerField()
     professor = models.ForeignKey(Professor, on_delete=models.PROTECT)
     module = models.ForeignKey(Module_instance, on_delete=models.PROTECT)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    # Stars before the last upsert, lets the upsert return old and new stars in one statement
+    previous_stars = models.IntegerField(null=True, editable=False)
+    # None for ratings made before creation times were recorded, they have no daily rollup
+    created_at = models.DateTimeField(default=timezone.now, db_index=True, null=True)
     
     class Meta:
         # Ensure a user can only rate a specific professor for a specific module instance once
         unique_together = ('user', 'professor', 'module')
+        # Used by the admin stars filter
+        indexes = [models.Index(fields=['stars'])]
+
+
+# Running count, sum and histogram of stars per professor per module instance
+# Kept up to date with deltas on every rating write (see rate/ratings.py), and the
+# only record left of ratings that have been archived. raters is a HyperLogLog
+# sketch of the users who rated (see rate/sketches.py), None before the first.
+class Rating_summary (models.Model):
+    professor = models.ForeignKey(Professor, on_delete=models.CASCADE)
+    module = models.ForeignKey(Module_instance, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    stars_1 = models.IntegerField(default=0)
+    stars_2 = models.IntegerField(default=0)
+    stars_3 = models.IntegerField(default=0)
+    stars_4 = models.IntegerField(default=0)
+    stars_5 = models.IntegerField(default=0)
+    raters = models.BinaryField(null=True, editable=False)
+
+    class Meta:
+        unique_together = ('professor', 'module')
+
+
+# Count and sum of stars per professor per day the ratings were created
+# Windowed averages read these instead of scanning ratings (see rate/ratings.py)
+class Daily_rating (models.Model):
+    day = models.DateField()
+    professor = models.ForeignKey(Professor, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'professor')
+
+
+# Append-only log of row changes, seq is a monotonic cursor for /api/changes/
+class Change (models.Model):
+    OPS = {"upsert": "upsert", "delete": "delete"}
+
+    seq = models.BigAutoField(primary_key=True)
+    entity = models.CharField(max_length=20)
+    key = models.CharField(max_length=64)
+    op = models.CharField(max_length=6, choices=OPS)
+
+    class Meta:
+        # Latest change per entity, the catalog version of rate/snapshots.py
+        indexes = [models.Index(fields=['entity', 'seq'])]
+
+
+# Outcome of a rating accepted by the write-behind ingestion (see rate/ingest.py)
+# Written by the applier in the same batch as the rating, so a replayed log entry
+# that already has a receipt is skipped
+class Rating_receipt (models.Model):
+    STATUSES = {"applied": "applied", "rejected": "rejected"}
+
+    id = models.CharField(primary_key=True, max_length=32)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    status = models.CharField(max_length=8, choices=STATUSES)
+    error = models.CharField(max_length=200, blank=True)
+    applied_at = models.DateTimeField(default=timezone.now)
+
+
+# Academic years whose ratings have been moved to the archive (manage.py archive_year)
+# Closed years accept no new ratings
+class Archived_year (models.Model):
+    year = models.IntegerField(primary_key=True)
+    archived_at = models.DateTimeField(default=timezone.now)
+    rating_count = models.IntegerField(default=0)
+
+    def __str__ (self):
+        return str(self.year)
+
+
+# Maps a shard key (an academic year) to the database alias holding its ratings
+# Aliases come from settings.RATING_SHARDS, unmapped keys stay on default
+class Shard_map (models.Model):
+    key = models.CharField(unique=True, max_length=20)
+    alias = models.CharField(max_length=40)
+
+    def __str__ (self):
+        return f"{self.key} -> {self.alias}"
+
+    # Aliases must be databases in RATING_SHARDS (or default). Years whose ratings
+    # are on their current shard are moved with "manage.py move_shard" instead,
+    # a plain edit would leave the ratings and summaries behind
+    def clean(self):
+        from .sharding import shard_aliases, holds_ratings
 
+        if self.alias not in shard_aliases():
+            raise ValidationError({"alias": f"{self.alias} is not in RATING_SHARDS"})
 
+        previous = Shard_map.objects.filter(pk=self.pk).first() if self.pk else None
+        moves = {self.key: Shard_map.objects.filter(key=self.key).values_list("alias", flat=True).first() or "default"}
+        if previous is not None and previous.key != self.key:
+            # The old key goes back to default
+            moves[previous.key] = previous.alias
+        for key, alias in moves.items():
+            target = self.alias if key == self.key else "default"
+            if alias == target or not key.isdigit():
+                continue
+            module_ids = Module_instance.objects.filter(year=int(key)).values_list("id", flat=True)
+            if holds_ratings(alias, module_ids):
+                raise ValidationError(f"Year {key} has ratings on {alias}, "
+                                      f"move them with \"manage.py move_shard {key} {target}\"")
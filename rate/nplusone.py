@@ -0,0 +1,99 @@
+import logging
+import os
+import re
+import traceback
+import warnings
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger("rate.nplusone")
+
+_IN_LIST = re.compile(r"IN \((?:%s, )*%s\)")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+\b")
+
+
+class NPlusOneWarning(UserWarning):
+    pass
+
+
+class NPlusOneError(AssertionError):
+    pass
+
+
+# Function for the structure of a query, the same for every run whatever the values
+# IN lists of any length, inline strings and numbers are collapsed
+def fingerprint(sql):
+    sql = _IN_LIST.sub("IN (...)", sql)
+    sql = _STRING.sub("?", sql)
+    return _NUMBER.sub("?", sql)
+
+
+# Function for the stack of project code that ran a query, innermost frame last
+# Frames in Django, DRF and other installed packages are left out
+def project_stack():
+    base = str(settings.BASE_DIR)
+    frames = []
+    for frame in traceback.extract_stack()[:-2]:
+        if frame.filename.startswith(base) and "site-packages" not in frame.filename \
+                and frame.filename != __file__:
+            frames.append(frame)
+    return frames
+
+
+# Collects the queries run while it is active and reports repeated ones
+# A query is repeated when structurally identical SQL runs at least <threshold>
+# times from the same line of project code, the classic N+1 loop
+class QueryDetector:
+
+    def __init__(self, mode="warn", threshold=None):
+        self.mode = mode
+        self.threshold = threshold or settings.NPLUSONE_THRESHOLD
+        self.counts = {}
+        self.stacks = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        stack = project_stack()
+        site = (stack[-1].filename, stack[-1].lineno) if stack else None
+        key = (fingerprint(sql), context["connection"].alias, site)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.stacks.setdefault(key, stack)
+        return execute(sql, params, many, context)
+
+    # Function for the repeated queries, most repeated first
+    def repeated(self):
+        found = [(count, key) for key, count in self.counts.items() if count >= self.threshold]
+        return sorted(found, key=lambda item: item[0], reverse=True)
+
+    def report(self, label=""):
+        lines = []
+        for count, (sql, alias, site) in self.repeated():
+            where = f"{os.path.relpath(site[0], settings.BASE_DIR)}:{site[1]}" if site else "unknown call site"
+            lines.append(f"{count} x on {alias} from {where}: {sql}")
+            for entry in traceback.format_list(self.stacks[(sql, alias, site)][-8:]):
+                lines.extend("  " + line for line in entry.rstrip().splitlines())
+        if not lines:
+            return
+
+        message = f"Repeated queries{' in ' + label if label else ''}:\n" + "\n".join(lines)
+        if self.mode == "raise":
+            raise NPlusOneError(message)
+        logger.warning(message)
+        warnings.warn(message, NPlusOneWarning, stacklevel=3)
+
+
+# Context manager that reports repeated queries run inside it, on every database
+# For tests: with detect_nplusone("raise"): ...
+@contextmanager
+def detect_nplusone(mode="warn", threshold=None, label=""):
+    detector = QueryDetector(mode, threshold)
+    wrappers = [connection.execute_wrapper(detector) for connection in connections.all()]
+    for wrapper in wrappers:
+        wrapper.__enter__()
+    try:
+        yield detector
+    finally:
+        for wrapper in reversed(wrappers):
+            wrapper.__exit__(None, None, None)
+    detector.report(label)
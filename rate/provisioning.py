@@ -0,0 +1,167 @@
+import os
+import secrets
+import string
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from rest_framework.authtoken.models import Token
+
+# Columns of a provisioning CSV, password may be left empty to have one generated
+USER_COLUMNS = ["username", "email", "password"]
+
+# Usernames or emails looked up per conflict query
+LOOKUP_CHUNK = 500
+
+
+# Function for a random password that passes validate_password
+def generate_password(length=16):
+    alphabet = string.ascii_letters + string.digits
+    while True:
+        password = "".join(secrets.choice(alphabet) for _ in range(length))
+        if any(c.isdigit() for c in password) and any(c.isupper() for c in password):
+            return password
+
+
+# Function for checking one account the same way /api/register/ does, returns an error or None
+def account_error(username, email, password):
+    from .views import validate_email, validate_password
+
+    if not username:
+        return "Username is required"
+    if len(username) > User._meta.get_field("username").max_length:
+        return "Username is too long"
+    if not email:
+        return "Email is required"
+    if not validate_email(email):
+        return "Invalid email format"
+    valid_pw, pw_message = validate_password(password)
+    return None if valid_pw else pw_message
+
+
+# Function for the values of a field that are already taken, a chunk of values per query
+def taken(field, values):
+    found = set()
+    values = list(values)
+    for start in range(0, len(values), LOOKUP_CHUNK):
+        found.update(User.objects.filter(**{f"{field}__in": values[start:start + LOOKUP_CHUNK]})
+                     .values_list(field, flat=True))
+    return found
+
+
+# Function for hashing passwords across a pool of workers, in order
+# Processes by default. Inside the server use threads instead: forking a worker that
+# runs threads is unsafe, and the PBKDF2 hasher releases the GIL while it works.
+def hash_passwords(passwords, workers=None, processes=True):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < 2:
+        return [make_password(password) for password in passwords]
+
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    chunksize = max(1, len(passwords) // (workers * 4)) if processes else 1
+    with pool(max_workers=workers) as executor:
+        return list(executor.map(make_password, passwords, chunksize=chunksize))
+
+
+# Function for creating many accounts, as /api/register/ would one at a time
+# accounts are dicts with USER_COLUMNS. Every account is validated, then the
+# usernames and emails are checked against each other and the existing users
+# with a few IN queries, the passwords of the valid ones are hashed on a pool
+# and the users (and tokens when asked for) inserted with bulk_create.
+#
+# Returns one result per account, in order: status "created", "invalid" or
+# "conflict", and the generated password and token when there is one. Accounts
+# that lose a race with /api/register/ during the insert are reported as conflicts.
+def provision_users(accounts, issue_tokens=False, workers=None, processes=True, batch_size=1000, dry_run=False):
+    results = []
+    pending = []
+    usernames = set()
+    emails = set()
+    for account in accounts:
+        # Accounts posted as JSON may hold numbers, lists etc.
+        wrong_type = [column for column in USER_COLUMNS
+                      if account.get(column) is not None and not isinstance(account.get(column), str)]
+        if wrong_type:
+            results.append({"username": account.get("username"), "email": account.get("email"),
+                            "status": "invalid", "error": f"{wrong_type[0].capitalize()} must be a string"})
+            continue
+
+        username = (account.get("username") or "").strip()
+        email = (account.get("email") or "").strip()
+        password = account.get("password") or ""
+        result = {"username": username, "email": email}
+        results.append(result)
+
+        if not password:
+            password = result["password"] = generate_password()
+        error = account_error(username, email, password)
+        if error is not None:
+            result.update(status="invalid", error=error)
+            continue
+        if username in usernames:
+            result.update(status="conflict", error=f"Username {username} appears more than once")
+            continue
+        if email in emails:
+            result.update(status="conflict", error=f"Email {email} appears more than once")
+            continue
+
+        usernames.add(username)
+        emails.add(email)
+        pending.append((result, password))
+
+    taken_usernames = taken("username", usernames)
+    taken_emails = taken("email", emails)
+    valid = []
+    for result, password in pending:
+        if result["username"] in taken_usernames:
+            result.update(status="conflict", error="Username already in use!")
+        elif result["email"] in taken_emails:
+            result.update(status="conflict", error="Email already in use!")
+        else:
+            valid.append((result, password))
+
+    if dry_run:
+        for result, _ in valid:
+            result["status"] = "valid"
+        return results
+
+    hashes = hash_passwords([password for _, password in valid], workers, processes)
+    for start in range(0, len(valid), batch_size):
+        batch = list(zip(valid[start:start + batch_size], hashes[start:start + batch_size]))
+        insert_batch([(result, hashed) for (result, _), hashed in batch], issue_tokens)
+
+    return results
+
+
+# Function for inserting a batch of accounts in one transaction
+# A username or email registered since the conflict check fails the whole batch,
+# then the batch is checked again and inserted without the accounts that clash
+def insert_batch(batch, issue_tokens):
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                users = User.objects.bulk_create([
+                    User(username=result["username"], email=result["email"], password=hashed)
+                    for result, hashed in batch
+                ])
+                tokens = []
+                if issue_tokens:
+                    tokens = Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users])
+            break
+        except IntegrityError:
+            if attempt:
+                raise
+            taken_usernames = taken("username", [result["username"] for result, _ in batch])
+            taken_emails = taken("email", [result["email"] for result, _ in batch])
+            remaining = []
+            for result, hashed in batch:
+                if result["username"] in taken_usernames or result["email"] in taken_emails:
+                    result.update(status="conflict", error="Username or email registered meanwhile")
+                else:
+                    remaining.append((result, hashed))
+            batch = remaining
+
+    for (result, _), user in zip(batch, users):
+        result.update(status="created", id=user.pk)
+    for (result, _), token in zip(batch, tokens):
+        result["token"] = token.key
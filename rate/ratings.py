@@ -0,0 +1,98 @@
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Rating, Rating_summary, Daily_rating
+from .changes import record_change, rating_key
+from .sharding import shard_for_year
+from .sketches import add_rater
+
+
+# Function for applying a rating being added and/or removed to the rating summaries
+# Updates count, sum and the per-star histogram in one INSERT ... ON CONFLICT
+# statement, so concurrent writers never lose an update
+def apply_rating_delta(professor_id, module_id, added=None, removed=None, using=None):
+    if added == removed:
+        return
+
+    histogram = [0] * 5
+    if added is not None:
+        histogram[added - 1] += 1
+    if removed is not None:
+        histogram[removed - 1] -= 1
+    count = (added is not None) - (removed is not None)
+    total = (added or 0) - (removed or 0)
+
+    using = using or router.db_for_write(Rating_summary)
+    table = Rating_summary._meta.db_table
+    columns = ", ".join(f"stars_{n}" for n in range(1, 6))
+    updates = ", ".join(f"stars_{n} = {table}.stars_{n} + excluded.stars_{n}" for n in range(1, 6))
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (professor_id, module_id, count, total, {columns}) "
+            f"VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+            f"ON CONFLICT (professor_id, module_id) DO UPDATE SET "
+            f"count = {table}.count + excluded.count, total = {table}.total + excluded.total, {updates}",
+            [professor_id, module_id, count, total, *histogram]
+        )
+
+
+# Function for applying a change in count/sum of stars to a professor's daily rollup
+# Ratings without a creation time (day is None) are not rolled up
+def apply_daily_delta(professor_id, day, count, stars, using=None):
+    if day is None or (count == 0 and stars == 0):
+        return
+
+    using = using or router.db_for_write(Daily_rating)
+    table = Daily_rating._meta.db_table
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (day, professor_id, count, total) VALUES (%s, %s, %s, %s) "
+            f"ON CONFLICT (day, professor_id) DO UPDATE SET "
+            f"count = {table}.count + excluded.count, total = {table}.total + excluded.total",
+            [connections[using].ops.adapt_datefield_value(day), professor_id, count, stars]
+        )
+
+
+# Function for getting the rollup day of a rating's created_at
+# Raw queries on SQLite return the timestamp as text, None stays None
+def rating_day(created_at):
+    if created_at is None:
+        return None
+    if isinstance(created_at, str):
+        created_at = parse_datetime(created_at)
+    return created_at.date()
+
+
+# Function for inserting a rating, or replacing the stars of an existing one
+# Returns (previous_stars, stars), previous_stars is None when the rating is new
+# Rows written here bypass the model signals, so the summary and daily deltas, the
+# rater sketch and the change log entry are written directly
+def upsert_rating(user, professor, module_instance, stars, using=None, created_at=None):
+    using = using or shard_for_year(module_instance.year)
+    table = Rating._meta.db_table
+
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (stars, professor_id, module_id, user_id, previous_stars, created_at) "
+                f"VALUES (%s, %s, %s, %s, NULL, %s) "
+                f"ON CONFLICT (user_id, professor_id, module_id) DO UPDATE SET "
+                f"previous_stars = {table}.stars, stars = excluded.stars "
+                f"RETURNING id, previous_stars, stars, created_at",
+                [stars, professor.pk, module_instance.pk, user.pk,
+                 connections[using].ops.adapt_datetimefield_value(created_at or timezone.now())]
+            )
+            rating_id, previous_stars, stars, created_at = cursor.fetchone()
+
+        # An updated rating stays in the daily bucket it was created in
+        day = rating_day(created_at)
+        if previous_stars is None:
+            apply_rating_delta(professor.pk, module_instance.pk, added=stars, using=using)
+            add_rater(professor.pk, module_instance.pk, user.pk, using=using)
+            apply_daily_delta(professor.pk, day, 1, stars)
+        else:
+            apply_rating_delta(professor.pk, module_instance.pk, added=stars, removed=previous_stars, using=using)
+            apply_daily_delta(professor.pk, day, 0, stars - previous_stars)
+        record_change("rating", rating_key(using, rating_id), "upsert")
+
+    return previous_stars, stars
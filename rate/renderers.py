@@ -0,0 +1,86 @@
+import json
+from rest_framework.renderers import JSONRenderer, BaseRenderer
+from rest_framework.parsers import BaseParser
+from rest_framework.exceptions import ParseError
+from rest_framework.utils import encoders
+
+# orjson and msgpack are optional, the API falls back to DRF's own JSON encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# JSON renderer that encodes with orjson when it is installed
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        # Indented output (e.g. "application/json; indent=4") is left to DRF
+        if orjson is None or self.get_indent(accepted_media_type or '', renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # orjson doesn't know about lazy strings, Decimals etc.
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+# NDJSON renderer, selected with "Accept: application/x-ndjson" or "?format=ndjson"
+# A payload holding a single list (the module list, the professor ratings) is written
+# one item per line, so clients can show items as they arrive. Anything else is one line.
+class NDJSONRenderer(BaseRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        items = [data]
+        if isinstance(data, dict) and len(data) == 1:
+            value = next(iter(data.values()))
+            if isinstance(value, list):
+                items = value
+        return b''.join(self.dumps(item) + b'\n' for item in items)
+
+    def dumps(self, item):
+        if orjson is not None:
+            try:
+                return orjson.dumps(item)
+            except TypeError:
+                pass
+        return json.dumps(item, cls=encoders.JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+# MessagePack renderer, selected with "Accept: application/msgpack" or "?format=msgpack"
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True)
+
+
+# MessagePack parser so clients can send request bodies in the same format
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except Exception as exc:
+            raise ParseError(f"MessagePack parse error - {exc}")
@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from django.conf import settings
+from django.db import connections
+
+# Database alias that read-only views read from
+REPLICA = "replica"
+
+# Set while a read-only view is running
+_read_only = ContextVar("read_only", default=False)
+
+
+# Decorator for views that only read, their queries are routed to the replica
+# Authentication runs before the view body, so tokens are still checked on default
+def read_only(view_func):
+    @wraps(view_func)
+    def wrapper(*args, **kwargs):
+        token = _read_only.set(True)
+        try:
+            with pinned_replica():
+                return view_func(*args, **kwargs)
+        finally:
+            _read_only.reset(token)
+    return wrapper
+
+
+# Context manager for reading one state of the replica, when it is the bundled snapshot
+# Only this thread's connection is pinned, fan-out threads have their own
+@contextmanager
+def pinned_replica():
+    replica = connections[REPLICA] if REPLICA in settings.DATABASES else None
+    if not hasattr(replica, "pin_snapshot"):
+        yield
+        return
+
+    replica.pin_snapshot()
+    try:
+        yield
+    finally:
+        replica.unpin_snapshot()
+
+
+# Sends reads made inside read_only views to the replica alias, everything else to default
+# Works the same whether "replica" is the bundled in-memory snapshot or a real replica
+class ReadReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if _read_only.get() and REPLICA in settings.DATABASES:
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    # Rows read from the replica may point at rows on default, they are the same database
+    def allow_relation(self, obj1, obj2, **hints):
+        if {obj1._state.db, obj2._state.db} <= {"default", REPLICA}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == REPLICA:
+            return False
+        return None
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router
+
+# Seconds the shard map is cached in-process
+SHARD_MAP_TTL = 30
+
+_shard_map = {"loaded": 0, "keys": {}}
+_shard_map_lock = threading.Lock()
+_pool = None
+
+
+# Function for listing every database that may hold ratings, default holds unmapped keys
+def shard_aliases():
+    return list(settings.RATING_SHARDS) + ["default"]
+
+
+# Function for finding the database that holds the ratings for an academic year
+def shard_for_year(year):
+    if not settings.RATING_SHARDS:
+        return "default"
+
+    from .models import Shard_map
+
+    with _shard_map_lock:
+        if time.monotonic() - _shard_map["loaded"] > SHARD_MAP_TTL:
+            keys = dict(Shard_map.objects.using("default").values_list("key", "alias"))
+            # A typo would otherwise fail every rating write with a KeyError on connections
+            unknown = {key: alias for key, alias in keys.items() if alias not in shard_aliases()}
+            if unknown:
+                raise ImproperlyConfigured(f"Shard_map points at databases not in RATING_SHARDS: {unknown}")
+            _shard_map["keys"] = keys
+            _shard_map["loaded"] = time.monotonic()
+        return _shard_map["keys"].get(str(year), "default")
+
+
+# Function for reading the shard map again on the next lookup in this process
+def reload_shard_map():
+    with _shard_map_lock:
+        _shard_map["loaded"] = 0
+
+
+# Function for checking whether a database holds ratings or summaries of some module instances
+def holds_ratings(alias, module_ids):
+    from .models import Rating, Rating_summary
+
+    module_ids = list(module_ids)
+    return (Rating.objects.using(alias).filter(module_id__in=module_ids).exists()
+            or Rating_summary.objects.using(alias).filter(module_id__in=module_ids).exists())
+
+
+# Function for running func(alias, db) for every shard in parallel and returning the results
+# db is the database to read the shard from: the shard itself, or for default the
+# normal read database (which may be the replica). Without shards it runs inline.
+def fan_out(model, func, aliases=None):
+    aliases = list(aliases or shard_aliases())
+    # Resolved here, the router's read-only flag doesn't reach the pool threads
+    read_default = router.db_for_read(model) or "default"
+    dbs = [read_default if alias == "default" else alias for alias in aliases]
+
+    if len(aliases) == 1:
+        return [func(aliases[0], dbs[0])]
+
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=settings.RATING_SHARD_WORKERS, thread_name_prefix="shard")
+    return list(_pool.map(func, aliases, dbs))
+
+
+# Function for stopping the fan-out threads, "manage.py serve" does before forking
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+# A forked child has the parent's pool but not its threads, it starts its own
+def _forget_pool():
+    global _pool
+    _pool = None
+
+
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+# Routes ratings and their summaries to the shard of their module instance's year
+# Other models, and ratings of unmapped years, stay on default. Shard databases
+# only get the sharded tables, their foreign keys point at tables on default
+class ShardRouter:
+    SHARDED_MODELS = {"rating", "rating_summary"}
+
+    def is_sharded(self, model):
+        return model._meta.app_label == "rate" and model._meta.model_name in self.SHARDED_MODELS
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get("instance")
+        if not settings.RATING_SHARDS or instance is None:
+            return None
+
+        if self.is_sharded(model) and isinstance(instance, model):
+            return instance._state.db or shard_for_year(instance.module.year)
+        if instance._state.db in settings.RATING_SHARDS:
+            return "default"
+        return None
+
+    # Related lookups from a sharded row (e.g. rating.professor) go back to default
+    def db_for_read(self, model, **hints):
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in settings.RATING_SHARDS:
+            return instance._state.db if self.is_sharded(model) else "default"
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db in settings.RATING_SHARDS or obj2._state.db in settings.RATING_SHARDS:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.RATING_SHARDS:
+            return app_label == "rate" and model_name in self.SHARDED_MODELS
+        return None
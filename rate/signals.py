@@ -0,0 +1,119 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Professor, Module, Module_instance, Rating
+from django.db import transaction
+from .encoding import bump_version
+from .snapshots import schedule_publish
+from .ratings import apply_rating_delta, apply_daily_delta, rating_day
+from .sketches import add_rater
+from .changes import record_change, rating_key
+from .sharding import shard_aliases
+
+# Change log entity names for each model
+ENTITIES = {
+    Professor: "professor",
+    Module: "module",
+    Module_instance: "module_instance",
+    Rating: "rating",
+}
+
+
+# Any change to the catalog invalidates the encoded /api/list/ payloads, and once
+# committed is published as a new snapshot
+@receiver(post_save, sender=Professor)
+@receiver(post_save, sender=Module)
+@receiver(post_save, sender=Module_instance)
+@receiver(post_delete, sender=Professor)
+@receiver(post_delete, sender=Module)
+@receiver(post_delete, sender=Module_instance)
+@receiver(m2m_changed, sender=Module_instance.prof.through)
+def catalog_changed(sender, using=None, **kwargs):
+    bump_version("catalog")
+    transaction.on_commit(schedule_publish, using=using)
+
+
+# Record every write to the rated models in the change log
+@receiver(post_save, sender=Professor)
+@receiver(post_save, sender=Module)
+@receiver(post_save, sender=Module_instance)
+@receiver(post_save, sender=Rating)
+def log_saved(sender, instance, raw=False, using=None, **kwargs):
+    if not raw:
+        record_change(ENTITIES[sender], change_key(instance, using), "upsert")
+
+
+@receiver(post_delete, sender=Professor)
+@receiver(post_delete, sender=Module)
+@receiver(post_delete, sender=Module_instance)
+@receiver(post_delete, sender=Rating)
+def log_deleted(sender, instance, using=None, **kwargs):
+    record_change(ENTITIES[sender], change_key(instance, using), "delete")
+
+
+# Function for the change log key of a row, ratings may live on a shard
+def change_key(instance, using):
+    if isinstance(instance, Rating):
+        return rating_key(using, instance.pk)
+    return instance.pk
+
+
+# Professor assignments are part of the module instance row in the change feed
+@receiver(m2m_changed, sender=Module_instance.prof.through)
+def log_professors_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            record_change("module_instance", instance.pk, "upsert")
+        return
+
+    # Changed from the professor side, e.g. professor.module_instance_set.clear()
+    if action == "pre_clear":
+        instance._cleared_instances = list(instance.module_instance_set.values_list("id", flat=True))
+    elif action == "post_clear":
+        pk_set = getattr(instance, "_cleared_instances", [])
+    if action in ("post_add", "post_remove", "post_clear"):
+        for instance_id in pk_set or []:
+            record_change("module_instance", instance_id, "upsert")
+
+
+# Remember what an edited rating looked like so post_save can apply the difference
+@receiver(pre_save, sender=Rating)
+def rating_pre_save(sender, instance, raw=False, using=None, **kwargs):
+    instance._summary_old = None
+    if instance.pk and not raw:
+        instance._summary_old = Rating.objects.using(using).filter(pk=instance.pk).values_list(
+            "professor_id", "module_id", "stars", "created_at").first()
+
+
+# Keep the rating summaries, rater sketches and daily rollups in step with ratings saved through the ORM (views, admin)
+# Summaries live next to their ratings (which may be a shard), daily rollups stay on default
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, created, raw=False, using=None, **kwargs):
+    if raw:
+        return
+
+    old = getattr(instance, "_summary_old", None)
+    if old is not None:
+        apply_rating_delta(old[0], old[1], removed=old[2], using=using)
+        apply_daily_delta(old[0], rating_day(old[3]), -1, -old[2])
+    apply_rating_delta(instance.professor_id, instance.module_id, added=instance.stars, using=using)
+    add_rater(instance.professor_id, instance.module_id, instance.user_id, using=using)
+    apply_daily_delta(instance.professor_id, rating_day(instance.created_at), 1, instance.stars)
+
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, using=None, **kwargs):
+    apply_rating_delta(instance.professor_id, instance.module_id, removed=instance.stars, using=using)
+    apply_daily_delta(instance.professor_id, rating_day(instance.created_at), -1, -instance.stars)
+
+
+# The database only cascades a deleted user to the ratings next to it, ratings on
+# the other shards are deleted through the ORM once the user is gone, so their
+# summary, daily rollup and change log entries follow as for any deleted rating
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, using=None, **kwargs):
+    def delete_ratings():
+        for alias in shard_aliases():
+            if alias != using:
+                Rating.objects.using(alias).filter(user_id=instance.pk).delete()
+    transaction.on_commit(delete_ratings, using=using)
@@ -0,0 +1,103 @@
+import hashlib
+import math
+from django.db import router
+from .models import Rating_summary
+
+# HyperLogLog sketches of the users who rated a professor in a module instance
+#
+# A sketch is SKETCH_SIZE one-byte registers. Each user id is hashed to 64 bits:
+# the top PRECISION bits pick a register, which keeps the highest rank (position
+# of the first 1 bit) of the remaining bits seen. Adding a user twice changes
+# nothing, and the sketch of a union of raters is the register-wise max of the
+# sketches, so any roll-up is merged from the per module instance sketches
+# without touching the ratings.
+#
+# With 1024 registers the standard error of an estimate is 1.04 / sqrt(1024),
+# about 3.25%: two thirds of estimates are within 3.25% of the true count and
+# 99.7% within 9.75%. Counts up to 2.5 x 1024 use linear counting, which is more
+# accurate still: a few dozen raters are counted exactly. Users are never removed,
+# a deleted rating's user still counts until the summary is rebuilt.
+PRECISION = 10
+SKETCH_SIZE = 1 << PRECISION
+RELATIVE_ERROR = 1.04 / math.sqrt(SKETCH_SIZE)
+
+# Compare-and-swap attempts before a sketch update gives up
+CAS_ATTEMPTS = 10
+
+_RANK_BITS = 64 - PRECISION
+_ALPHA = 0.7213 / (1 + 1.079 / SKETCH_SIZE)
+
+
+# Function for the register and rank of a user id
+# Hashed with blake2b so every process places a user in the same register
+def register_rank(user_id):
+    value = int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), "big")
+    rest = value & ((1 << _RANK_BITS) - 1)
+    return value >> _RANK_BITS, _RANK_BITS - rest.bit_length() + 1
+
+
+# Function for a sketch with some user ids added, None stands for the empty sketch
+# Ratings without a user (None) are skipped. Returns the sketch unchanged (the same
+# object) when none of the users raise a register
+def add_users(sketch, user_ids):
+    registers = None
+    for user_id in user_ids:
+        if user_id is None:
+            continue
+        index, rank = register_rank(user_id)
+        current = registers if registers is not None else sketch
+        if current is not None and current[index] >= rank:
+            continue
+        if registers is None:
+            registers = bytearray(sketch) if sketch is not None else bytearray(SKETCH_SIZE)
+        registers[index] = rank
+    return sketch if registers is None else bytes(registers)
+
+
+# Function for the union of sketches, empty sketches (None) are skipped
+def merge(sketches):
+    sketches = [bytes(sketch) for sketch in sketches if sketch is not None]
+    if not sketches:
+        return None
+    if len(sketches) == 1:
+        return sketches[0]
+    return bytes(map(max, *sketches))
+
+
+# Function for the estimated number of distinct users added to a sketch
+def estimate(sketch):
+    if sketch is None:
+        return 0
+
+    zeros = sketch.count(0)
+    raw = _ALPHA * SKETCH_SIZE * SKETCH_SIZE / sum(2.0 ** -register for register in sketch)
+    if raw <= 2.5 * SKETCH_SIZE and zeros:
+        return round(SKETCH_SIZE * math.log(SKETCH_SIZE / zeros))
+    return round(raw)
+
+
+# Function for adding a rater to the sketch of a professor in a module instance
+# The summary row must exist, the rating writes create it first. The sketch is
+# read, updated in Python and written back only if it is still the one read, so
+# concurrent raters never overwrite each other. Returns False if every attempt lost.
+def add_rater(professor_id, module_id, user_id, using=None):
+    using = using or router.db_for_write(Rating_summary)
+    summaries = Rating_summary.objects.using(using).filter(professor_id=professor_id, module_id=module_id)
+    for _ in range(CAS_ATTEMPTS):
+        row = summaries.values_list("raters", flat=True).first()
+        sketch = bytes(row) if row is not None else None
+        updated = add_users(sketch, [user_id])
+        if updated is sketch:
+            return True
+        if summaries.filter(raters=sketch).update(raters=updated):
+            return True
+    return False
+
+
+# Function for the sketches of ratings given as (professor_id, module_id, user_id) rows
+# Returns {(professor_id, module_id): sketch}, for rebuilding sketches from scratch
+def build_sketches(rows):
+    users = {}
+    for professor_id, module_id, user_id in rows:
+        users.setdefault((professor_id, module_id), []).append(user_id)
+    return {key: add_users(None, user_ids) for key, user_ids in users.items()}
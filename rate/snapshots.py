@@ -0,0 +1,347 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from django.conf import settings
+from django.db import connections
+from django.db.models import Max
+from django.http import FileResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.utils.cache import patch_vary_headers
+from .models import Module_instance, Change
+from .encoding import brotli, zstandard, current_version, negotiate_encoding
+from .renderers import FastJSONRenderer, NDJSONRenderer
+
+logger = logging.getLogger("rate.snapshots")
+
+# Pre-rendered snapshots of the catalog behind /api/list/
+#
+# Every time the catalog changes the full module list, and a slice of it per year,
+# is rendered as JSON and NDJSON and written to CATALOG_SNAPSHOT_DIR under a name
+# holding a hash of its content (catalog.<hash>.json, catalog-2024.<hash>.ndjson),
+# next to pre-compressed copies (.gz, .br, .zst). A versioned file never changes,
+# so it can be cached for ever. current.json lists the files of the latest snapshot,
+# and catalog.json, catalog-2024.json etc. are symlinks to them for a front-end
+# proxy that serves /api/list/ straight from the directory. The manifest records the
+# catalog version it was built from, the app only serves it while that is current.
+
+# Formats published, keyed by the renderer format of /api/list/
+FORMATS = {
+    "json": FastJSONRenderer,
+    "ndjson": NDJSONRenderer,
+}
+
+# File suffix of each pre-compressed copy, the ones nginx's *_static modules look for
+SUFFIXES = {"gzip": ".gz", "br": ".br", "zstd": ".zst"}
+
+# Snapshots are compressed once, so at the highest levels
+STATIC_COMPRESSORS = {
+    "gzip": lambda body: gzip.compress(body, compresslevel=9, mtime=0),
+}
+if brotli is not None:
+    STATIC_COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=11)
+if zstandard is not None:
+    STATIC_COMPRESSORS["zstd"] = lambda body: zstandard.ZstdCompressor(level=19).compress(body)
+
+MANIFEST = "current.json"
+# Change log entities that make up the catalog
+CATALOG_ENTITIES = ["professor", "module", "module_instance"]
+SNAPSHOT_NAME = re.compile(r"catalog(-\d+)?\.[0-9a-f]{16}\.(json|ndjson)")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+# Function for building the catalog of module instances and their professors
+# year limits it to the module instances of one academic year
+def build_module_list(year=None):
+    # Query all module instances with their associated modules and professors
+    module_instances = Module_instance.objects.all().select_related('mod').prefetch_related('prof')
+    if year is not None:
+        module_instances = module_instances.filter(year=year)
+
+    # Prepare response data
+    module_list = []
+
+    for instance in module_instances:
+        # Get all professors teaching this module instance
+        professors = instance.prof.all()
+        prof_info = [{"id": prof.id, "name": prof.name} for prof in professors]
+
+        # Format module data for response message
+        module_data = {
+            "code": instance.mod.code,
+            "description": instance.mod.desc,
+            "year": instance.year,
+            "semester": instance.sem,
+            "professors": prof_info
+        }
+        module_list.append(module_data)
+
+    return {
+        "modules": module_list
+    }
+
+
+# Function for the version of the catalog in the database, the seq of its latest change
+# The same in every process, unlike the in-process counters of rate/encoding.py
+def catalog_version():
+    return Change.objects.filter(entity__in=CATALOG_ENTITIES).aggregate(seq=Max("seq"))["seq"] or 0
+
+
+# Function for writing a file so readers only ever see the old or the new content
+def write_atomic(path, body):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(body)
+    os.replace(tmp, path)
+
+
+# Function for pointing <alias> at <target> (a name in the same directory), atomically
+def link_atomic(directory, alias, target):
+    tmp = os.path.join(directory, f"{alias}.{os.getpid()}.{threading.get_ident()}.tmp")
+    os.symlink(target, tmp)
+    os.replace(tmp, os.path.join(directory, alias))
+
+
+# Function for writing one rendered body and its compressed copies
+# Returns the manifest entry of the file. Files that exist already have the same
+# content, so they are left alone (and their mtime marks them as in use).
+# Compressed copies that come out no smaller than the body are left out.
+def write_snapshot(directory, prefix, fmt, body):
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    name = f"{prefix}.{digest}.{fmt}"
+    encodings = []
+    variants = [("identity", name, lambda: body)]
+    for encoding, compressor in STATIC_COMPRESSORS.items():
+        variants.append((encoding, name + SUFFIXES[encoding], lambda compressor=compressor: compressor(body)))
+
+    for encoding, filename, render in variants:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            rendered = render()
+            # A compressed copy that saves nothing isn't worth sending
+            if encoding != "identity" and len(rendered) >= len(body):
+                continue
+            write_atomic(path, rendered)
+        link_atomic(directory, f"{prefix}.{fmt}" + SUFFIXES.get(encoding, ""), filename)
+        if encoding != "identity":
+            encodings.append(encoding)
+    return {"file": name, "etag": digest, "encodings": encodings}
+
+
+# Function for publishing a snapshot of the catalog as it is now, returns the manifest
+# Runs under an flock on <dir>/.publish.lock, so processes publishing at the same
+# time write one after the other and the last one reads the latest catalog
+def publish_catalog():
+    directory = str(settings.CATALOG_SNAPSHOT_DIR)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".publish.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Read first, a change made while building leaves the snapshot out of date
+            version = catalog_version()
+            modules = build_module_list()["modules"]
+            slices = {"all": modules}
+            for module in modules:
+                slices.setdefault(str(module["year"]), []).append(module)
+
+            files = {}
+            for name, items in slices.items():
+                prefix = "catalog" if name == "all" else f"catalog-{name}"
+                files[name] = {
+                    fmt: write_snapshot(directory, prefix, fmt, renderer().render({"modules": items}))
+                    for fmt, renderer in FORMATS.items()
+                }
+
+            manifest = {"published_at": time.time(), "catalog_version": version, "files": files}
+            previous = read_manifest(directory)
+            if previous is None or previous["files"] != files or previous.get("catalog_version") != version:
+                write_atomic(os.path.join(directory, MANIFEST), json.dumps(manifest, indent=1).encode())
+            else:
+                manifest = previous
+            prune(directory, files)
+            return manifest
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST), "rb") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# Function for deleting what the manifest no longer refers to
+# Aliases of years that are gone go at once. Old versions are kept for
+# CATALOG_SNAPSHOT_RETAIN seconds, clients may still follow a redirect to them.
+def prune(directory, files):
+    current = {entry["file"] for formats in files.values() for entry in formats.values()}
+    cutoff = time.time() - settings.CATALOG_SNAPSHOT_RETAIN
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        base = filename.removesuffix(SUFFIXES["gzip"]).removesuffix(SUFFIXES["br"]).removesuffix(SUFFIXES["zstd"])
+        if os.path.islink(path):
+            if os.readlink(path).removesuffix(filename[len(base):]) not in current:
+                os.unlink(path)
+        elif SNAPSHOT_NAME.fullmatch(base) and base not in current and os.path.getmtime(path) < cutoff:
+            os.unlink(path)
+
+
+# Debounced publishing after catalog changes
+# Saving a module instance in the admin sends several signals, they are gathered
+# into one publish CATALOG_SNAPSHOT_DELAY seconds after the first. The timer thread
+# is not a daemon, so a management command that changes the catalog waits for it.
+_scheduled = False
+_schedule_lock = threading.Lock()
+
+
+def schedule_publish():
+    global _scheduled
+    if not settings.CATALOG_SNAPSHOT_DIR:
+        return
+    with _schedule_lock:
+        if _scheduled:
+            return
+        _scheduled = True
+    threading.Timer(settings.CATALOG_SNAPSHOT_DELAY, publish_scheduled).start()
+
+
+# A timer pending in the parent doesn't exist in a forked child, which schedules its own
+def _forget_schedule():
+    global _scheduled, _schedule_lock
+    _scheduled = False
+    _schedule_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_schedule)
+
+
+def publish_scheduled():
+    global _scheduled
+    # Changes committed from now on need a publish of their own
+    with _schedule_lock:
+        _scheduled = False
+    try:
+        publish_catalog()
+    except Exception:
+        logger.exception("Publishing the catalog snapshot failed")
+    finally:
+        connections.close_all()
+
+
+# Per process copy of the manifest, read again when current.json is replaced
+# A manifest built from another catalog version (an older catalog, or another
+# database altogether) is not served. The version is read again when this process
+# changes the catalog, and otherwise every ENCODED_CACHE_TTL seconds.
+class SnapshotManifest:
+
+    def __init__(self):
+        self._key = None
+        self._manifest = None
+        self._version = None
+
+    def current(self):
+        directory = str(settings.CATALOG_SNAPSHOT_DIR)
+        try:
+            stat = os.stat(os.path.join(directory, MANIFEST))
+        except FileNotFoundError:
+            return None
+        key = (directory, stat.st_ino, stat.st_mtime_ns)
+        if key != self._key:
+            self._manifest = read_manifest(directory)
+            self._key = key
+        if self._manifest is None or self._manifest.get("catalog_version") != self.catalog_version():
+            return None
+        return self._manifest
+
+    def catalog_version(self):
+        local = current_version("catalog")
+        if self._version is None or self._version[0] != local \
+                or time.monotonic() - self._version[2] > settings.ENCODED_CACHE_TTL:
+            self._version = (local, catalog_version(), time.monotonic())
+        return self._version[1]
+
+
+snapshot_manifest = SnapshotManifest()
+
+
+# Function for the tag of an ETag header, weak or not
+def etag_matches(if_none_match, etag):
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+# Function for sending a snapshot file with the best encoding the client accepts
+def file_response(request, name, encodings, media_type):
+    encoding = negotiate_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    if encoding not in encodings:
+        encoding = "identity"
+    path = os.path.join(str(settings.CATALOG_SNAPSHOT_DIR), name + SUFFIXES.get(encoding, ""))
+    response = FileResponse(open(path, "rb"), content_type=media_type)
+    del response["Content-Disposition"]
+    if encoding != "identity":
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response, encoding
+
+
+# Function for answering /api/list/ from the current snapshot
+# Returns None when there is no snapshot for the request (publishing is off, nothing
+# was published yet, or another format was negotiated), the caller renders it instead.
+# The answer is the file itself, or a redirect to its versioned URL with
+# CATALOG_SNAPSHOT_REDIRECT, and may be cached for CATALOG_SNAPSHOT_MAX_AGE seconds.
+def snapshot_response(request, year=None):
+    fmt = request.accepted_renderer.format
+    if not settings.CATALOG_SNAPSHOT_DIR or fmt not in FORMATS:
+        return None
+    # Parameters such as "; indent=4" change the body
+    if ";" in request.accepted_media_type:
+        return None
+    manifest = snapshot_manifest.current()
+    if manifest is None:
+        return None
+    entry = manifest["files"].get("all" if year is None else str(year), {}).get(fmt)
+    if entry is None:
+        return None
+
+    etag = '"%s"' % entry["etag"]
+    if etag_matches(request.META.get("HTTP_IF_NONE_MATCH", ""), etag):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+    elif settings.CATALOG_SNAPSHOT_REDIRECT:
+        response = HttpResponseRedirect(settings.CATALOG_SNAPSHOT_URL + entry["file"])
+    else:
+        response, encoding = file_response(request, entry["file"], entry["encodings"], FORMATS[fmt].media_type)
+        response["ETag"] = etag if encoding == "identity" else "W/" + etag
+    response["Cache-Control"] = f"public, max-age={settings.CATALOG_SNAPSHOT_MAX_AGE}"
+    patch_vary_headers(response, ("Accept", "Accept-Encoding"))
+    return response
+
+
+# Function for sending a versioned snapshot file, for when no proxy serves
+# CATALOG_SNAPSHOT_URL. Returns None for names that are not (or no longer) published.
+def versioned_response(request, name):
+    if not settings.CATALOG_SNAPSHOT_DIR or not SNAPSHOT_NAME.fullmatch(name):
+        return None
+    path = os.path.join(str(settings.CATALOG_SNAPSHOT_DIR), name)
+    if not os.path.exists(path):
+        return None
+
+    etag = '"%s"' % name.split(".")[1]
+    if etag_matches(request.META.get("HTTP_IF_NONE_MATCH", ""), etag):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+    else:
+        encodings = [encoding for encoding, suffix in SUFFIXES.items() if os.path.exists(path + suffix)]
+        fmt = name.rsplit(".", 1)[1]
+        response, encoding = file_response(request, name, encodings, FORMATS[fmt].media_type)
+        response["ETag"] = etag if encoding == "identity" else "W/" + etag
+    response["Cache-Control"] = IMMUTABLE
+    return response
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Max
+from .models import Change
+from .views import build_professor_ratings
+
+logger = logging.getLogger("rate.stream")
+
+
+# Functions run on the database thread by the broadcaster
+def latest_change_seq():
+    close_old_connections()
+    return Change.objects.aggregate(seq=Max("seq"))["seq"] or 0
+
+
+def load_professor_ratings():
+    return {professor["id"]: professor for professor in build_professor_ratings()}
+
+
+# Updates waiting to be sent to one SSE client, the latest aggregate per professor
+# A client that falls behind gets its pending professors merged rather than
+# dropped, so it never misses a professor's latest average and never holds more
+# than one entry per professor.
+class Subscription:
+
+    def __init__(self):
+        self.pending = {}
+        self.ready = asyncio.Event()
+
+    def push(self, professors):
+        for professor in professors:
+            self.pending[professor["id"]] = professor
+        self.ready.set()
+
+    # Function for waiting for updates, returns every professor changed since the last call
+    async def get(self):
+        await self.ready.wait()
+        self.ready.clear()
+        professors, self.pending = list(self.pending.values()), {}
+        return professors
+
+
+# One broadcaster per process fans professor rating changes out to every SSE client
+# Other processes write ratings, so it polls the shared change log sequence:
+# one cheap MAX(seq) query per window no matter how many clients are connected.
+# The ratings are only recomputed when the sequence has moved, and every
+# professor changed within the window is sent once with its latest aggregate.
+class RatingBroadcaster:
+
+    def __init__(self):
+        self.subscribers = set()
+        self.snapshot = None
+        self.task = None
+
+    async def subscribe(self):
+        subscription = Subscription()
+        if self.snapshot is None:
+            self.cursor = await sync_to_async(latest_change_seq)()
+            self.snapshot = await sync_to_async(load_professor_ratings)()
+
+        self.subscribers.add(subscription)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    async def run(self):
+        while self.subscribers:
+            await asyncio.sleep(settings.RATING_STREAM_WINDOW)
+            try:
+                await self.poll()
+            except Exception:
+                # A failed poll (e.g. the database is locked) is tried again next window
+                logger.exception("Polling the change log for the rating stream failed")
+
+        # Nobody is listening, the next subscriber reloads a fresh snapshot
+        self.snapshot = None
+
+    async def poll(self):
+        cursor = await sync_to_async(latest_change_seq)()
+        if cursor == self.cursor:
+            return
+
+        ratings = await sync_to_async(load_professor_ratings)()
+        changed = [rating for prof_id, rating in ratings.items() if self.snapshot.get(prof_id) != rating]
+        self.cursor, self.snapshot = cursor, ratings
+
+        if changed:
+            self.publish(changed)
+
+    def publish(self, professors):
+        for subscription in list(self.subscribers):
+            subscription.push(professors)
+
+
+broadcaster = RatingBroadcaster()
+
+
+# Function for formatting one Server-Sent Event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+# ASGI app for /api/stream/, pushes professor rating changes as Server-Sent Events
+# The first event is a snapshot of every professor, later "rating" events carry
+# only the professors whose average or count changed
+async def sse_application(scope, receive, send):
+    subscription = await broadcaster.subscribe()
+
+    # Watch for the client going away while we wait on updates
+    async def wait_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    disconnect = asyncio.ensure_future(wait_disconnect())
+
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        await send({
+            "type": "http.response.body",
+            "body": sse_event("snapshot", {"professors": list(broadcaster.snapshot.values())}),
+            "more_body": True,
+        })
+
+        while True:
+            update = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait({update, disconnect}, timeout=settings.RATING_STREAM_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnect in done:
+                update.cancel()
+                break
+
+            if update in done:
+                body = sse_event("rating", {"professors": update.result()})
+            else:
+                # Comment line keeps proxies from closing an idle connection
+                update.cancel()
+                body = b": keep-alive\n\n"
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        broadcaster.unsubscribe(subscription)
+        disconnect.cancel()
@@ -1,3 +1,1391 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import importlib
+import io
+import json
+import os
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from importlib.util import find_spec
+from contextlib import closing
+from unittest import mock, skipUnless
+from urllib.request import urlopen
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from . import accesslog
+from .accesslog import PHASES, RequestTimings, flush_access_log
+from .admission import AdmissionState
+from .encoding import COMPRESSORS, encoded_cache
+from .changes import record_changes as real_record_changes
+from .maintenance import check_daily, check_summaries, run_maintenance
+from .ingest import LIVE_LOG, drain, enqueue_rating, find_pending, ingest_path, sealed_segments
+from .nplusone import NPlusOneError, detect_nplusone, fingerprint
+from .management.commands.archive_year import Command as ArchiveYear
+from .management.commands.serve import Command as Serve, PreforkWSGIServer, QuietWSGIRequestHandler
+from .models import Professor, Module, Module_instance, Rating, Rating_receipt, Rating_summary, Shard_map, Change, Daily_rating, Archived_year
+from .db.snapshot.base import DatabaseWrapper as SnapshotWrapper
+from .provisioning import provision_users
+from .routers import REPLICA, read_only
+from .ratings import upsert_rating
+from .sharding import fan_out, reload_shard_map, shard_for_year
+from .snapshots import publish_catalog, snapshot_manifest
+from .stream import RatingBroadcaster, Subscription
+from .sketches import SKETCH_SIZE, RELATIVE_ERROR, add_rater, add_users, build_sketches, estimate, merge
 
-# Create your tests here.
+
+# Tests for the HyperLogLog rater sketches and their documented error bound
+class SketchTests(SimpleTestCase):
+
+    def test_empty_sketch(self):
+        self.assertIsNone(add_users(None, []))
+        self.assertEqual(estimate(None), 0)
+        self.assertIsNone(merge([None, None]))
+
+    def test_fixed_size(self):
+        self.assertEqual(len(add_users(None, [1])), SKETCH_SIZE)
+        self.assertEqual(len(add_users(None, range(100_000))), SKETCH_SIZE)
+
+    def test_adding_a_user_again_changes_nothing(self):
+        sketch = add_users(None, range(50))
+        self.assertIs(add_users(sketch, range(50)), sketch)
+        self.assertIs(add_users(sketch, [None]), sketch)
+
+    def test_small_counts_are_nearly_exact(self):
+        for n in [1, 2, 5, 10, 20]:
+            self.assertEqual(estimate(add_users(None, range(n))), n)
+        for n in [100, 500, 2000]:
+            self.assertAlmostEqual(estimate(add_users(None, range(n))), n, delta=n * 2 * RELATIVE_ERROR)
+
+    # Every estimate within three standard errors, and the spread over many sets
+    # of users no wider than the documented standard error
+    def test_error_bound(self):
+        errors = []
+        for n in [1_000, 10_000, 50_000]:
+            for start in range(0, 10 * n, n):
+                error = estimate(add_users(None, range(start, start + n))) / n - 1
+                self.assertLess(abs(error), 3 * RELATIVE_ERROR, f"{n} users from {start}")
+                errors.append(error)
+        rms = (sum(error * error for error in errors) / len(errors)) ** 0.5
+        self.assertLess(rms, RELATIVE_ERROR * 1.2)
+
+    def test_merge_is_the_sketch_of_the_union(self):
+        first = add_users(None, range(0, 3000))
+        second = add_users(None, range(2000, 6000))
+        self.assertEqual(merge([first, second]), add_users(None, range(6000)))
+        self.assertEqual(merge([first, None]), first)
+        self.assertAlmostEqual(estimate(merge([first, second])), 6000, delta=6000 * 3 * RELATIVE_ERROR)
+
+    def test_build_sketches(self):
+        sketches = build_sketches([("P1", 1, 1), ("P1", 1, 2), ("P2", 1, 1), ("P2", 2, None)])
+        self.assertEqual(sketches[("P1", 1)], add_users(None, [1, 2]))
+        self.assertEqual(sketches[("P2", 1)], add_users(None, [1]))
+        self.assertIsNone(sketches[("P2", 2)])
+
+    def test_backfill_migration_builds_the_same_sketches(self):
+        # The migration keeps its own copy of the helpers
+        migration = importlib.import_module("rate.migrations.0011_rating_summary_raters")
+        rows = [(f"P{n % 7}", n % 5, n) for n in range(5000)] + [("P1", 1, None)]
+        self.assertEqual(migration.build_sketches(rows), build_sketches(rows))
+
+
+# Tests for keeping the sketches up to date and rolling them up in /api/raters/
+class RatersTests(TestCase):
+    # Read-only views read from the replica when there is one, a mirror of default in tests
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.professors = [Professor.objects.create(id=f"P{n}", name=f"Professor {n}") for n in range(1, 3)]
+        cls.modules = [Module.objects.create(code=f"M{n}", desc=f"Module {n}") for n in range(1, 3)]
+        cls.instances = []
+        for module in cls.modules:
+            for year in [2023, 2024]:
+                instance = Module_instance.objects.create(mod=module, year=year, sem=1)
+                instance.prof.set(cls.professors)
+                cls.instances.append(instance)
+        cls.users = [User.objects.create_user(f"user{n}", password="Passw0rd!") for n in range(12)]
+
+    def sketch(self, professor, instance):
+        raters = Rating_summary.objects.get(professor=professor, module=instance).raters
+        return bytes(raters) if raters is not None else None
+
+    def test_rating_writes_update_the_sketch(self):
+        professor, instance = self.professors[0], self.instances[0]
+        Rating.objects.create(stars=4, professor=professor, module=instance, user=self.users[0])
+        upsert_rating(self.users[1], professor, instance, 3)
+        self.assertEqual(self.sketch(professor, instance), add_users(None, [self.users[0].pk, self.users[1].pk]))
+
+        # Changing the stars leaves the raters as they are
+        upsert_rating(self.users[1], professor, instance, 5)
+        self.assertEqual(estimate(self.sketch(professor, instance)), 2)
+
+    def test_add_rater_only_writes_new_raters(self):
+        professor, instance = self.professors[0], self.instances[0]
+        Rating.objects.create(stars=4, professor=professor, module=instance, user=self.users[0])
+        sketch = self.sketch(professor, instance)
+
+        self.assertTrue(add_rater(professor.pk, instance.pk, self.users[0].pk))
+        self.assertEqual(self.sketch(professor, instance), sketch)
+        self.assertTrue(add_rater(professor.pk, instance.pk, self.users[1].pk))
+        self.assertEqual(estimate(self.sketch(professor, instance)), 2)
+
+    def test_rollups(self):
+        # Users 0-5 rate professor 1 in every instance, users 6-11 rate professor 2 in 2024 only
+        for instance in self.instances:
+            for user in self.users[:6]:
+                Rating.objects.create(stars=3, professor=self.professors[0], module=instance, user=user)
+            if instance.year == 2024:
+                for user in self.users[6:]:
+                    Rating.objects.create(stars=5, professor=self.professors[1], module=instance, user=user)
+
+        client = APIClient()
+        response = client.get("/api/raters/", {"by": "professor"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(g["professor"]["id"], g["raters"], g["rating_count"]) for g in response.data["groups"]],
+                         [("P1", 6, 24), ("P2", 6, 12)])
+        self.assertEqual(response.data["total"], {"raters": 12, "rating_count": 36})
+
+        response = client.get("/api/raters/", {"by": "year,module"})
+        self.assertEqual([(g["year"], g["module"]["code"], g["raters"]) for g in response.data["groups"]],
+                         [(2023, "M1", 6), (2023, "M2", 6), (2024, "M1", 12), (2024, "M2", 12)])
+
+        response = client.get("/api/raters/", {"by": "module", "professor_id": "P2", "year": 2023})
+        self.assertEqual(response.data["groups"], [])
+        self.assertEqual(response.data["total"]["raters"], 0)
+
+    def test_bad_parameters(self):
+        client = APIClient()
+        self.assertEqual(client.get("/api/raters/", {"by": "user"}).status_code, 400)
+        self.assertEqual(client.get("/api/raters/", {"by": "year,year"}).status_code, 400)
+        self.assertEqual(client.get("/api/raters/", {"year": "soon"}).status_code, 400)
+        self.assertEqual(client.get("/api/raters/", {"professor_id": "XX"}).status_code, 404)
+        self.assertEqual(client.get("/api/raters/", {"module_code": "XX"}).status_code, 404)
+
+
+# Tests for the opt-in rating update mode and the summary deltas of every rating write
+class RatingTests(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.professor = Professor.objects.create(id="P1", name="Professor 1")
+        cls.instance = Module_instance.objects.create(mod=Module.objects.create(code="M1", desc="Module 1"),
+                                                      year=2024, sem=1)
+        cls.instance.prof.add(cls.professor)
+        cls.users = [User.objects.create_user(f"user{n}", password="Passw0rd!") for n in range(2)]
+
+    def rate(self, user, stars, **extra):
+        client = APIClient()
+        client.force_authenticate(user)
+        body = {"professor_id": "P1", "module_code": "M1", "year": 2024, "semester": 1, "stars": stars, **extra}
+        return client.post("/api/rate/", body, format="json")
+
+    def summary(self):
+        summary = Rating_summary.objects.get(professor=self.professor, module=self.instance)
+        return [summary.count, summary.total, summary.stars_1, summary.stars_2, summary.stars_3,
+                summary.stars_4, summary.stars_5]
+
+    def test_update_mode_returns_old_and_new_stars(self):
+        response = self.rate(self.users[0], 4, update=True)
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(response.data["previous_stars"])
+
+        response = self.rate(self.users[0], 2, update=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["previous_stars"], response.data["stars"]), (4, 2))
+        self.assertEqual(Rating.objects.get().stars, 2)
+        self.assertEqual(self.summary(), [1, 2, 0, 1, 0, 0, 0])
+        daily = Daily_rating.objects.get()
+        self.assertEqual((daily.count, daily.total), (1, 2))
+
+    def test_second_rating_without_update_is_refused(self):
+        self.assertEqual(self.rate(self.users[0], 4).status_code, 201)
+        response = self.rate(self.users[0], 1)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["existing_rating"], 4)
+        self.assertEqual(self.summary(), [1, 4, 0, 0, 0, 1, 0])
+
+    def test_model_writes_apply_deltas(self):
+        first = Rating.objects.create(stars=5, professor=self.professor, module=self.instance, user=self.users[0])
+        second = Rating.objects.create(stars=3, professor=self.professor, module=self.instance, user=self.users[1])
+        self.assertEqual(self.summary(), [2, 8, 0, 0, 1, 0, 1])
+
+        first.stars = 1
+        first.save()
+        self.assertEqual(self.summary(), [2, 4, 1, 0, 1, 0, 0])
+
+        second.delete()
+        self.assertEqual(self.summary(), [1, 1, 1, 0, 0, 0, 0])
+        daily = Daily_rating.objects.get()
+        self.assertEqual((daily.count, daily.total), (1, 1))
+
+    def test_rating_without_creation_time_has_no_daily_rollup(self):
+        rating = Rating.objects.create(stars=4, professor=self.professor, module=self.instance, user=self.users[0],
+                                       created_at=None)
+        rating.stars = 2
+        rating.save()
+        self.assertEqual(self.summary(), [1, 2, 0, 1, 0, 0, 0])
+        self.assertFalse(Daily_rating.objects.exists())
+
+        rating.delete()
+        self.assertEqual(self.summary(), [0, 0, 0, 0, 0, 0, 0])
+        self.assertFalse(Daily_rating.objects.exists())
+
+
+# Tests for /api/trending/: the current and previous windows and the movement between them
+class TrendingTests(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        instance = Module_instance.objects.create(mod=Module.objects.create(code="M1", desc="Module 1"),
+                                                  year=2024, sem=1)
+        professors = [Professor.objects.create(id=f"P{n}", name=f"Professor {n}") for n in range(1, 4)]
+        users = iter([User.objects.create_user(f"user{n}", password="Passw0rd!") for n in range(7)])
+        now = timezone.now()
+        # (professor, stars, days ago), None for a rating made before creation times were recorded
+        for professor, stars, days_ago in [(0, 5, 10), (0, 5, 12), (0, 2, 1),
+                                           (1, 3, 8), (1, 4, 0), (1, 1, None),
+                                           (2, 5, 20)]:
+            Rating.objects.create(stars=stars, professor=professors[professor], module=instance, user=next(users),
+                                  created_at=None if days_ago is None else now - timedelta(days=days_ago))
+
+    def trending(self, **params):
+        return APIClient().get("/api/trending/", params)
+
+    def test_windows_compare_with_the_days_before(self):
+        response = self.trending(days=7)
+        self.assertEqual(response.status_code, 200)
+        today = timezone.now().date()
+        self.assertEqual((response.data["from"], response.data["to"]), (today - timedelta(days=6), today))
+        self.assertEqual(response.data["professors"], [
+            {"id": "P1", "name": "Professor 1", "average_rating": 2.0, "rating_count": 1,
+             "previous_average_rating": 5.0, "previous_rating_count": 2, "change": -3.0},
+            {"id": "P2", "name": "Professor 2", "average_rating": 4.0, "rating_count": 1,
+             "previous_average_rating": 3.0, "previous_rating_count": 1, "change": 1.0},
+        ])
+        self.assertEqual([p["id"] for p in response.data["trending"]], ["P1", "P2"])
+        self.assertEqual([p["id"] for p in self.trending(days=7, limit=1).data["trending"]], ["P1"])
+
+    def test_professor_rated_in_one_window_is_not_trending(self):
+        response = self.trending(days=1)
+        self.assertEqual([(p["id"], p["rating_count"], p["previous_rating_count"], p["change"])
+                          for p in response.data["professors"]], [("P1", 0, 1, None), ("P2", 1, 0, None)])
+        self.assertEqual(response.data["trending"], [])
+
+        response = self.trending(days=30)
+        self.assertEqual([(p["id"], p["rating_count"]) for p in response.data["professors"]],
+                         [("P1", 3), ("P2", 2), ("P3", 1)])
+
+    def test_days_are_validated(self):
+        for days in ["0", "366", "week"]:
+            self.assertEqual(self.trending(days=days).status_code, 400)
+
+
+# Tests for the /api/changes/ feed
+class ChangeFeedTests(TestCase):
+    databases = "__all__"
+
+    def changes(self, since=0, **params):
+        response = APIClient().get("/api/changes/", {"since": since, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_catalog_and_rating_changes(self):
+        professor = Professor.objects.create(id="P1", name="Professor 1")
+        instance = Module_instance.objects.create(mod=Module.objects.create(code="M1", desc="Module 1"),
+                                                  year=2024, sem=1)
+        instance.prof.add(professor)
+        feed = self.changes()
+        self.assertFalse(feed["has_more"])
+        # The instance was saved, then its professors set: one entry with the professors in it
+        self.assertEqual([(c["entity"], c["key"], c["op"]) for c in feed["changes"]],
+                         [("professor", "P1", "upsert"), ("module", "M1", "upsert"),
+                          ("module_instance", str(instance.pk), "upsert")])
+        self.assertEqual(feed["changes"][-1]["data"]["professors"], ["P1"])
+
+        # Only what changed after the cursor comes back
+        cursor = feed["cursor"]
+        rating = Rating.objects.create(stars=4, professor=professor, module=instance,
+                                       user=User.objects.create_user("student", password="Passw0rd!"))
+        professor.name = "Professor One"
+        professor.save()
+        feed = self.changes(cursor)
+        self.assertEqual([(c["entity"], c["op"]) for c in feed["changes"]], [("rating", "upsert"), ("professor", "upsert")])
+        self.assertEqual(feed["changes"][0]["data"]["stars"], 4)
+        self.assertEqual(feed["changes"][1]["data"]["name"], "Professor One")
+
+        cursor = feed["cursor"]
+        key = str(rating.pk)
+        rating.delete()
+        feed = self.changes(cursor)
+        self.assertEqual(feed["changes"], [{"seq": cursor + 1, "entity": "rating", "key": key, "op": "delete", "data": None}])
+        self.assertEqual(self.changes(feed["cursor"])["changes"], [])
+
+    def test_paging(self):
+        for n in range(5):
+            Professor.objects.create(id=f"P{n}", name=f"Professor {n}")
+        feed = self.changes(limit=2)
+        self.assertTrue(feed["has_more"])
+        keys = [c["key"] for c in feed["changes"]]
+        while feed["has_more"]:
+            feed = self.changes(feed["cursor"], limit=2)
+            keys += [c["key"] for c in feed["changes"]]
+        self.assertEqual(keys, [f"P{n}" for n in range(5)])
+
+    def test_bad_parameters(self):
+        client = APIClient()
+        self.assertEqual(client.get("/api/changes/", {"since": "soon"}).status_code, 400)
+        self.assertEqual(client.get("/api/changes/", {"since": -1}).status_code, 400)
+        self.assertEqual(client.get("/api/changes/", {"limit": 0}).status_code, 400)
+
+
+# Tests for the repeated query detector
+class NPlusOneTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        module = Module.objects.create(code="M1", desc="Module 1")
+        for year in range(2020, 2026):
+            Module_instance.objects.create(mod=module, year=year, sem=1)
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x' LIMIT 21"),
+                         fingerprint("SELECT * FROM t WHERE id IN (%s) AND name = 'y' LIMIT 5"))
+
+    def test_loop_is_reported(self):
+        with self.assertRaises(NPlusOneError):
+            with detect_nplusone("raise"):
+                [instance.mod.desc for instance in Module_instance.objects.all()]
+
+    def test_prefetched_loop_is_not(self):
+        with detect_nplusone("raise") as detector:
+            [instance.mod.desc for instance in Module_instance.objects.select_related("mod")]
+        self.assertEqual(detector.repeated(), [])
+
+
+# Tests for the rating changelist, its queries must not grow with the table
+class RatingAdminTests(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.professor = Professor.objects.create(id="P1", name="Professor 1")
+        cls.instance = Module_instance.objects.create(mod=Module.objects.create(code="M1", desc="Module 1"),
+                                                      year=2024, sem=1)
+        cls.admin = User.objects.create_superuser("admin", password="Passw0rd!")
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_ratings(self, count):
+        start = User.objects.count()
+        users = [User.objects.create_user(f"user{start + n}") for n in range(count)]
+        for n, user in enumerate(users):
+            Rating.objects.create(stars=n % 5 + 1, professor=self.professor, module=self.instance, user=user)
+
+    def changelist(self, query=""):
+        with CaptureQueriesContext(connections["default"]) as queries:
+            response = self.client.get(f"/admin/rate/rating/{query}")
+        self.assertEqual(response.status_code, 200)
+        return response, [q["sql"] for q in queries.captured_queries]
+
+    def test_stars_filter_has_fixed_choices(self):
+        self.add_ratings(10)
+        response, sql = self.changelist("?stars=3")
+        self.assertEqual(response.context["cl"].result_count, 2)
+        self.assertEqual({rating.stars for rating in response.context["cl"].result_list}, {3})
+        self.assertFalse([q for q in sql if "DISTINCT" in q.upper()])
+
+    def test_query_count_does_not_grow_with_ratings(self):
+        self.add_ratings(5)
+        _, small = self.changelist()
+        _, small_filtered = self.changelist("?stars=2")
+        self.add_ratings(50)
+        _, large = self.changelist()
+        _, large_filtered = self.changelist("?stars=2")
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(len(small_filtered), len(large_filtered))
+
+
+# Tests for content negotiation: orjson output, NDJSON and MessagePack
+class NegotiationTests(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        for n in range(3):
+            Professor.objects.create(id=f"P{n}", name=f"Professor {n}")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.expected = {"professors": [{"id": f"P{n}", "name": f"Professor {n}", "average_rating": 0,
+                                         "rating_count": 0} for n in range(3)]}
+
+    def test_json(self):
+        response = self.client.get("/api/view/")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(json.loads(response.content), self.expected)
+        # Compact either way, orjson must not change the bytes
+        self.assertEqual(response.content, json.dumps(self.expected, separators=(",", ":")).encode())
+        with mock.patch("rate.renderers.orjson", None):
+            self.assertEqual(self.client.get("/api/view/").content, response.content)
+
+        indented = self.client.get("/api/view/", HTTP_ACCEPT="application/json; indent=2")
+        self.assertEqual(json.loads(indented.content), self.expected)
+        self.assertIn(b'\n  "professors"', indented.content)
+
+    def test_ndjson_is_one_item_per_line(self):
+        for kwargs in [{"data": {"format": "ndjson"}}, {"HTTP_ACCEPT": "application/x-ndjson"}]:
+            with self.subTest(kwargs=kwargs):
+                response = self.client.get("/api/view/", **kwargs)
+                self.assertEqual(response["Content-Type"], "application/x-ndjson")
+                lines = response.content.decode().splitlines()
+                self.assertEqual([json.loads(line) for line in lines], self.expected["professors"])
+
+    @skipUnless(find_spec("msgpack"), "msgpack is not installed")
+    def test_msgpack_both_ways(self):
+        import msgpack
+        response = self.client.get("/api/view/", HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(response.content), self.expected)
+        self.assertEqual(msgpack.unpackb(self.client.get("/api/view/", {"format": "msgpack"}).content),
+                         self.expected)
+
+        body = msgpack.packb({"username": "packed", "email": "packed@example.com", "password": "Passw0rd!"})
+        response = self.client.post("/api/register/", body, content_type="application/msgpack",
+                                    HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(User.objects.filter(username="packed").exists())
+        response = self.client.post("/api/register/", b"\xc1", content_type="application/msgpack")
+        self.assertEqual(response.status_code, 400)
+
+
+# Tests for response compression: the size threshold, picking an encoding and Vary
+class CompressionTests(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        for n in range(20):
+            Professor.objects.create(id=f"P{n}", name=f"Professor {n}")
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def get(self, **kwargs):
+        response = self.client.get("/api/view/", **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_small_responses_are_left_alone(self):
+        size = len(self.get().content)
+        with override_settings(RESPONSE_COMPRESSION_MIN_SIZE=size + 1):
+            response = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertNotIn("Accept-Encoding", response.get("Vary", ""))
+
+        with override_settings(RESPONSE_COMPRESSION_MIN_SIZE=size):
+            response = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_SIZE=100)
+    def test_compressed_body_and_vary(self):
+        identity = self.get()
+        # Varies even when the client asked for no compression, a cache must not serve it to every client
+        self.assertFalse(identity.has_header("Content-Encoding"))
+        self.assertIn("Accept-Encoding", identity["Vary"])
+
+        response = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(gzip.decompress(response.content), identity.content)
+        self.assertEqual(response["Content-Length"], str(len(response.content)))
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_SIZE=100)
+    def test_encoding_is_negotiated(self):
+        cases = [
+            ("gzip;q=0, identity", None),
+            ("gzip, deflate", "gzip"),
+            ("deflate", None),
+            ("gzip;q=0.5, br;q=0.4", "gzip"),
+        ]
+        if "br" in COMPRESSORS:
+            cases.append(("gzip, br", "br"))
+        if "zstd" in COMPRESSORS:
+            cases.append(("*", "zstd"))
+        for accept, encoding in cases:
+            with self.subTest(accept=accept):
+                self.assertEqual(self.get(HTTP_ACCEPT_ENCODING=accept).get("Content-Encoding"), encoding)
+        with override_settings(RESPONSE_COMPRESSION_ENCODINGS=["gzip"]):
+            self.assertEqual(self.get(HTTP_ACCEPT_ENCODING="br, zstd, gzip")["Content-Encoding"], "gzip")
+
+
+# Tests for skipping the site middleware on /api/: the admin keeps sessions and CSRF
+class SiteMiddlewareTests(TestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.client = Client(enforce_csrf_checks=True)
+
+    def test_api_gets_no_session_or_csrf(self):
+        response = self.client.post("/api/register/", {"username": "lean", "email": "lean@example.com",
+                                                        "password": "Passw0rd!"}, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(hasattr(response.wsgi_request, "session"))
+        self.assertFalse(response.cookies)
+        self.assertNotIn("X-Frame-Options", response)
+
+    def test_admin_keeps_session_and_csrf(self):
+        response = self.client.get("/admin/login/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(hasattr(response.wsgi_request, "session"))
+        self.assertIn("csrftoken", response.cookies)
+        self.assertEqual(response["X-Frame-Options"], "DENY")
+
+        User.objects.create_superuser("admin", password="Passw0rd!")
+        credentials = {"username": "admin", "password": "Passw0rd!", "next": "/admin/"}
+        self.assertEqual(self.client.post("/admin/login/", credentials).status_code, 403)
+
+        credentials["csrfmiddlewaretoken"] = response.cookies["csrftoken"].value
+        response = self.client.post("/admin/login/", credentials)
+        self.assertRedirects(response, "/admin/")
+        self.assertIn("sessionid", response.cookies)
+        self.assertEqual(self.client.get("/admin/").status_code, 200)
+
+
+# Tests for the access log and its per phase timings
+class AccessLogTests(TestCase):
+    databases = "__all__"
+
+    def test_phases_do_not_overlap(self):
+        timings = RequestTimings()
+        timings.switch("validation")
+        with timings.phase("db"):
+            with timings.phase("render"):
+                pass
+        timings.switch(None)
+        total = sum(timings.seconds.values())
+        self.assertLessEqual(total, timings.mark - timings.start + 1e-9)
+        self.assertEqual(list(timings.fields()), [f"{phase}_ms" for phase in PHASES] + ["queries"])
+
+    def test_request_is_logged_with_its_phases(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "access.log")
+        # The handler is per process, a fresh one writes to this test's file
+        self.addCleanup(setattr, accesslog, "_handler", None)
+        self.addCleanup(lambda: accesslog.logger.removeHandler(accesslog._handler))
+        self.addCleanup(flush_access_log)
+
+        professor = Professor.objects.create(id="P1", name="Professor 1")
+        instance = Module_instance.objects.create(mod=Module.objects.create(code="M1", desc="Module 1"),
+                                                  year=2024, sem=1)
+        instance.prof.add(professor)
+        user = User.objects.create_user("student", password="Passw0rd!")
+        token = Token.objects.create(user=user)
+
+        with override_settings(ACCESS_LOG_FILE=path, ACCESS_LOG_SAMPLE_RATE=1.0):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+            body = {"professor_id": "P1", "module_code": "M1", "year": 2024, "semester": 1, "stars": 4}
+            self.assertEqual(client.post("/api/rate/", body, format="json").status_code, 201)
+            flush_access_log()
+
+        with open(path) as log:
+            record = json.loads(log.readline())
+        self.assertEqual((record["endpoint"], record["status"], record["user"]), ("api/rate/", 201, user.pk))
+        self.assertGreater(record["queries"], 0)
+        for phase in PHASES:
+            self.assertGreater(record[f"{phase}_ms"], 0)
+        self.assertGreaterEqual(record["total_ms"], sum(record[f"{phase}_ms"] for phase in PHASES))
+
+
+# Tests for bulk account provisioning, with a fast hasher
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class ProvisioningTests(TestCase):
+
+    def test_provision_users(self):
+        User.objects.create_user("taken", email="taken@example.com", password="Passw0rd!")
+        results = provision_users([
+            {"username": "new1", "email": "new1@example.com", "password": "Passw0rd!"},
+            {"username": "new2", "email": "new2@example.com", "password": ""},
+            {"username": "taken", "email": "other@example.com", "password": "Passw0rd!"},
+            {"username": "new3", "email": "taken@example.com", "password": "Passw0rd!"},
+            {"username": "new1", "email": "again@example.com", "password": "Passw0rd!"},
+            {"username": "new4", "email": "not an email", "password": "Passw0rd!"},
+            {"username": "new5", "email": "new5@example.com", "password": "weak"},
+        ], issue_tokens=True, workers=1)
+
+        self.assertEqual([result["status"] for result in results],
+                         ["created", "created", "conflict", "conflict", "conflict", "invalid", "invalid"])
+        self.assertTrue(User.objects.get(username="new1").check_password("Passw0rd!"))
+        self.assertTrue(User.objects.get(username="new2").check_password(results[1]["password"]))
+        self.assertEqual(Token.objects.get(key=results[0]["token"]).user.username, "new1")
+        self.assertEqual(User.objects.count(), 3)
+
+    def test_fields_must_be_strings(self):
+        results = provision_users([
+            {"username": 12, "email": "new1@example.com", "password": "Passw0rd!"},
+            {"username": "new2", "email": ["new2@example.com"], "password": "Passw0rd!"},
+            {"username": "new3", "email": "new3@example.com", "password": 12345678},
+        ], workers=1)
+        self.assertEqual([(result["status"], result["error"]) for result in results],
+                         [("invalid", "Username must be a string"), ("invalid", "Email must be a string"),
+                          ("invalid", "Password must be a string")])
+        self.assertFalse(User.objects.exists())
+
+    def test_dry_run_creates_nothing(self):
+        results = provision_users([{"username": "new1", "email": "new1@example.com", "password": "Passw0rd!"}],
+                                  dry_run=True)
+        self.assertEqual(results[0]["status"], "valid")
+        self.assertFalse(User.objects.exists())
+
+    def test_bulk_endpoint_is_staff_only(self):
+        client = APIClient()
+        body = {"users": [{"username": "new1", "email": "new1@example.com", "password": "Passw0rd!"}]}
+        user = User.objects.create_user("student", password="Passw0rd!")
+        client.force_authenticate(user)
+        self.assertEqual(client.post("/api/users/bulk/", body, format="json").status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        response = client.post("/api/users/bulk/", body, format="json")
+        self.assertEqual((response.status_code, response.data["created"]), (200, 1))
+
+
+# Tests for publishing the catalog snapshots and serving /api/list/ from them
+class SnapshotTests(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        professor = Professor.objects.create(id="P1", name="Professor 1")
+        for year in [2023, 2024]:
+            instance = Module_instance.objects.create(mod=Module.objects.create(code=f"M{year}", desc="Module"),
+                                                      year=year, sem=1)
+            instance.prof.add(professor)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(CATALOG_SNAPSHOT_DIR=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # The catalog version is cached per process
+        snapshot_manifest._version = None
+
+    def test_list_is_served_from_the_snapshot(self):
+        client = APIClient()
+        rendered = client.get("/api/list/").content
+        manifest = publish_catalog()
+        self.assertEqual(sorted(manifest["files"]), ["2023", "2024", "all"])
+
+        response = client.get("/api/list/")
+        self.assertEqual(b"".join(response.streaming_content), rendered)
+        self.assertEqual(response["ETag"], '"%s"' % manifest["files"]["all"]["json"]["etag"])
+        self.assertEqual(response["Cache-Control"], "public, max-age=60")
+        self.assertEqual(client.get("/api/list/", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+        response = client.get("/api/list/", {"year": 2024}, HTTP_ACCEPT="application/x-ndjson")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(b"".join(response.streaming_content).count(b"\n"), 1)
+        # Years without a snapshot are rendered as before, and only cached if they are in the catalog
+        self.assertEqual(client.get("/api/list/", {"year": 1999}).json(), {"modules": []})
+        self.assertFalse(any(key.startswith("catalog:") for key, _ in encoded_cache._entries))
+        self.assertEqual(client.get("/api/list/", {"year": "soon"}).status_code, 400)
+
+    def test_a_new_snapshot_replaces_the_old_one(self):
+        first = publish_catalog()["files"]
+        Module.objects.filter(code="M2023").update(desc="Renamed")
+        second = publish_catalog()["files"]
+
+        self.assertNotEqual(first["2023"], second["2023"])
+        self.assertEqual(first["2024"], second["2024"])
+        self.assertEqual(os.readlink(os.path.join(self.directory, "catalog-2023.json")), second["2023"]["json"]["file"])
+        self.assertIn(b"Renamed", b"".join(APIClient().get("/api/list/", {"year": 2023}).streaming_content))
+
+    def test_out_of_date_snapshot_is_not_served(self):
+        publish_catalog()
+        client = APIClient()
+        self.assertTrue(client.get("/api/list/").streaming)
+
+        # Changed and not published yet
+        module = Module.objects.get(code="M2023")
+        module.desc = "Renamed"
+        module.save()
+        response = client.get("/api/list/")
+        self.assertFalse(response.streaming)
+        self.assertIn(b"Renamed", response.content)
+
+        # A manifest from another database
+        publish_catalog()
+        path = os.path.join(self.directory, "current.json")
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest["catalog_version"] += 1000
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+        self.assertFalse(client.get("/api/list/").streaming)
+
+    def test_redirect_to_the_versioned_file(self):
+        name = publish_catalog()["files"]["all"]["json"]["file"]
+        client = APIClient()
+        with override_settings(CATALOG_SNAPSHOT_REDIRECT=True):
+            response = client.get("/api/list/")
+        self.assertEqual((response.status_code, response["Location"]), (302, f"/api/list/snapshots/{name}"))
+
+        response = client.get(response["Location"], HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual((response.status_code, response["Content-Encoding"]), (200, "gzip"))
+        self.assertEqual(response["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual(client.get("/api/list/snapshots/catalog.0123456789abcdef.json").status_code, 404)
+
+
+# Tests for the in-memory snapshot replica (rate/db/snapshot): commits show up, and a
+# pinned snapshot reads one state for the whole of a read-only view
+class ReplicaTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "db.sqlite3")
+        self.writer = sqlite3.connect(path)
+        self.addCleanup(self.writer.close)
+        with self.writer:
+            self.writer.execute("CREATE TABLE note (id INTEGER PRIMARY KEY)")
+            self.writer.execute("INSERT INTO note DEFAULT VALUES")
+
+        settings_dict = connections.configure_settings({
+            "default": {"ENGINE": "rate.db.snapshot", "NAME": path, "OPTIONS": {"max_staleness": 0}}})["default"]
+        self.replica = SnapshotWrapper(settings_dict, alias="snapshot")
+        self.addCleanup(self.replica.close)
+
+    def write(self):
+        with self.writer:
+            self.writer.execute("INSERT INTO note DEFAULT VALUES")
+
+    def count(self):
+        with self.replica.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM note")
+            return cursor.fetchone()[0]
+
+    def test_commit_becomes_visible(self):
+        self.assertEqual(self.count(), 1)
+        self.write()
+        self.assertEqual(self.count(), 2)
+
+    def test_pinned_snapshot_reads_one_state(self):
+        self.assertEqual(self.count(), 1)
+        self.replica.pin_snapshot()
+        self.write()
+        self.assertEqual(self.count(), 1)
+        self.replica.unpin_snapshot()
+        self.assertEqual(self.count(), 2)
+
+    def test_read_only_views_pin_the_replica(self):
+        @read_only
+        def view():
+            before = self.count()
+            self.write()
+            return before, self.count()
+
+        with mock.patch.dict(settings.DATABASES, {REPLICA: {}}), \
+                mock.patch("rate.routers.connections", {REPLICA: self.replica}):
+            self.count()
+            self.write()
+            # Brought up to date when the view starts, then held
+            self.assertEqual(view(), (2, 2))
+        self.assertEqual(self.count(), 3)
+
+
+# Tests for admission control: client token buckets and per class concurrency
+class AdmissionTests(TestCase):
+
+    def test_concurrency_limit_sheds(self):
+        state = AdmissionState(["expensive"], 4, 16)
+        config = {"concurrency": 1, "queue": 0}
+        self.assertTrue(state.acquire(0, config))
+        self.assertFalse(state.acquire(0, config))
+        state.release(0)
+        self.assertTrue(state.acquire(0, config))
+        self.assertEqual(state.stats()["classes"]["expensive"]["shed"], 1)
+
+    # A worker killed while holding the lock must not hang the others
+    @mock.patch("rate.admission.LOCK_TIMEOUT", 0.05)
+    def test_dead_lock_holder_fails_open(self):
+        state = AdmissionState(["expensive"], 4, 16)
+        config = {"concurrency": 1, "queue": 0}
+        self.assertTrue(state.acquire(0, config))
+        pid = os.fork()
+        if pid == 0:
+            state.lock.acquire()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        with self.assertLogs("rate.admission", "ERROR"):
+            self.assertEqual(state.acquire(0, config), AdmissionState.UNCOUNTED)
+        self.assertEqual(state.take_token("10.0.0.1", 0.01, 1), 0)
+        self.assertEqual(state.take_token("10.0.0.1", 0.01, 1), 0)
+        state.release(0)
+        stats = state.stats()
+        self.assertTrue(stats["fail_open"])
+        self.assertEqual(stats["classes"]["expensive"]["in_flight"], 1)
+
+    def test_token_bucket(self):
+        state = AdmissionState([], 4, 16)
+        self.assertEqual([state.take_token("10.0.0.1", 1, 2) > 0 for _ in range(3)], [False, False, True])
+        self.assertEqual(state.take_token("10.0.0.2", 1, 2), 0)
+
+    # A made-up token per request must not buy a fresh bucket
+    @override_settings(ADMISSION_RATE_LIMIT={"rate": 0.01, "burst": 2})
+    def test_clients_are_throttled_by_address(self):
+        client = APIClient(REMOTE_ADDR="10.0.38.1")
+        statuses = [client.get("/api/admission/", HTTP_AUTHORIZATION=f"Token madeup{n}").status_code
+                    for n in range(3)]
+        self.assertEqual(statuses[2], 429)
+        self.assertEqual(APIClient(REMOTE_ADDR="10.0.38.2").get("/api/admission/").status_code, 200)
+
+
+# Tests for write-behind rating ingestion: receipts, replay and stuck segments
+class IngestTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.professor = Professor.objects.create(id="P1", name="Professor 1")
+        cls.instance = Module_instance.objects.create(mod=Module.objects.create(code="M1", desc="Module 1"),
+                                                      year=2024, sem=1)
+        cls.instance.prof.add(cls.professor)
+        cls.user = User.objects.create_user("student", password="Passw0rd!")
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(RATING_INGEST_ASYNC=True, RATING_INGEST_DIR=directory.name,
+                                     RATING_INGEST_MAX_ATTEMPTS=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_accepted_rating_is_applied_with_a_receipt(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        body = {"professor_id": "P1", "module_code": "M1", "year": 2024, "semester": 1, "stars": 4}
+        response = client.post("/api/rate/", body, format="json")
+        self.assertEqual(response.status_code, 202)
+        status_url = response.data["status_url"]
+        self.assertEqual(client.get(status_url).data["status"], "pending")
+        self.assertFalse(Rating.objects.exists())
+
+        self.assertEqual(drain(), 1)
+        self.assertEqual(client.get(status_url).data["status"], "applied")
+        self.assertEqual(Rating.objects.get().stars, 4)
+        self.assertEqual(Rating_summary.objects.get().count, 1)
+
+        # Once applied, rating again is refused straight away
+        self.assertEqual(client.post("/api/rate/", body, format="json").status_code, 400)
+
+    def test_rating_still_in_the_log_is_not_accepted_twice(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        body = {"professor_id": "P1", "module_code": "M1", "year": 2024, "semester": 1, "stars": 4}
+        first = client.post("/api/rate/", body, format="json")
+        self.assertEqual(first.status_code, 202)
+
+        response = client.post("/api/rate/", {**body, "stars": 1}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((response.data["existing_rating"], response.data["receipt"]), (4, first.data["receipt"]))
+        # Within one batch too
+        response = client.post("/api/rate/batch/", {"ratings": [{**body, "stars": 2}]}, format="json")
+        self.assertEqual(response.data["results"][0]["status_code"], 400)
+        # Updates are still accepted, they replace the stars
+        self.assertEqual(client.post("/api/rate/", {**body, "stars": 5, "update": True}, format="json").status_code, 202)
+
+        self.assertEqual(drain(), 2)
+        self.assertEqual(Rating.objects.get().stars, 5)
+        self.assertFalse(Rating_receipt.objects.filter(status="rejected").exists())
+
+    def test_replayed_segment_is_applied_once(self):
+        receipt = enqueue_rating(self.user, self.professor, self.instance, 5)
+        with open(ingest_path(LIVE_LOG), "rb") as log:
+            line = log.read()
+        self.assertEqual(drain(), 1)
+        # A crash before the segment was removed replays it
+        with open(ingest_path("ratings.00000000000000000001.log"), "wb") as segment:
+            segment.write(line)
+        self.assertEqual(drain(), 0)
+        self.assertEqual(Rating.objects.count(), 1)
+        self.assertEqual(Rating_receipt.objects.get(id=receipt).status, "applied")
+
+    def test_ratings_of_deleted_users_are_not_counted(self):
+        user = User.objects.create_user("leaving", password="Passw0rd!")
+        receipt = enqueue_rating(user, self.professor, self.instance, 2)
+        user.delete()
+        with self.assertLogs("rate.ingest", "WARNING"):
+            self.assertEqual(drain(), 0)
+        self.assertFalse(Rating_receipt.objects.filter(id=receipt).exists())
+        self.assertEqual(sealed_segments(), [])
+
+    def test_failing_segment_is_quarantined(self):
+        with open(ingest_path("ratings.00000000000000000001.log"), "wb") as segment:
+            segment.write(b'{"id":"broken","user":1}\n')
+        receipt = enqueue_rating(self.user, self.professor, self.instance, 3)
+
+        with self.assertRaises(KeyError):
+            drain()
+        with self.assertLogs("rate.ingest", "ERROR"):
+            self.assertEqual(drain(), 1)
+        self.assertEqual(Rating_receipt.objects.get(id=receipt).status, "applied")
+        self.assertEqual(sealed_segments(), [])
+        self.assertTrue(os.path.exists(ingest_path("ratings.00000000000000000001.log.quarantined")))
+
+    def test_pending_index_follows_the_log(self):
+        first = enqueue_rating(self.user, self.professor, self.instance, 3)
+        self.assertEqual(find_pending(first)["stars"], 3)
+        second = enqueue_rating(self.user, self.professor, self.instance, 4, update=True)
+        self.assertEqual(find_pending(second)["stars"], 4)
+        self.assertIsNotNone(find_pending(first))
+
+        drain()
+        self.assertIsNone(find_pending(first))
+        self.assertIsNone(find_pending(second))
+
+
+# Tests for the rating stream: slow clients and a failing poll
+class StreamTests(SimpleTestCase):
+
+    def test_slow_client_gets_the_latest_of_every_professor(self):
+        async def scenario():
+            subscription = Subscription()
+            for n in range(1000):
+                subscription.push([{"id": f"P{n % 3}", "average": n}])
+            return await subscription.get()
+
+        self.assertEqual(asyncio.run(scenario()),
+                         [{"id": "P0", "average": 999}, {"id": "P1", "average": 997}, {"id": "P2", "average": 998}])
+
+    @override_settings(RATING_STREAM_WINDOW=0)
+    def test_poll_errors_do_not_stop_the_broadcaster(self):
+        class FlakyBroadcaster(RatingBroadcaster):
+            polls = 0
+
+            async def poll(self):
+                self.polls += 1
+                if self.polls == 1:
+                    raise RuntimeError("database is locked")
+                self.publish([{"id": "P1", "average": 4}])
+
+        async def scenario():
+            broadcaster = FlakyBroadcaster()
+            subscription = Subscription()
+            broadcaster.subscribers.add(subscription)
+            task = asyncio.ensure_future(broadcaster.run())
+            professors = await asyncio.wait_for(subscription.get(), 1)
+            broadcaster.unsubscribe(subscription)
+            await task
+            return professors
+
+        with self.assertLogs("rate.stream", "ERROR"):
+            self.assertEqual(asyncio.run(scenario()), [{"id": "P1", "average": 4}])
+
+
+# Tests for "manage.py archive_year": copy, verify, summary rebuild and delete
+class ArchiveTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.professors = [Professor.objects.create(id=f"P{n}", name=f"Professor {n}") for n in range(1, 3)]
+        module = Module.objects.create(code="M1", desc="Module 1")
+        cls.instances = {year: Module_instance.objects.create(mod=module, year=year, sem=1) for year in [2023, 2024]}
+        cls.users = [User.objects.create_user(f"user{n}", password="Passw0rd!") for n in range(5)]
+        for n, user in enumerate(cls.users):
+            Rating.objects.create(stars=n + 1, professor=cls.professors[0], module=cls.instances[2023], user=user)
+        Rating.objects.create(stars=2, professor=cls.professors[1], module=cls.instances[2023], user=cls.users[0])
+        # A rating whose user was removed
+        Rating.objects.create(stars=5, professor=cls.professors[1], module=cls.instances[2023], user=None)
+        Rating.objects.create(stars=4, professor=cls.professors[0], module=cls.instances[2024], user=cls.users[0])
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "ratings_2023.sqlite3")
+        settings = override_settings(ARCHIVE_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.live_ids = list(Rating.objects.filter(module__year=2023).order_by("id").values_list("id", flat=True))
+
+    def archive(self, **options):
+        out = io.StringIO()
+        call_command("archive_year", "2023", chunk_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def summary(self, professor):
+        return Rating_summary.objects.get(professor=professor, module=self.instances[2023])
+
+    def assert_archived(self):
+        self.assertFalse(Rating.objects.filter(module__year=2023).exists())
+        self.assertEqual(Rating.objects.get().module, self.instances[2024])
+        with closing(sqlite3.connect(self.path)) as archive:
+            self.assertEqual([row[0] for row in archive.execute("SELECT id FROM rating ORDER BY id")], self.live_ids)
+
+        first, second = self.summary(self.professors[0]), self.summary(self.professors[1])
+        self.assertEqual([first.count, first.total, first.stars_1, first.stars_2, first.stars_3, first.stars_4,
+                          first.stars_5], [5, 15, 1, 1, 1, 1, 1])
+        self.assertEqual([second.count, second.total, second.stars_2, second.stars_5], [2, 7, 1, 1])
+        self.assertEqual(bytes(first.raters), add_users(None, [user.pk for user in self.users]))
+        self.assertEqual(bytes(second.raters), add_users(None, [self.users[0].pk]))
+        self.assertEqual(Archived_year.objects.get(year=2023).rating_count, 7)
+
+        # Every archived rating is a delete in the change feed, once
+        deletes = Change.objects.filter(entity="rating", op="delete").values_list("key", flat=True)
+        self.assertEqual(sorted(deletes), sorted(str(pk) for pk in self.live_ids))
+
+    def test_archive(self):
+        out = self.archive()
+        self.assertIn("Copied 7 of 7 ratings", out)
+        self.assertIn("Deleted 7 ratings", out)
+        self.assert_archived()
+
+        # Closed years take no new ratings
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        body = {"professor_id": "P1", "module_code": "M1", "year": 2023, "semester": 1, "stars": 3, "update": True}
+        self.assertEqual(client.post("/api/rate/", body, format="json").status_code, 400)
+
+    def test_rerun_after_interruption(self):
+        # Dies after the copy, before anything is rebuilt
+        with mock.patch.object(ArchiveYear, "rebuild_summaries", side_effect=RuntimeError("killed")):
+            with self.assertRaises(RuntimeError):
+                self.archive()
+        self.assertEqual(Rating.objects.filter(module__year=2023).count(), 7)
+
+        # Dies while deleting the second chunk, which is rolled back
+        calls = []
+
+        def record_changes(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError("killed")
+            real_record_changes(*args)
+
+        with mock.patch("rate.management.commands.archive_year.record_changes", record_changes):
+            with self.assertRaises(RuntimeError):
+                self.archive()
+        self.assertEqual(Rating.objects.filter(module__year=2023).count(), 5)
+
+        out = self.archive()
+        self.assertIn("Copied 0 of 5 ratings", out)
+        self.assertIn("Deleted 5 ratings", out)
+        self.assert_archived()
+
+    def test_nothing_is_deleted_unless_verified(self):
+        with mock.patch.object(ArchiveYear, "copy_ratings", return_value=(7, 0)):
+            with self.assertRaisesMessage(CommandError, "Only 0 of 7 live ratings are in the archive"):
+                self.archive()
+        self.assertEqual(Rating.objects.filter(module__year=2023).count(), 7)
+        self.assertEqual(self.summary(self.professors[0]).count, 5)
+        self.assertFalse(Change.objects.filter(op="delete").exists())
+
+
+# Clock for the maintenance tasks that moves a second every time it is read
+class TickingClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        self.now += 1
+        return self.now
+
+
+# Tests for the integrity checks of "manage.py maintain": repair, the time budget and carrying on
+class MaintenanceTests(TestCase):
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.professor = Professor.objects.create(id="P1", name="Professor 1")
+        cls.instances = [Module_instance.objects.create(mod=Module.objects.create(code=f"M{n}", desc=f"Module {n}"),
+                                                        year=2024, sem=1) for n in range(3)]
+        cls.users = [User.objects.create_user(f"user{n}") for n in range(3)]
+        cls.days = [timezone.now().date() - timedelta(days=n) for n in (4, 3, 2)]
+        for n, instance in enumerate(cls.instances):
+            Rating.objects.create(stars=n + 1, professor=cls.professor, module=instance, user=cls.users[n],
+                                  created_at=timezone.now() - timedelta(days=4 - n))
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.lock_file = os.path.join(directory.name, "maintenance.lock")
+        settings = override_settings(MAINTENANCE_LOCK_FILE=self.lock_file)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def run_checks(self, repair=False):
+        with self.assertLogs("rate.maintenance", "INFO"):
+            results = run_maintenance(["check_summaries", "check_daily"], budget=5, repair=repair)
+        return [result["detail"] for result in results]
+
+    def test_mismatches_are_reported_and_repaired(self):
+        Rating_summary.objects.filter(module=self.instances[1]).update(count=5, stars_2=0, raters=None)
+        Daily_rating.objects.filter(day=self.days[2]).delete()
+        Daily_rating.objects.create(day=self.days[0] - timedelta(days=1), professor=self.professor, count=1, total=4)
+
+        self.assertEqual(self.run_checks(), ["3 summaries checked, 1 mismatched", "4 rollups checked, 2 mismatched"])
+        self.assertEqual(Rating_summary.objects.get(module=self.instances[1]).count, 5)
+
+        self.assertEqual(self.run_checks(repair=True),
+                         ["3 summaries checked, 1 mismatched and repaired", "4 rollups checked, 2 mismatched and repaired"])
+        summary = Rating_summary.objects.get(module=self.instances[1])
+        self.assertEqual((summary.count, summary.total, summary.stars_2), (1, 2, 1))
+        self.assertEqual(estimate(summary.raters), 1)
+        self.assertEqual(list(Daily_rating.objects.filter(count__gt=0).order_by("day").values_list("day", "total")),
+                         list(zip(self.days, [1, 2, 3])))
+        # The extra rollup is left at zero, as a deleted rating leaves it
+        self.assertEqual(self.run_checks(), ["3 summaries checked, 0 mismatched", "4 rollups checked, 0 mismatched"])
+
+    def test_budget_stops_inside_a_slice(self):
+        # One read for the deadline, one for the slice, then one per row checked
+        state = {}
+        with mock.patch("rate.maintenance.time", TickingClock()):
+            summaries = check_summaries(3.5, False, state)
+            daily = check_daily(3.5, False, state)
+        self.assertEqual(summaries[0]["detail"], "2 summaries checked, 0 mismatched")
+        self.assertEqual(daily[0]["detail"], "2 rollups checked, 0 mismatched")
+        self.assertEqual(state, {"check_summaries": self.instances[1].id, "check_daily": self.days[2].isoformat()})
+
+    def test_next_run_carries_on_from_the_state_file(self):
+        with open(self.lock_file, "w") as lock:
+            json.dump({"check_summaries": self.instances[1].id, "check_daily": self.days[2].isoformat()}, lock)
+
+        self.assertEqual(self.run_checks(), ["1 summaries checked, 0 mismatched", "1 rollups checked, 0 mismatched"])
+        # Both checks reached the end, the next run starts over
+        with open(self.lock_file) as lock:
+            self.assertEqual(json.load(lock), {"check_summaries": 0, "check_daily": None})
+        self.assertEqual(self.run_checks(), ["3 summaries checked, 0 mismatched", "3 rollups checked, 0 mismatched"])
+
+
+# Tests for state that must not cross a fork of "manage.py serve"
+class ForkTests(SimpleTestCase):
+
+    # Function for running func in a forked child, returns its exit code
+    def in_child(self, func, timeout=10):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = 0 if func() else 1
+            finally:
+                os._exit(code)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                return os.waitstatus_to_exitcode(status)
+            time.sleep(0.05)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.fail("The child is stuck")
+
+    def test_shard_pool_works_after_fork(self):
+        aliases = ["default", "ratings_other"]
+        # The parent's pool has idle threads, which the child doesn't get
+        for _ in range(5):
+            self.assertEqual(fan_out(Rating, lambda alias, db: alias, aliases), aliases)
+        time.sleep(0.2)
+        self.assertEqual(self.in_child(lambda: fan_out(Rating, lambda alias, db: alias, aliases) == aliases), 0)
+
+
+# Tests for recycling the workers of "manage.py serve"
+class ServeTests(SimpleTestCase):
+
+    def command(self, **options):
+        command = Serve(stdout=io.StringIO(), stderr=io.StringIO())
+        command.options = {"max_requests": 3, "max_requests_jitter": 0, "graceful_timeout": 1, **options}
+        command.workers = {}
+        command.scheduler_pid = None
+        command.stopping = False
+        return command
+
+    # The worker loop sets its own signal handlers, the test runner's are put back afterwards
+    def keep_signal_handlers(self):
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def application(self, environ, start_response):
+        start_response("200 OK", [("Content-Length", "2")])
+        return [b"ok"]
+
+    @override_settings(SERVE_WARMUP_PATHS=[])
+    def test_worker_stops_after_max_requests(self):
+        self.keep_signal_handlers()
+        command = self.command()
+        command.server = PreforkWSGIServer(("127.0.0.1", 0), QuietWSGIRequestHandler)
+        command.server.set_app(self.application)
+        command.server.socket.setblocking(False)
+        self.addCleanup(command.server.server_close)
+        command.ready_read, command.ready_write = os.pipe()
+        # The worker closes its copy of the read end
+        ready_read = os.dup(command.ready_read)
+
+        url = "http://127.0.0.1:%d/" % command.server.server_address[1]
+        client = threading.Thread(target=lambda: [urlopen(url, timeout=5).read() for _ in range(3)])
+        client.start()
+        # A worker that doesn't stop by itself is sent SIGTERM, so the test can't hang
+        stuck = []
+        timer = threading.Timer(10, lambda: stuck.append(os.kill(os.getpid(), signal.SIGTERM)))
+        timer.start()
+        try:
+            command.run_worker(scheduler=False)
+        finally:
+            timer.cancel()
+            client.join()
+
+        self.assertFalse(stuck)
+        self.assertEqual(command.server.requests, 3)
+        with closing(os.fdopen(ready_read, "rb")) as ready:
+            self.assertEqual(ready.read(), b".")
+
+    def test_exited_workers_are_replaced(self):
+        for code in [0, 3]:
+            with self.subTest(code=code):
+                command = self.command()
+                pid = os.fork()
+                if pid == 0:
+                    os._exit(code)
+                command.workers[pid] = time.monotonic()
+                command.scheduler_pid = pid
+
+                spawned = []
+                def spawn(scheduler=False):
+                    spawned.append(scheduler)
+                    command.stopping = True
+                command.spawn = spawn
+                command.drain_ready = lambda: None
+                command.shutdown = lambda: None
+                with mock.patch("rate.management.commands.serve.time.sleep"):
+                    command.supervise()
+
+                # The replacement takes over the maintenance scheduler, only a failure is reported
+                self.assertEqual(spawned, [True])
+                self.assertEqual(command.workers, {})
+                self.assertEqual(bool(command.stderr._out.getvalue()), code != 0)
+
+
+# The rating shard for ShardTests, declared in webserv/test_settings.py
+TEST_SHARD = "ratings_test"
+
+
+# Tests for routing ratings to the shard of their year, reading them back from every
+# shard, and moving a year between shards. Fan-out reads run on other threads, so
+# the rows are committed rather than kept in a test transaction.
+@skipUnless(TEST_SHARD in settings.DATABASES, "needs the test shard of webserv.test_settings")
+@override_settings(RATING_SHARDS={TEST_SHARD: ":memory:"})
+class ShardTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        self.professor = Professor.objects.create(id="P1", name="Professor 1")
+        module = Module.objects.create(code="M1", desc="Module 1")
+        self.instances = {}
+        for year in [2023, 2024]:
+            self.instances[year] = Module_instance.objects.create(mod=module, year=year, sem=1)
+            self.instances[year].prof.add(self.professor)
+        self.users = [User.objects.create_user(f"user{n}", password="Passw0rd!") for n in range(3)]
+        reload_shard_map()
+        self.addCleanup(reload_shard_map)
+
+    def on_shard(self, model):
+        return model.objects.using(TEST_SHARD)
+
+    def test_ratings_go_to_the_shard_of_their_year(self):
+        Shard_map.objects.create(key="2024", alias=TEST_SHARD)
+        upsert_rating(self.users[0], self.professor, self.instances[2023], 2)
+        upsert_rating(self.users[0], self.professor, self.instances[2024], 4)
+        upsert_rating(self.users[1], self.professor, self.instances[2024], 5)
+
+        self.assertEqual(list(Rating.objects.values_list("stars", flat=True)), [2])
+        self.assertEqual(sorted(self.on_shard(Rating).values_list("stars", flat=True)), [4, 5])
+        self.assertEqual(self.on_shard(Rating_summary).get().count, 2)
+
+        # Roll-ups read every shard
+        response = APIClient().get("/api/raters/")
+        self.assertEqual(response.data["total"], {"raters": 2, "rating_count": 3})
+        keys = [change["key"] for change in APIClient().get("/api/changes/").data["changes"]
+                if change["entity"] == "rating"]
+        expected = [str(Rating.objects.get().pk)] + [f"{TEST_SHARD}:{pk}" for pk in self.on_shard(Rating).order_by("id")
+                                                     .values_list("id", flat=True)]
+        self.assertEqual(keys, expected)
+
+    def test_unknown_alias_is_refused(self):
+        with self.assertRaises(ValidationError):
+            Shard_map(key="2024", alias="ratings_tset").full_clean()
+        Shard_map(key="2024", alias=TEST_SHARD).full_clean()
+
+        # Rows saved without validation fail loudly instead of on every write
+        Shard_map.objects.create(key="2024", alias="ratings_tset")
+        with self.assertRaises(ImproperlyConfigured):
+            shard_for_year(2024)
+
+    def test_remapping_a_year_with_ratings_is_refused(self):
+        upsert_rating(self.users[0], self.professor, self.instances[2024], 4)
+        with self.assertRaises(ValidationError):
+            Shard_map(key="2024", alias=TEST_SHARD).full_clean()
+        # 2023 has no ratings yet
+        Shard_map(key="2023", alias=TEST_SHARD).full_clean()
+
+        Shard_map.objects.create(key="2023", alias=TEST_SHARD)
+        reload_shard_map()
+        instance = self.instances[2024]
+        instance.year = 2023
+        with self.assertRaises(ValidationError):
+            instance.full_clean()
+
+    def test_move_shard(self):
+        for user, stars in zip(self.users, [3, 4, 5]):
+            upsert_rating(user, self.professor, self.instances[2024], stars)
+        call_command("move_shard", "2024", TEST_SHARD, wait=0, chunk_size=2, stdout=io.StringIO())
+
+        self.assertFalse(Rating.objects.exists())
+        self.assertFalse(Rating_summary.objects.exists())
+        self.assertEqual(sorted(self.on_shard(Rating).values_list("stars", flat=True)), [3, 4, 5])
+        summary = self.on_shard(Rating_summary).get()
+        self.assertEqual((summary.count, summary.total, summary.stars_4), (3, 12, 1))
+        self.assertEqual(bytes(summary.raters), add_users(None, [user.pk for user in self.users]))
+        self.assertEqual(shard_for_year(2024), TEST_SHARD)
+        self.assertEqual(Change.objects.filter(entity="rating", op="delete").count(), 3)
+
+        # And back, a user who rated again in the meantime keeps the newer rating
+        upsert_rating(self.users[0], self.professor, self.instances[2024], 1, using="default")
+        Shard_map.objects.all().delete()
+        call_command("move_shard", "2024", "default", wait=0, stdout=io.StringIO())
+        self.assertFalse(self.on_shard(Rating).exists())
+        self.assertEqual(sorted(Rating.objects.values_list("stars", flat=True)), [1, 4, 5])
+        self.assertEqual(Rating_summary.objects.get().total, 10)
+
+    def test_deleting_a_user_deletes_their_ratings_on_every_shard(self):
+        Shard_map.objects.create(key="2024", alias=TEST_SHARD)
+        upsert_rating(self.users[0], self.professor, self.instances[2023], 2)
+        upsert_rating(self.users[0], self.professor, self.instances[2024], 4)
+        upsert_rating(self.users[1], self.professor, self.instances[2024], 5)
+        shard_key = f"{TEST_SHARD}:{self.on_shard(Rating).get(user=self.users[0]).pk}"
+
+        self.users[0].delete()
+        self.assertFalse(Rating.objects.exists())
+        self.assertEqual(list(self.on_shard(Rating).values_list("stars", flat=True)), [5])
+        summary = self.on_shard(Rating_summary).get()
+        self.assertEqual((summary.count, summary.total, summary.stars_4, summary.stars_5), (1, 5, 0, 1))
+        self.assertEqual(list(Daily_rating.objects.values_list("count", "total")), [(1, 5)])
+        self.assertTrue(Change.objects.filter(entity="rating", key=shard_key, op="delete").exists())
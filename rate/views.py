@@ -1,11 +1,25 @@
 from django.shortcuts import render
-from .models import Professor, Module, Module_instance, Rating
+from .models import Professor, Module, Module_instance, Rating, Rating_summary, Daily_rating, Archived_year, Rating_receipt
 from django.contrib.auth.models import User
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth import authenticate
-from django.db.models import Q
+from django.db.models import Q, Sum
+from django.utils import timezone
+from datetime import timedelta
+from .encoding import cached_response
+from .snapshots import build_module_list, snapshot_response, versioned_response
+from .ratings import upsert_rating
+from .ingest import enqueue_rating, find_pending, find_pending_ratings
+from .admission import admission_state
+from .authentication import token_expired
+from django.conf import settings
+from .changes import read_changes, DEFAULT_LIMIT, MAX_LIMIT
+from .routers import read_only
+from .sharding import fan_out, shard_for_year
+from .sketches import merge, estimate, RELATIVE_ERROR
+from .provisioning import provision_users
 import re
 
 # Function for validating email using regex
@@ -67,6 +81,37 @@ def register(request):
 
     return Response({"message": f"New user {uname} registered successfully!"}, status=status.HTTP_201_CREATED)
 
+# Function for creating many accounts at once, for staff provisioning a cohort
+# Takes {"users": [{"username", "email", "password"}, ...], "issue_tokens": true}, an
+# empty password gets a generated one. Each account gets a result with its status
+# ("created", "invalid" or "conflict"), and its generated password and token.
+@api_view(["POST"])
+def register_bulk(request):
+    if not request.user.is_authenticated:
+        return Response({"error": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED)
+    if not request.user.is_staff:
+        return Response({"error": "Only staff can create accounts in bulk"}, status=status.HTTP_403_FORBIDDEN)
+
+    users = request.data.get("users")
+    if not isinstance(users, list) or not users:
+        return Response({"error": "users must be a non-empty list"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(users) > settings.PROVISION_BULK_MAX:
+        return Response({"error": f"At most {settings.PROVISION_BULK_MAX} accounts can be created at once"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if not all(isinstance(user, dict) for user in users):
+        return Response({"error": "Each user must be an object"}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Hashed on threads, the server workers must not fork
+    issue_tokens = request.data.get("issue_tokens") in [True, "true", "True", "1", 1]
+    results = provision_users(users, issue_tokens=issue_tokens, workers=settings.PROVISION_WORKERS, processes=False)
+
+    created = sum(1 for result in results if result["status"] == "created")
+    return Response({
+        "results": results,
+        "created": created,
+        "failed": len(results) - created
+    }, status=status.HTTP_200_OK)
+
 # Function for logging in a user
 @api_view(["POST"])
 def login(request):
@@ -86,6 +131,11 @@ def login(request):
         # Generate or get an authentication token
         from rest_framework.authtoken.models import Token
         token, created = Token.objects.get_or_create(user=user)
+
+        # Replace a token that has expired but not been purged yet
+        if token_expired(token):
+            token.delete()
+            token = Token.objects.create(user=user)
         
         return Response({
             "message": f"User {uname} logged-in successfully!",
@@ -112,31 +162,37 @@ def logout(request):
         return Response({"error": "Token not found"}, status=status.HTTP_404_NOT_FOUND)
 
 @api_view(["GET"])
+@read_only
 def list_modules(request):
-    # Query all module instances with their associated modules and professors
-    module_instances = Module_instance.objects.all().select_related('mod')
-    
-    # Prepare response data
-    module_list = []
-    
-    for instance in module_instances:
-        # Get all professors teaching this module instance
-        professors = instance.prof.all()
-        prof_info = [{"id": prof.id, "name": prof.name} for prof in professors]
-        
-        # Format module data for response message
-        module_data = {
-            "code": instance.mod.code,
-            "description": instance.mod.desc,
-            "year": instance.year,
-            "semester": instance.sem,
-            "professors": prof_info
-        }
-        module_list.append(module_data)
-    
-    return Response({
-        "modules": module_list
-    }, status=status.HTTP_200_OK)
+    # ?year= lists the module instances of one academic year
+    year = request.query_params.get("year")
+    if year is not None:
+        try:
+            year = int(year)
+        except ValueError:
+            return Response({"error": "Year must be a valid number"}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Serve the published snapshot file, or else the pre-encoded catalog, which is
+    # only rebuilt when the catalog changes
+    response = snapshot_response(request, year)
+    if response is not None:
+        return response
+    if year is None:
+        return cached_response(request, "catalog", build_module_list)
+    # Only years in the catalog are cached, so made-up years can't grow the cache
+    if not Module_instance.objects.filter(year=year).exists():
+        return Response({"modules": []}, status=status.HTTP_200_OK)
+    return cached_response(request, f"catalog:{year}", lambda: build_module_list(year))
+
+
+# Function for serving a versioned catalog snapshot (see rate/snapshots.py)
+# A front-end proxy normally serves these from CATALOG_SNAPSHOT_DIR itself
+@api_view(["GET"])
+def catalog_snapshot(request, name):
+    response = versioned_response(request, name)
+    if response is None:
+        return Response({"error": "Snapshot not found"}, status=status.HTTP_404_NOT_FOUND)
+    return response
 
 # Function to rate a professor in a module instance
 @api_view(["POST"])
@@ -144,8 +200,12 @@ def rate_professor(request):
     # Verify the user is authenticated
     if not request.user.is_authenticated:
         return Response({"error": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED)
-    
-    data = request.data
+
+    return submit_rating(request, request.data)
+
+# Function for validating and saving one rating for the request's user
+# Shared by single ratings and batches, receipt is the client's id for the rating
+def submit_rating(request, data, receipt=None):
     prof_id = data.get("professor_id")
     module_code = data.get("module_code")
     year = data.get("year")
@@ -219,9 +279,39 @@ def rate_professor(request):
             {"error": f"Module instance for {module_code} in year {year}, semester {semester} not found"},
             status=status.HTTP_404_NOT_FOUND
         )
+
+    # Ratings of archived years are closed
+    if Archived_year.objects.filter(year=year).exists():
+        return Response({"error": f"Ratings for year {year} are closed"}, status=status.HTTP_400_BAD_REQUEST)
     
+    # Opt-in update mode replaces an existing rating in a single upsert statement
+    update = data.get("update") in [True, "true", "True", "1", 1]
+
+    # Write-behind mode only logs the rating, the applier writes it later
+    if settings.RATING_INGEST_ASYNC and update:
+        return accepted_rating(request, professor, module, module_instance, stars, update, receipt)
+
+    if update:
+        previous_stars, stars = upsert_rating(request.user, professor, module_instance, stars)
+
+        return Response({
+            "professor": {
+                "id": professor.id,
+                "name": professor.name
+            },
+            "module": {
+                "code": module.code,
+                "description": module.desc
+            },
+            "year": year,
+            "semester": semester,
+            "stars": stars,
+            "previous_stars": previous_stars,
+            "message": f"Rating {'updated' if previous_stars is not None else 'submitted'} successfully for Professor {professor.name}, Module {module.desc}"
+        }, status=status.HTTP_200_OK if previous_stars is not None else status.HTTP_201_CREATED)
+
     # Check if the user has already rated this professor for this module instance
-    existing_rating = Rating.objects.filter(
+    existing_rating = Rating.objects.using(shard_for_year(year)).filter(
         user=request.user,
         professor=professor,
         module=module_instance
@@ -233,9 +323,20 @@ def rate_professor(request):
             "error": f"You have already rated Professor {professor.name} for {module.desc} ({year}, semester {semester})",
             "existing_rating": existing_rating.stars
         }, status=status.HTTP_400_BAD_REQUEST)
+
+    if settings.RATING_INGEST_ASYNC:
+        # A rating accepted earlier may still be waiting in the log, the applier would reject this one
+        pending = find_pending_ratings(request.user, professor, module_instance)
+        if pending:
+            return Response({
+                "error": f"You have already rated Professor {professor.name} for {module.desc} ({year}, semester {semester})",
+                "existing_rating": pending[-1]["stars"],
+                "receipt": pending[-1]["id"]
+            }, status=status.HTTP_400_BAD_REQUEST)
+        return accepted_rating(request, professor, module, module_instance, stars, update, receipt)
     
     # Create the rating
-    rating = Rating.objects.create(
+    rating = Rating.objects.using(shard_for_year(year)).create(
         stars=stars,
         professor=professor,
         module=module_instance,
@@ -258,22 +359,142 @@ def rate_professor(request):
         "message": f"Rating submitted successfully for Professor {professor.name}, Module {module.desc}"
     }, status=status.HTTP_201_CREATED)
 
-# Function for viewing average rating for all professors across all modules
+# Function for accepting a validated rating into the write-behind log
+# The receipt can be polled at /api/rate/status/<receipt>/ until the applier has run
+def accepted_rating(request, professor, module, module_instance, stars, update, receipt=None):
+    receipt = enqueue_rating(request.user, professor, module_instance, stars, update, receipt)
+
+    return Response({
+        "receipt": receipt,
+        "status": "pending",
+        "status_url": f"/api/rate/status/{receipt}/",
+        "professor": {
+            "id": professor.id,
+            "name": professor.name
+        },
+        "module": {
+            "code": module.code,
+            "description": module.desc
+        },
+        "year": module_instance.year,
+        "semester": module_instance.sem,
+        "stars": stars,
+        "message": f"Rating accepted for Professor {professor.name}, Module {module.desc}"
+    }, status=status.HTTP_202_ACCEPTED)
+
+# Function to submit many ratings in one request, for clients flushing an offline queue
+# Each rating may carry an "id" (32 hex characters). A rating whose id was seen
+# before isn't applied again, its first outcome is returned instead, so a batch
+# can be resent safely after a lost response.
+@api_view(["POST"])
+def rate_batch(request):
+    if not request.user.is_authenticated:
+        return Response({"error": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    items = request.data.get("ratings")
+    if not isinstance(items, list) or not items:
+        return Response({"error": "ratings must be a non-empty list"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > settings.RATING_BATCH_MAX:
+        return Response({"error": f"At most {settings.RATING_BATCH_MAX} ratings can be sent at once"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    results = []
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({"id": None, "status_code": 400, "error": "Each rating must be an object"})
+            continue
+
+        receipt = item.get("id")
+        if receipt is not None and not (isinstance(receipt, str) and re.fullmatch(r"[0-9a-f]{32}", receipt)):
+            results.append({"id": receipt, "status_code": 400, "error": "id must be 32 lowercase hex characters"})
+            continue
+
+        if receipt is not None:
+            seen = Rating_receipt.objects.filter(id=receipt).first()
+            if seen is not None and seen.user_id != request.user.pk:
+                results.append({"id": receipt, "status_code": 409, "error": f"id {receipt} is already in use"})
+                continue
+            if seen is not None:
+                results.append({
+                    "id": receipt,
+                    "status_code": 200 if seen.status == "applied" else 400,
+                    "duplicate": True,
+                    "error": seen.error or None
+                })
+                continue
+            if settings.RATING_INGEST_ASYNC:
+                pending = find_pending(receipt)
+                if pending is not None and pending["user"] == request.user.pk:
+                    results.append({"id": receipt, "status_code": 202, "duplicate": True, "receipt": receipt,
+                                    "status_url": f"/api/rate/status/{receipt}/"})
+                    continue
+
+        response = submit_rating(request, item, receipt)
+
+        # Accepted ratings get their receipt from the applier
+        if receipt is not None and response.status_code != status.HTTP_202_ACCEPTED:
+            Rating_receipt.objects.get_or_create(id=receipt, defaults={
+                "user": request.user,
+                "status": "applied" if response.status_code < 300 else "rejected",
+                "error": response.data.get("error", "")[:200]
+            })
+        results.append({**response.data, "id": receipt, "status_code": response.status_code})
+
+    return Response({
+        "results": results,
+        "succeeded": sum(1 for result in results if result["status_code"] < 300),
+        "failed": sum(1 for result in results if result["status_code"] >= 300)
+    }, status=status.HTTP_200_OK)
+
+# Function for checking on a rating accepted by the write-behind ingestion
 @api_view(["GET"])
-def view(request):
+def rating_status(request, receipt):
+    if not request.user.is_authenticated:
+        return Response({"error": "Authentication required"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    applied = Rating_receipt.objects.filter(id=receipt, user=request.user).first()
+    if applied is not None:
+        return Response({
+            "receipt": receipt,
+            "status": applied.status,
+            "error": applied.error or None,
+            "applied_at": applied.applied_at
+        }, status=status.HTTP_200_OK)
+
+    # Not applied yet, it is still in the log
+    record = find_pending(receipt)
+    if record is not None and record["user"] == request.user.pk:
+        return Response({"receipt": receipt, "status": "pending"}, status=status.HTTP_200_OK)
+
+    return Response({"error": f"Receipt {receipt} not found"}, status=status.HTTP_404_NOT_FOUND)
+
+# Function for building the average rating of every professor across all modules
+def build_professor_ratings():
     # Query all professors
     professors = Professor.objects.all()
+
+    # Totals per professor come from the rating summaries, one grouped query per shard
+    def shard_totals(alias, db):
+        return list(Rating_summary.objects.using(db).values("professor_id").annotate(
+            count=Sum("count"), total=Sum("total")))
+
+    totals = {}
+    for rows in fan_out(Rating_summary, shard_totals):
+        for row in rows:
+            merged = totals.setdefault(row["professor_id"], {"count": 0, "total": 0})
+            merged["count"] += row["count"]
+            merged["total"] += row["total"]
     
     professor_ratings = []
     
     for professor in professors:
-        # Get all ratings for this professor
-        ratings = Rating.objects.filter(professor=professor)
+        row = totals.get(professor.id)
+        rating_count = row["count"] if row else 0
         
         # Calculate average rating and round to nearest integer
         avg_rating = 0
-        if ratings.exists():
-            avg_rating = sum(rating.stars for rating in ratings) / ratings.count()
+        if rating_count > 0:
+            avg_rating = row["total"] / rating_count
         avg_rating = round(avg_rating)
 
         # Make response
@@ -281,15 +502,22 @@ def view(request):
             "id": professor.id,
             "name": professor.name,
             "average_rating": avg_rating,
-            "rating_count": ratings.count()
+            "rating_count": rating_count
         })
     
+    return professor_ratings
+
+# Function for viewing average rating for all professors across all modules
+@api_view(["GET"])
+@read_only
+def view(request):
     return Response({
-        "professors": professor_ratings
+        "professors": build_professor_ratings()
     }, status=status.HTTP_200_OK)
 
 # Function for getting average rating of a professor in a module
 @api_view(['POST'])
+@read_only
 def average(request):
     data = request.data
     prof_id = data.get("professor_id")
@@ -317,13 +545,9 @@ def average(request):
     module_instances = Module_instance.objects.filter(mod=module)
     
     # Check if professor teaches this module
-    teaches_module = False
-    for module_instance in module_instances:
-        if module_instance.prof.filter(id=prof_id).exists():
-            teaches_module = True
-            break
+    teaches_module = module_instances.filter(prof=professor).exists()
     
-    if not teaches_module and module_instances:
+    if not teaches_module and module_instances.exists():
         return Response({
             "professor": {
                 "id": professor.id,
@@ -339,23 +563,26 @@ def average(request):
         }, status=status.HTTP_200_OK)
 
     # Calculate average rating
-    # Sum of all ratings across all instances
+    # Sum and number of ratings across all instances, from the rating summaries
+    # on the shards that hold this module's years
+    instances = dict(module_instances.values_list("id", "year"))
+
+    def shard_totals(alias, db):
+        return Rating_summary.objects.using(db).filter(professor=professor, module_id__in=list(instances)).aggregate(
+            count=Sum("count"), total=Sum("total"))
+
     sum_rating = 0
-    # Number of ratings across all instances
     rating_count = 0
-    
-    for module_instance in module_instances:
-        ratings = Rating.objects.filter(module=module_instance, professor=professor)
-        sum_rating += sum(rating.stars for rating in ratings)
-        rating_count += ratings.count()
+    for totals in fan_out(Rating_summary, shard_totals, {shard_for_year(year) for year in instances.values()}):
+        sum_rating += totals["total"] or 0
+        rating_count += totals["count"] or 0
     
     # If no ratings return None as average rating
     avg_rating = None
 
     # Get average rating and round to nearest integer
     if rating_count > 0:
-        avg_rating = sum_rating / rating_count
-    avg_rating = round(avg_rating)
+        avg_rating = round(sum_rating / rating_count)
 
     return Response({
         "professor": {
@@ -370,3 +597,170 @@ def average(request):
         "average_rating": avg_rating,
         "rating_count": rating_count
     }, status=status.HTTP_200_OK)
+
+# Function for reading the change feed after a cursor
+# Consumers pass the returned cursor back as "since" to get only newer changes
+@api_view(["GET"])
+@read_only
+def changes(request):
+    try:
+        since = int(request.query_params.get("since", 0))
+        limit = int(request.query_params.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        return Response({"error": "since and limit must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if since < 0 or limit < 1:
+        return Response({"error": "since must be 0 or more and limit at least 1"}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(read_changes(since, min(limit, MAX_LIMIT)), status=status.HTTP_200_OK)
+
+# Function for windowed average ratings and the professors whose average moved the most
+# Compares the last <days> days with the <days> days before, using the daily rollups
+@api_view(["GET"])
+@read_only
+def trending(request):
+    try:
+        days = int(request.query_params.get("days", 7))
+        limit = int(request.query_params.get("limit", 10))
+    except ValueError:
+        return Response({"error": "days and limit must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if days < 1 or days > 365:
+        return Response({"error": "days must be between 1 and 365"}, status=status.HTTP_400_BAD_REQUEST)
+
+    today = timezone.now().date()
+    start = today - timedelta(days=days - 1)
+    previous_start = start - timedelta(days=days)
+
+    # One grouped query over at most 2 * days rollup rows per professor
+    rows = Daily_rating.objects.filter(day__gte=previous_start, day__lte=today).values("professor_id").annotate(
+        window_count=Sum("count", filter=Q(day__gte=start)),
+        window_total=Sum("total", filter=Q(day__gte=start)),
+        previous_count=Sum("count", filter=Q(day__lt=start)),
+        previous_total=Sum("total", filter=Q(day__lt=start)),
+    )
+    names = dict(Professor.objects.values_list("id", "name"))
+
+    professors = []
+    for row in rows:
+        count = row["window_count"] or 0
+        previous_count = row["previous_count"] or 0
+        if count == 0 and previous_count == 0:
+            continue
+
+        avg_rating = round(row["window_total"] / count, 2) if count else None
+        previous_avg = round(row["previous_total"] / previous_count, 2) if previous_count else None
+        change = None
+        if avg_rating is not None and previous_avg is not None:
+            change = round(avg_rating - previous_avg, 2)
+
+        professors.append({
+            "id": row["professor_id"],
+            "name": names.get(row["professor_id"]),
+            "average_rating": avg_rating,
+            "rating_count": count,
+            "previous_average_rating": previous_avg,
+            "previous_rating_count": previous_count,
+            "change": change
+        })
+
+    # Professors rated in both windows, biggest movement first
+    moved = sorted((p for p in professors if p["change"] is not None), key=lambda p: abs(p["change"]), reverse=True)
+
+    return Response({
+        "days": days,
+        "from": start,
+        "to": today,
+        "professors": sorted(professors, key=lambda p: p["id"]),
+        "trending": moved[:max(limit, 0)]
+    }, status=status.HTTP_200_OK)
+
+# Groupings the distinct rater counts can be rolled up by
+RATER_GROUPS = ["professor", "module", "year"]
+
+# Function for the estimated number of distinct users who rated, rolled up by any
+# combination of professor, module and year (e.g. ?by=professor,year)
+# Each group merges the HyperLogLog sketches of its rating summaries, so no ratings
+# are read. Estimates are within relative_error of the true count two times in three.
+@api_view(["GET"])
+@read_only
+def raters(request):
+    by = request.query_params.get("by", "professor").split(",")
+    if any(group not in RATER_GROUPS for group in by) or len(set(by)) != len(by):
+        return Response({"error": "by must be a comma separated list of professor, module and year"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    prof_id = request.query_params.get("professor_id")
+    module_code = request.query_params.get("module_code")
+    year = request.query_params.get("year")
+    if year is not None:
+        try:
+            year = int(year)
+        except ValueError:
+            return Response({"error": "Year must be a valid number"}, status=status.HTTP_400_BAD_REQUEST)
+
+    professors = dict(Professor.objects.values_list("id", "name"))
+    modules = dict(Module.objects.values_list("code", "desc"))
+    if prof_id is not None and prof_id not in professors:
+        return Response({"error": f"Professor with ID {prof_id} not found"}, status=status.HTTP_404_NOT_FOUND)
+    if module_code is not None and module_code not in modules:
+        return Response({"error": f"Module with code {module_code} not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    module_instances = Module_instance.objects.all()
+    if module_code is not None:
+        module_instances = module_instances.filter(mod_id=module_code)
+    if year is not None:
+        module_instances = module_instances.filter(year=year)
+    instances = {pk: (code, instance_year)
+                 for pk, code, instance_year in module_instances.values_list("id", "mod_id", "year")}
+
+    # Summaries of the selected module instances, from the shards that hold their years
+    def shard_sketches(alias, db):
+        summaries = Rating_summary.objects.using(db).all()
+        if module_code is not None or year is not None:
+            summaries = summaries.filter(module_id__in=list(instances))
+        if prof_id is not None:
+            summaries = summaries.filter(professor_id=prof_id)
+        return list(summaries.values_list("professor_id", "module_id", "count", "raters"))
+
+    aliases = {shard_for_year(instance_year) for _, instance_year in instances.values()}
+    groups = {}
+    for rows in fan_out(Rating_summary, shard_sketches, aliases or None):
+        for professor_id, module_id, count, sketch in rows:
+            if module_id not in instances:
+                continue
+            code, instance_year = instances[module_id]
+            values = {"professor": professor_id, "module": code, "year": instance_year}
+            group = groups.setdefault(tuple(values[name] for name in by), {"count": 0, "sketches": []})
+            group["count"] += count
+            group["sketches"].append(sketch)
+
+    results = []
+    for key, group in sorted(groups.items()):
+        result = {}
+        for name, value in zip(by, key):
+            if name == "professor":
+                result["professor"] = {"id": value, "name": professors.get(value)}
+            elif name == "module":
+                result["module"] = {"code": value, "description": modules.get(value)}
+            else:
+                result["year"] = value
+        result["raters"] = estimate(merge(group["sketches"]))
+        result["rating_count"] = group["count"]
+        results.append(result)
+
+    return Response({
+        "by": by,
+        "relative_error": round(RELATIVE_ERROR, 4),
+        "groups": results,
+        "total": {
+            "raters": estimate(merge(sketch for group in groups.values() for sketch in group["sketches"])),
+            "rating_count": sum(group["count"] for group in groups.values())
+        }
+    }, status=status.HTTP_200_OK)
+
+# Function for the admission control counters, for monitoring
+# In-flight and queued are current, admitted, shed and throttled count up from startup
+@api_view(["GET"])
+def admission(request):
+    return Response(admission_state().stats(), status=status.HTTP_200_OK)
@@ -13,4 +13,32 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webserv.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up
+from rate.stream import sse_application
+from rate.maintenance import start_scheduler
+
+
+# Server-Sent Events stream is served outside the Django request cycle, every other
+# request goes to Django as usual
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http" and scope["path"] == "/api/stream/":
+        return await sse_application(scope, receive, send)
+    return await django_application(scope, receive, send)
+
+
+# Runs database maintenance in the background when MAINTENANCE_INTERVAL is set
+# Started on the server's startup event rather than at import, which a server
+# that preloads the app does in the parent process before forking its workers
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            start_scheduler()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
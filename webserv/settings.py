@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
+from importlib.util import find_spec
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -44,19 +46,94 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'rate.authentication.ExpiringTokenAuthentication',
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'rate.renderers.FastJSONRenderer',
+        'rate.renderers.NDJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ],
 }
 
+# MessagePack is only offered when the msgpack package is installed
+if find_spec('msgpack'):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].insert(1, 'rate.renderers.MessagePackRenderer')
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].insert(1, 'rate.renderers.MessagePackParser')
+
+# Response compression (see rate/middleware.py), encodings in order of preference
+# br and zstd are only used when the brotli / zstandard packages are installed
+RESPONSE_COMPRESSION_ENCODINGS = ['zstd', 'br', 'gzip']
+RESPONSE_COMPRESSION_MIN_SIZE = 1024
+
+# Seconds an encoded payload (e.g. /api/list/) may be served from the in-process cache
+ENCODED_CACHE_TTL = 30
+
+# Live rating stream (/api/stream/ on the ASGI app, see rate/stream.py)
+# Seconds between change log polls, changes within one window are coalesced per professor
+RATING_STREAM_WINDOW = 1.0
+# Seconds of silence before a keep-alive comment is sent
+RATING_STREAM_HEARTBEAT = 15
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'rate.middleware.AccessLogMiddleware',
+    'rate.middleware.AdmissionMiddleware',
+    'rate.middleware.NPlusOneMiddleware',
+    'rate.middleware.CompressionMiddleware',
+    # ETags for GET responses that don't set one, and 304s for If-None-Match
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'rate.middleware.PathDispatchMiddleware',
+]
+
+# Run by PathDispatchMiddleware for every path except LEAN_PATH_PREFIXES
+# The API uses token auth only, so it skips the session lookup and the rest
+SITE_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
+LEAN_PATH_PREFIXES = ['/api/']
+
+# Admission control (see rate/admission.py), classes are matched by path prefix in
+# order. concurrency is the number of requests of the class running at once
+# (None for no limit), queue how many more may wait up to queue_timeout seconds
+# for a slot before being shed with a 503.
+ADMISSION_CLASSES = {
+    'critical': {
+        'paths': ['/api/login/', '/api/register/', '/api/logout/', '/api/admission/'],
+        'concurrency': None,
+    },
+    'expensive': {
+        'paths': ['/api/view/', '/api/average/', '/api/trending/', '/api/raters/'],
+        'concurrency': 4,
+        'queue': 4,
+        'queue_timeout': 0.25,
+    },
+    'normal': {
+        'paths': ['/api/'],
+        'concurrency': 32,
+        'queue': 64,
+        'queue_timeout': 1.0,
+    },
+}
+ADMISSION_RETRY_AFTER = 1
+# Per client address token bucket: requests per second and burst size, None to turn off
+# (clients behind one proxy or NAT share a bucket, so do load tests from one machine)
+ADMISSION_RATE_LIMIT = {'rate': 20, 'burst': 40}
+# Size of the shared tables: worker processes and token buckets
+ADMISSION_MAX_PROCESSES = 64
+ADMISSION_BUCKETS = 4096
+
+# The admin checks look for its middleware in MIDDLEWARE, they run from SITE_MIDDLEWARE
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
 
 ROOT_URLCONF = 'webserv.urls'
 
@@ -78,17 +155,156 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'webserv.wsgi.application'
 
+# Requests "manage.py serve" sends through the app before forking its workers,
+# the first one is also sent by every worker to open its database connections
+SERVE_WARMUP_PATHS = ['/api/list/', '/api/view/', '/api/trending/']
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite databases run in WAL mode, readers and the writer don't block each other.
+# The WAL is copied back into the database by the checkpoint maintenance task.
+SQLITE_OPTIONS = {
+    'init_command': 'PRAGMA journal_mode=WAL',
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
+    },
+}
+
+# Read-only views read from a "replica" alias when there is one (see rate/routers.py),
+# turned on with READ_REPLICA=1 in the environment. The bundled backend keeps an
+# in-memory copy of db.sqlite3 per database connection, refreshed when the file
+# changes and at most max_staleness seconds behind. Every new connection copies the
+# whole file, so it only pays off where connections live long, as in the workers of
+# "manage.py serve", not under runserver's thread per request. Point it at a real
+# replica to scale out.
+if os.environ.get('READ_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'rate.db.snapshot',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'max_staleness': 1.0,
+        },
+        # Keep the snapshot for the life of the worker rather than reloading per request
+        'CONN_MAX_AGE': None,
+        'TEST': {
+            'MIRROR': 'default',
+        },
     }
+
+# Optional rating shards (see rate/sharding.py), alias -> SQLite file, e.g.
+# RATING_SHARDS = {'ratings_2024': BASE_DIR / 'ratings_2024.sqlite3'}
+# Years are assigned to shards with Shard_map rows, then create the tables with
+# "manage.py migrate --database <alias>". Shards only hold the rating tables, so
+# foreign keys to catalog and user tables on default are not enforced there.
+# A year that already has ratings is moved with "manage.py move_shard <year> <alias>".
+RATING_SHARDS = {}
+
+for alias, path in RATING_SHARDS.items():
+    DATABASES[alias] = {
+        'ENGINE': 'rate.db.shard',
+        'NAME': path,
+        'OPTIONS': SQLITE_OPTIONS,
+    }
+
+# Threads used to query shards in parallel
+RATING_SHARD_WORKERS = 8
+
+DATABASE_ROUTERS = ['rate.routers.ReadReplicaRouter', 'rate.sharding.ShardRouter']
+
+# Write-behind rating ingestion (see rate/ingest.py). When on, /api/rate/ validates,
+# appends the rating to a local log and answers 202 with a receipt id, and
+# "manage.py apply_ratings" applies the log to the database in batches
+RATING_INGEST_ASYNC = False
+RATING_INGEST_DIR = BASE_DIR / 'ingest'
+# Seconds the log writer waits to group concurrent ratings into one fsync
+RATING_INGEST_FSYNC_WINDOW = 0.002
+# Ratings applied per transaction
+RATING_INGEST_BATCH = 1000
+# Failed drains of a log segment before it is put aside as <segment>.quarantined
+RATING_INGEST_MAX_ATTEMPTS = 5
+
+# Most ratings a client can send to /api/rate/batch/ in one request
+RATING_BATCH_MAX = 100
+
+# Bulk account creation by staff at /api/users/bulk/ (see rate/provisioning.py), the
+# most accounts per request and the threads hashing their passwords. A PBKDF2 hash
+# takes about 0.4 s of CPU, so 50 accounts answer within the client's 30 s read
+# timeout even on one core. For a whole cohort use "manage.py provision_users",
+# which hashes on a process pool.
+PROVISION_BULK_MAX = 50
+PROVISION_WORKERS = 4
+
+# Repeated query detection (see rate/nplusone.py): None, "warn" to log and warn, or
+# "raise" to fail the request, e.g. NPLUSONE_DETECTION=raise python manage.py test
+NPLUSONE_DETECTION = os.environ.get('NPLUSONE_DETECTION') or None
+# Structurally identical queries from the same line that count as N+1
+NPLUSONE_THRESHOLD = 5
+
+# Seconds an API token is valid for, None for tokens that never expire
+AUTH_TOKEN_MAX_AGE = None
+
+# Database maintenance (see rate/maintenance.py). "manage.py maintain" runs it by
+# hand (or from cron under other WSGI servers), setting MAINTENANCE_INTERVAL (seconds)
+# also runs it from a thread in one "manage.py serve" worker and in ASGI processes
+MAINTENANCE_INTERVAL = None
+# Seconds each task may work for per run, the integrity checks carry on next run
+MAINTENANCE_TASK_BUDGET = 2.0
+MAINTENANCE_LOCK_FILE = BASE_DIR / 'maintenance.lock'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'rate': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
 }
 
+# Structured access log (see rate/accesslog.py), one JSON line per request with its
+# endpoint, user, status, sizes and auth/validation/db/render timings. None turns it off.
+ACCESS_LOG_FILE = None
+# Fraction of requests logged, server errors are always logged
+ACCESS_LOG_SAMPLE_RATE = 1.0
+# The file is rotated at this size, keeping ACCESS_LOG_BACKUP_COUNT old files
+ACCESS_LOG_MAX_BYTES = 10 * 1024 * 1024
+ACCESS_LOG_BACKUP_COUNT = 5
+# Records waiting for the writer thread, more are dropped instead of slowing requests down
+ACCESS_LOG_QUEUE_SIZE = 10000
+
+# Catalog snapshots (see rate/snapshots.py): /api/list/ and its ?year= slices are
+# published to this directory as versioned, pre-compressed files whenever the catalog
+# changes, and by "manage.py publish_catalog". None turns them off.
+# A front-end proxy can serve the directory at CATALOG_SNAPSHOT_URL (and /api/list/
+# from its catalog.json / catalog.ndjson symlinks) without the app, e.g. with nginx:
+#     location /api/list/snapshots/ { alias /srv/webserv/snapshots/; gzip_static on; expires max; }
+CATALOG_SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+CATALOG_SNAPSHOT_URL = '/api/list/snapshots/'
+# Redirect /api/list/ to the versioned file instead of sending it from the app
+CATALOG_SNAPSHOT_REDIRECT = False
+# Seconds clients and proxies may reuse an /api/list/ answer, the versioned files never change
+CATALOG_SNAPSHOT_MAX_AGE = 60
+# Seconds after a catalog change before publishing, changes made meanwhile are published together
+CATALOG_SNAPSHOT_DELAY = 1.0
+# Seconds replaced snapshot files are kept for clients that were redirected to them
+CATALOG_SNAPSHOT_RETAIN = 3600
+
+# Where "manage.py archive_year" writes the ratings of closed years, one SQLite file per year
+ARCHIVE_DIR = BASE_DIR / 'archive'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
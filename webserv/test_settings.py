@@ -0,0 +1,12 @@
+# Settings for "manage.py test", which picks them up unless DJANGO_SETTINGS_MODULE is set
+# Tests that publish catalog snapshots do so in a directory of their own, a test
+# catalog must never replace the published one
+from .settings import *
+
+CATALOG_SNAPSHOT_DIR = None
+
+# Rating shard used by the shard tests, they map years to it with override_settings(RATING_SHARDS=...)
+DATABASES['ratings_test'] = {
+    'ENGINE': 'rate.db.shard',
+    'NAME': ':memory:',
+}
@@ -16,15 +16,23 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from rate.views import register, login, logout, list_modules, rate_professor, view, average
+from rate.views import register, register_bulk, login, logout, list_modules, catalog_snapshot, rate_professor, rate_batch, view, average, changes, trending, raters, rating_status, admission
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/register/' , register),
+    path('api/users/bulk/', register_bulk),
     path('api/login/', login),
     path('api/list/', list_modules),
+    path('api/list/snapshots/<str:name>', catalog_snapshot),
     path('api/rate/', rate_professor),
+    path('api/rate/batch/', rate_batch),
+    path('api/rate/status/<str:receipt>/', rating_status),
     path('api/view/', view),
     path('api/average/', average),
     path('api/logout/', logout),
+    path('api/changes/', changes),
+    path('api/trending/', trending),
+    path('api/raters/', raters),
+    path('api/admission/', admission),
 ]